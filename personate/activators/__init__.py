@@ -1 +1,2 @@
 from personate.activators.activators import Activator
+from personate.activators.router import ActivationRouter
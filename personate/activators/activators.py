@@ -12,7 +12,7 @@ from typing import (
     Tuple,
 )
 import discord
-from acrossword import Ranker
+from personate.activators.router import ActivationRouter
 import random
 import asyncio
 import copy
@@ -129,6 +129,7 @@ class Activator:
         ignore_topics: Optional[List[str]] = None,
         sides: Optional[int] = None,
         mandatory: bool = False,
+        ranker: Optional[Any] = None,
     ) -> None:
         """
         This adds a check to the activator. It looks unusual, but it's elegant so whatever.
@@ -140,7 +141,11 @@ class Activator:
                     "on_topic": self.on_topic,
                     "on_diceroll": self.on_diceroll,
                 }[condition](
-                    name=name, topic=topic, sides=sides, ignore_topics=ignore_topics
+                    name=name,
+                    topic=topic,
+                    sides=sides,
+                    ignore_topics=ignore_topics,
+                    ranker=ranker,
                 )
                 self.optional_checks.append(check)
                 return
@@ -432,45 +437,21 @@ class Activator:
 
         return checker
 
-    def on_topic(self, topic: str, ignore_topics: List[str], **kwargs) -> Callable:
-        ranker = Ranker()
-        on_topic = (
-            f"This sentence is specifically related to {topic} and mentions {topic}"
-        )
-        not_on_topic = [
-            "This sentence is unoffensive and contains no upsetting content",
-            "This sentence is calm and factual",
-            "This sentence is conversational and casual",
-            "This sentence is not very interesting and talks about generic topics",
-            "This sentence is about science, sports, art, computers, or music",
-        ]
-        topics = [on_topic]
-        topics.extend(not_on_topic)
-        if ignore_topics:
-            topics.extend(
-                [
-                    f"This sentence is specifically related to {topic} and mentions {topic}"
-                    for topic in ignore_topics
-                ]
-            )
+    def on_topic(
+        self,
+        topic: str,
+        ignore_topics: List[str],
+        ranker: Optional[Any] = None,
+        **kwargs,
+    ) -> Callable:
+        """
+        This activates your bot when a certain topic is mentioned. The topic is registered with the process-wide ActivationRouter for ranker (the default ranker if not given), so every Agent's on_topic checks are answered by embedding each message once.
+        """
+        router = ActivationRouter.shared(ranker)
+        group = router.register(topic=topic, ignore_topics=ignore_topics)
 
         async def checker(msg: discord.Message) -> bool:
-            content = msg.content
-            top_topic = await ranker.rank(
-                texts=tuple(topics),
-                query=content,
-                top_k=1,
-                model=ranker.default_model,
-                return_none_if_below_threshold=True,
-                threshold=0.3,
-            )
-
-            if top_topic:
-                if top_topic[0] == on_topic:
-                    return True
-                else:
-                    return False
-            return False
+            return group in await router.route(msg.content)
 
         return checker
 
@@ -0,0 +1,132 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from acrossword import Ranker
+from personate.embeddings.index import VectorIndex, embed
+from personate.embeddings.registry import get_ranker
+from personate.utils.logger import logger
+
+logger.disable(__name__)
+
+
+def topic_sentence(topic: str) -> str:
+    return f"This sentence is specifically related to {topic} and mentions {topic}"
+
+
+NOT_ON_TOPIC = [
+    "This sentence is unoffensive and contains no upsetting content",
+    "This sentence is calm and factual",
+    "This sentence is conversational and casual",
+    "This sentence is not very interesting and talks about generic topics",
+    "This sentence is about science, sports, art, computers, or music",
+]
+
+
+class ActivationRouter:
+    """
+    Decides which on_topic checks a message activates, for every Agent in the process at once.
+
+    Every registered topic (and its ignore_topics) shares one deduplicated topic matrix. A message is embedded once, scored against the whole matrix with one matrix product, and each registration's best-scoring sentence is picked out in the same vectorised pass. Results are cached per message content, and concurrent checks for the same message wait on the same computation – so when ten agents share a bot, the message is still only embedded once.
+
+    Example:
+        router = ActivationRouter.shared()
+        zig = router.register(topic="Zig programming language", ignore_topics=["zebra crossings"])
+        if zig in await router.route("How do I allocate memory in Zig?"):
+            ...
+    """
+
+    _shared: Dict[Any, "ActivationRouter"] = {}
+
+    @classmethod
+    def shared(cls, ranker: Optional[Ranker] = None) -> "ActivationRouter":
+        """Returns the process-wide router for ranker (or the default ranker). Agents using different ranking backends get different routers, since their topic vectors can't be compared."""
+        ranker = ranker or get_ranker()
+        if ranker not in cls._shared:
+            cls._shared[ranker] = cls(ranker=ranker)
+        return cls._shared[ranker]
+
+    def __init__(
+        self,
+        ranker: Optional[Ranker] = None,
+        threshold: float = 0.3,
+        cache_size: int = 512,
+    ) -> None:
+        self.ranker = ranker or get_ranker()
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.topics = VectorIndex()
+        self.groups: List[List[int]] = []
+        self.group_rows: Optional[np.ndarray] = None
+        self.results: "OrderedDict[str, Set[int]]" = OrderedDict()
+        self.pending: Dict[Tuple[int, str], asyncio.Future] = {}
+        # Bumped by register(), so routes computed against an older set of topics aren't cached or shared.
+        self.generation = 0
+
+    def _row_for(self, sentence: str) -> int:
+        row = self.topics.position_of(sentence)
+        if row is None:
+            self.topics.append([sentence])
+            row = len(self.topics) - 1
+        return row
+
+    def register(self, topic: str, ignore_topics: Optional[List[str]] = None) -> int:
+        """Adds a topic, returning the id that route() includes in its result whenever a message is about it."""
+        sentences = [topic_sentence(topic)] + NOT_ON_TOPIC
+        sentences.extend(topic_sentence(t) for t in ignore_topics or [])
+        # The on-topic sentence always comes first, so a group is activated when its argmax is column 0.
+        self.groups.append([self._row_for(s) for s in sentences])
+        width = max(len(g) for g in self.groups)
+        self.group_rows = np.array(
+            [g + [-1] * (width - len(g)) for g in self.groups], dtype=np.int64
+        )
+        self.generation += 1
+        self.results.clear()
+        return len(self.groups) - 1
+
+    async def _route(self, content: str) -> Set[int]:
+        # Topics registered while this is embedding aren't part of this route.
+        group_rows = self.group_rows
+        missing = self.topics.missing()
+        if missing:
+            self.topics.set_rows(
+                missing,
+                await embed(self.ranker, [self.topics.keys[i] for i in missing]),
+            )
+        query = (await embed(self.ranker, [content]))[0]
+        scores = np.append(self.topics.scores(query), -np.inf)
+        # Padding (-1) indexes the trailing -inf, so it never wins.
+        group_scores = scores[group_rows]
+        winners = np.argmax(group_scores, axis=1)
+        activated = (winners == 0) & (group_scores[:, 0] >= self.threshold)
+        return set(np.flatnonzero(activated).tolist())
+
+    async def route(self, content: str) -> Set[int]:
+        """Returns the ids of every registered topic that the content is about."""
+        if not self.groups:
+            return set()
+        if content in self.results:
+            self.results.move_to_end(content)
+            return self.results[content]
+        generation = self.generation
+        key = (generation, content)
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            result = await self._route(content)
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.pending[key]
+        if generation != self.generation:
+            return result
+        self.results[content] = result
+        if len(self.results) > self.cache_size:
+            self.results.popitem(last=False)
+        logger.debug(f"Message {content!r} activated topics {result}")
+        return result
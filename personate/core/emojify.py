@@ -1,5 +1,7 @@
 import json
-from acrossword import Ranker
+import os
+from personate.embeddings.classifier import LabelClassifier, vectors_path_for
+from personate.embeddings.registry import get_ranker
 import random
 import pkgutil
 from typing import Optional
@@ -7,7 +9,10 @@ from typing import Optional
 def emojify(emoji_file: str, names: Optional[list[str]] = None):
     with open(emoji_file, "r") as f:
         emojis = json.load(f)
-    ranker = Ranker()
+    ranker = get_ranker()
+    classifier = LabelClassifier(
+        emojis.keys(), ranker=ranker, vectors_path=vectors_path_for(emoji_file, ranker)
+    )
     def outer_wrapper(func):
         async def wrapper(*args, **kwargs):
             if not "name" in kwargs:
@@ -16,7 +21,7 @@ def emojify(emoji_file: str, names: Optional[list[str]] = None):
                 name = kwargs["name"]
             result = await func(*args, **kwargs)
             if names and name in names:
-                top_emoji = await ranker.rank(texts=tuple(emojis.keys()), query=result, top_k=1, model=ranker.default_model)
+                top_emoji = await classifier.classify(result, top_k=1)
                 return f"{result} {random.choice(emojis[top_emoji[0]])}"
             else:
                 return result
@@ -35,4 +40,23 @@ def get_all_emojis():
             full_description = f"{o['description']} {keywords}"
             unicode_char = f'{o["code"].replace("+", "000")}'
             emojis[full_description] = o["emoji"]
-    return emojis
\ No newline at end of file
+    return emojis
+
+
+all_emojis_classifier: Optional[LabelClassifier] = None
+
+
+def get_all_emojis_classifier() -> LabelClassifier:
+    """A LabelClassifier over every description from get_all_emojis, shared by the whole process. Its vectors are kept next to full-emoji-list.json."""
+    global all_emojis_classifier
+    if all_emojis_classifier is None:
+        ranker = get_ranker()
+        all_emojis_classifier = LabelClassifier(
+            get_all_emojis().keys(),
+            ranker=ranker,
+            vectors_path=vectors_path_for(
+                os.path.join(os.path.dirname(__file__), "full-emoji-list.json"),
+                ranker,
+            ),
+        )
+    return all_emojis_classifier
\ No newline at end of file
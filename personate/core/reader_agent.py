@@ -3,9 +3,10 @@ from typing import Coroutine, List, Optional
 from types import ModuleType 
 from urllib.parse import quote_plus
 from acrossword import Document, DocumentCollection, Ranker
+from personate.embeddings.registry import get_ranker
 from personate.utils.logger import logger
 from personate.core.agent import Agent, get_conversation_history
-from personate.core.emojify import get_all_emojis
+from personate.core.emojify import get_all_emojis, get_all_emojis_classifier
 from personate.core.frame import Prompt
 from personate.core.template import get_annotation_from_template
 from personate.swarm.swarm import Swarm
@@ -39,7 +40,7 @@ class ReaderAgent(Agent):
         agent.prompt.set_response_type(agent.response_type)
         
         # Collect knowledge documents
-        agent.ranker = Ranker()
+        agent.ranker = get_ranker()
         agent.reading_list = data["reading_list"]   
         agent.home_dir = f"bots/{agent.name}"
         if not os.path.exists(agent.home_dir):
@@ -165,7 +166,7 @@ class ReaderAgent(Agent):
                 self.add_abilities_from_file(importname)
                 
     async def get_emoji(self, msg: str) -> str:
-        top_emoji = await self.ranker.rank(texts=tuple(self.emojis.keys()), query=msg, top_k=1, model=self.ranker.default_model)
+        top_emoji = await get_all_emojis_classifier().classify(msg, top_k=1)
         return self.emojis[top_emoji[0]]
 
     async def generate_agent_response(self, msg: str):
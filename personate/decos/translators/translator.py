@@ -6,7 +6,9 @@ from personate.utils.logger import logger
 import types
 import discord
 from personate.swarm.internal_message import InternalMessage
-from acrossword import Ranker
+from personate.embeddings.classifier import LabelClassifier, vectors_path_for
+from personate.embeddings.context import EmbeddingContext
+from personate.embeddings.registry import get_ranker
 import random
 
 class Translator:
@@ -166,34 +168,37 @@ class CWTaggerTranslator(Translator):
                 ]
             )
         self.possible_cw_tag_options.extend(self.neutral_options)
+        self.ranker = get_ranker()
         self.__dict__.update(kwargs)
+        self.classifier = LabelClassifier(
+            self.possible_cw_tag_options, ranker=self.ranker
+        )
 
     def add_cw_topic(self, topic: str) -> None:
         self.possible_cw_tag_options.append(
             f"{self.standard_boilerplate_prefix} {topic}"
         )
+        self.classifier.add_labels([self.possible_cw_tag_options[-1]])
 
     async def spoiler_text_and_add_cw_tag(
-        self, agent_message: InternalMessage, **kwargs
+        self,
+        agent_message: InternalMessage,
+        embedding_context: Optional[EmbeddingContext] = None,
+        **kwargs,
     ) -> None:
         if not agent_message or (
             not agent_message.internal_content and agent_message.external_content
         ):
             return
-        ranker = Ranker()
-        top_labels: List[str] = await ranker.rank(
-            texts=tuple(self.possible_cw_tag_options),
-            query=agent_message.internal_content,
+        labels = await self.classifier.classify(
+            agent_message.internal_content,
             top_k=self.top_k,
-            model=ranker.default_model,
+            context=embedding_context,
         )
-        if top_labels[0] in self.neutral_options:
+        if labels[0] in self.neutral_options:
             return
         final_label = ", ".join(
-            [
-                topic.replace(self.standard_boilerplate_prefix, "")
-                for topic in top_labels
-            ]
+            [topic.replace(self.standard_boilerplate_prefix, "") for topic in labels]
         )
         agent_message.external_content = (
             f"CW {final_label} ||{agent_message.external_content}||"
@@ -240,32 +245,42 @@ class EmojiTranslator(Translator):
         final_emojis.update(neutral)
         self.filename = file
         self.emojis = final_emojis
+        self.ranker = get_ranker()
         self.__dict__.update(kwargs)
+        self.classifier = LabelClassifier(
+            self.emojis.keys(),
+            ranker=self.ranker,
+            vectors_path=vectors_path_for(file, self.ranker) if file else None,
+        )
 
     def append_emoji(self, tags: str, emoji: Union[str, list]) -> None:
         if isinstance(emoji, str):
             emoji = [emoji]
         self.emojis[tags] = emoji
+        self.classifier.add_labels([tags])
         if self.filename:
             with open(self.filename, "w") as f:
                 json.dump(self.emojis, f, indent=4)
 
-    async def add_emoji_to_message(self, agent_message: InternalMessage, **kwargs):
-        ranker = Ranker()
+    async def add_emoji_to_message(
+        self,
+        agent_message: InternalMessage,
+        embedding_context: Optional[EmbeddingContext] = None,
+        **kwargs,
+    ):
         """Adds an emoji to the text provided based on its semantic similarity to the provided emojis and their labels, does not add an emoji if the result of rank is an empty list."""
         # emojis should look like {"happy, cheerful, good mood": ["<:happy:293844>", "<:some_other_emoji:293833>"]}, etc.
         logger.debug(
             f"I am adding an emoji to the message now: {agent_message.internal_content}"
         )
-        top_labels: List[str] = await ranker.rank(
-            texts=tuple(self.emojis.keys()),
-            query=agent_message.internal_content,
-            top_k=1,
-            model=ranker.default_model,
+        if not self.emojis:
+            return
+        labels = await self.classifier.classify(
+            agent_message.internal_content, top_k=1, context=embedding_context
         )
-        logger.debug(f"The top labels are: {top_labels}")
-        if top_labels:
-            top_emojis: List[str] = self.emojis[top_labels[0]]
+        logger.debug(f"The top labels are: {labels}")
+        if labels:
+            top_emojis: List[str] = self.emojis[labels[0]]
             top_emoji = random.choice(top_emojis)
             text = f"{agent_message.external_content} {top_emoji}"
             agent_message.external_content = text
@@ -281,23 +296,47 @@ import pycld2 as cld2
 import asyncio
 
 
+def language_code(language: str) -> Optional[str]:
+    """The cld2 code for a language given by code or by name (e.g "fr" or "French" -> "fr"), or None if cld2 doesn't know it."""
+    wanted = language.strip().lower()
+    for name, code in cld2.LANGUAGES:
+        if code == "un":
+            continue
+        if wanted in (code.lower(), name.lower()):
+            return code
+    return None
+
+
 class LanguageTranslator(Translator):
-    def __init__(self, default_language_code: str = "en"):
+    def __init__(self, default_language_code: str = "en", memory: Any = None):
+        """With a memory, a language the user has set with setlanguage is used instead of guessing it from their message."""
         super().__init__()
         self.translators.append(self.translate_message)
         self.default_language_code = default_language_code
+        self.memory = memory
+
+    async def preferred_language(self, message: InternalMessage) -> Optional[str]:
+        author_id = getattr(message, "author_id", None)
+        if not self.memory or author_id is None:
+            return None
+        return (await self.memory.get_profile(author_id)).get("language")
 
     async def translate_message(
         self,
-        agent_message: InternalMessage,
-        processed_user_message: InternalMessage,
+        agent_message: Optional[InternalMessage] = None,
+        processed_user_message: Optional[InternalMessage] = None,
         **kwargs: dict,
     ) -> None:
+        """As a post-translator (given agent_message), translates the agent's reply into the user's language. As a pre-translator (without one), translates the user's message into the default language."""
+        preferred_language = await self.preferred_language(processed_user_message)
         if agent_message and processed_user_message:
-            isReliable, textBytesFound, details = cld2.detect(
-                processed_user_message.external_content
-            )
-            user_language = details[0][1]
+            if preferred_language:
+                isReliable, user_language = True, preferred_language
+            else:
+                isReliable, textBytesFound, details = cld2.detect(
+                    processed_user_message.external_content
+                )
+                user_language = details[0][1]
             logger.debug(f"The user language is: {user_language}")
             if user_language != self.default_language_code and isReliable:
                 try:
@@ -310,6 +349,8 @@ class LanguageTranslator(Translator):
                 except:
                     pass
         elif processed_user_message and not agent_message:
+            if preferred_language == self.default_language_code:
+                return
             isReliable, textBytesFound, details = cld2.detect(
                 processed_user_message.internal_content
             )
@@ -0,0 +1,12 @@
+from personate.embeddings.index import VectorIndex, embed
+from personate.embeddings.batching import configure_batching
+from personate.embeddings.classifier import LabelClassifier
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.documents import DocumentIndex
+from personate.embeddings.lexical import LexicalRanker
+from personate.embeddings.quantization import (
+    configure_quantization,
+    quantization_report,
+)
+from personate.embeddings.registry import RankerRegistry, get_ranker, registry
+from personate.embeddings.workers import configure_inference
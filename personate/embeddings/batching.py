@@ -0,0 +1,109 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from acrossword import Ranker
+from personate.embeddings.index import encode
+from personate.utils.logger import logger
+
+
+class EmbeddingBatcher:
+    """
+    Gathers embedding requests for one ranker and runs them as a single batched forward pass.
+
+    When no batch is running, a request is embedded straight away, so a lone request never waits. Requests made while a batch is running queue up, and are deduplicated and embedded together as soon as it finishes – or after `window` seconds, or once `max_batch` texts have queued, whichever comes first – and each awaiting coroutine gets back just the rows it asked for. When several channels are busy, this turns many batch-size-1 forward passes into a few large ones.
+    """
+
+    def __init__(self, ranker: Ranker, window: float, max_batch: int) -> None:
+        self.ranker = ranker
+        self.window = window
+        self.max_batch = max_batch
+        self.loop = asyncio.get_running_loop()
+        self.queue: List[Tuple[List[str], asyncio.Future]] = []
+        self.queued_texts = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.running = 0
+        self.stats = {"requests": 0, "batches": 0, "texts": 0}
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        future = self.loop.create_future()
+        self.queue.append((list(texts), future))
+        self.queued_texts += len(texts)
+        self.stats["requests"] += 1
+        if not self.running or self.queued_texts >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.queue:
+            return
+        batch, self.queue, self.queued_texts = self.queue, [], 0
+        self.running += 1
+        self.loop.create_task(self.run(batch))
+
+    async def run(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        try:
+            await self._run(batch)
+        finally:
+            self.running -= 1
+            # Whatever queued up behind this batch goes next, together.
+            if self.queue:
+                self.flush()
+
+    async def _run(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        unique = list(dict.fromkeys(t for texts, _ in batch for t in texts))
+        try:
+            vectors = await encode(self.ranker, unique)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(unique)
+        rows = {t: i for i, t in enumerate(unique)}
+        for texts, future in batch:
+            if not future.done():
+                future.set_result(vectors[[rows[t] for t in texts]])
+        logger.debug(
+            f"Embedded {len(unique)} texts for {len(batch)} requests in one batch"
+        )
+
+
+class BatchingSettings:
+    def __init__(self, window: Optional[float] = 0.005, max_batch: int = 256) -> None:
+        self.window = window
+        self.max_batch = max_batch
+
+
+settings = BatchingSettings()
+batchers: Dict[int, EmbeddingBatcher] = {}
+
+
+def configure_batching(window: Optional[float] = 0.005, max_batch: int = 256) -> None:
+    """
+    Sets the longest (in seconds) a request waits for a running batch to finish before its own batch is started, and how many texts a batch can hold before it is run early. Requests made while nothing is running never wait. Pass window=None to turn batching off and embed every request on its own.
+    """
+    settings.window = window
+    settings.max_batch = max_batch
+    batchers.clear()
+
+
+def batcher_for(ranker: Any) -> Optional[EmbeddingBatcher]:
+    """Returns the batcher for ranker on the running event loop, or None if batching is turned off."""
+    if settings.window is None:
+        return None
+    batcher = batchers.get(id(ranker))
+    if (
+        batcher is None
+        or batcher.ranker is not ranker
+        or batcher.loop is not asyncio.get_running_loop()
+    ):
+        batcher = EmbeddingBatcher(ranker, settings.window, settings.max_batch)
+        batchers[id(ranker)] = batcher
+    return batcher
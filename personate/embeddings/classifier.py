@@ -0,0 +1,103 @@
+import asyncio
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.index import VectorIndex, embed
+from personate.embeddings.registry import get_ranker
+from personate.utils.logger import logger
+
+
+def vectors_path_for(pack_path: str, ranker: Any) -> str:
+    """Where to keep the label vectors for a pack file (e.g an emoji json), next to the pack and named after the model that made them."""
+    model_name = getattr(ranker, "model_name", None) or "default"
+    base, _ = os.path.splitext(pack_path)
+    return f"{base}.{model_name.replace('/', '_')}.vectors.npz"
+
+
+class LabelClassifier:
+    """
+    Ranks a text against a fixed set of labels with a single dot product.
+
+    Labels are embedded once (in one batch, the first time they're needed) and kept in a matrix; labels added later with add_labels are embedded on the next call. With a vectors_path, the matrix is saved there and loaded back on the next start, so large label sets like the full emoji list or the icon list are never embedded twice.
+
+    Example:
+        classifier = LabelClassifier(["happy", "sad"], vectors_path="emojis.vectors.npz")
+        await classifier.classify("I won the lottery!")  # ["happy"]
+    """
+
+    def __init__(
+        self,
+        labels: Iterable[str] = (),
+        ranker: Optional[Any] = None,
+        vectors_path: Optional[str] = None,
+    ) -> None:
+        self.ranker = ranker or get_ranker()
+        self.vectors_path = vectors_path
+        self.index = VectorIndex()
+        self.positions: Dict[str, int] = {}
+        self.saved: Dict[str, np.ndarray] = {}
+        self.preparing: Optional[asyncio.Future] = None
+        if vectors_path and os.path.exists(vectors_path):
+            try:
+                saved = VectorIndex.load(vectors_path)
+                filled = np.flatnonzero(saved.filled).tolist()
+                self.saved = dict(
+                    zip([saved.keys[i] for i in filled], saved.rows(filled))
+                )
+            except (OSError, ValueError, KeyError):
+                logger.warning(f"Couldn't read label vectors from {vectors_path}")
+        self.add_labels(labels)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def labels(self) -> List[str]:
+        return self.index.keys  # type: ignore
+
+    def add_labels(self, labels: Iterable[str]) -> None:
+        for label in labels:
+            if label in self.positions:
+                continue
+            self.positions[label] = len(self.index)
+            vector = self.saved.pop(label, None)
+            self.index.append(
+                [label], None if vector is None else vector.reshape(1, -1)
+            )
+
+    async def prepare(self) -> None:
+        """Embeds every label that doesn't have a vector yet, and saves the matrix if there's a vectors_path."""
+        while self.index.missing():
+            # Concurrent callers wait on the same batch instead of embedding the labels again.
+            if self.preparing is None or self.preparing.done():
+                self.preparing = asyncio.ensure_future(self._embed_missing())
+            await asyncio.shield(self.preparing)
+
+    async def _embed_missing(self) -> None:
+        missing = self.index.missing()
+        vectors = await embed(self.ranker, [self.index.keys[i] for i in missing])
+        self.index.set_rows(missing, vectors)
+        if self.vectors_path:
+            try:
+                self.index.save(self.vectors_path)
+            except OSError:
+                logger.warning(f"Couldn't save label vectors to {self.vectors_path}")
+
+    async def classify(
+        self,
+        text: str,
+        top_k: int = 1,
+        threshold: Optional[float] = None,
+        context: Optional[EmbeddingContext] = None,
+    ) -> List[str]:
+        """Returns the top_k labels closest to text, best first."""
+        if len(self.index) == 0:
+            return []
+        await self.prepare()
+        query = (await embed_in(context, self.ranker, [text]))[0]
+        return [
+            self.index.keys[i]  # type: ignore
+            for i, _ in self.index.search(query, top_k=top_k, threshold=threshold)
+        ]
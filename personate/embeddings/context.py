@@ -0,0 +1,76 @@
+import asyncio
+from typing import Dict, Iterable, Optional, Sequence, Set
+
+import numpy as np
+from acrossword import Ranker
+from personate.embeddings.index import embed
+from personate.utils.logger import logger
+
+
+class EmbeddingContext:
+    """
+    Embeds each distinct text at most once, for the lifetime of one turn.
+
+    AgentFrame makes one of these per user message and hands it to every stage that needs vectors (example reordering, Swarm.solve, the emoji and CW translators...). Texts a stage asks for are embedded in one batch, texts that are already being embedded are waited on rather than embedded again, and prefetch() lets the frame batch together texts it knows several stages will ask for.
+    """
+
+    def __init__(self, ranker: Ranker) -> None:
+        self.ranker = ranker
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.prefetching: Set["asyncio.Task[np.ndarray]"] = set()
+        self.forward_passes = 0
+
+    def prefetch(self, texts: Iterable[str]) -> "asyncio.Task[np.ndarray]":
+        """Starts embedding texts in the background, in a single batch. The context keeps the task until it's done; if it fails, the stages waiting on those texts get the exception raised, so it's only logged here."""
+        task = asyncio.create_task(self.embed(list(texts)))
+        self.prefetching.add(task)
+        task.add_done_callback(self._prefetched)
+        return task
+
+    def _prefetched(self, task: "asyncio.Task[np.ndarray]") -> None:
+        self.prefetching.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Prefetching embeddings failed: {task.exception()!r}")
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Returns unit-normalised vectors for texts, embedding only the ones this context hasn't seen."""
+        batch = [
+            t
+            for t in dict.fromkeys(texts)
+            if t not in self.vectors and t not in self.pending
+        ]
+        if batch:
+            loop = asyncio.get_running_loop()
+            futures = {t: loop.create_future() for t in batch}
+            self.pending.update(futures)
+            try:
+                self.forward_passes += 1
+                vectors = await embed(self.ranker, batch)
+                for t, vector in zip(batch, vectors):
+                    self.vectors[t] = vector
+                    futures[t].set_result(vector)
+            except Exception as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    # Mark it as retrieved, since the caller gets the exception raised directly.
+                    future.exception()
+                raise
+            finally:
+                for t in batch:
+                    del self.pending[t]
+        waiting = [t for t in texts if t not in self.vectors]
+        if waiting:
+            await asyncio.gather(
+                *[asyncio.shield(self.pending[t]) for t in set(waiting)]
+            )
+        return np.stack([self.vectors[t] for t in texts])
+
+
+async def embed_in(
+    context: Optional[EmbeddingContext], ranker: Ranker, texts: Sequence[str]
+) -> np.ndarray:
+    """Embeds texts through the turn's context when there is one for the same model, or directly otherwise."""
+    if context is not None and context.ranker is ranker:
+        return await context.embed(texts)
+    return await embed(ranker, texts)
@@ -0,0 +1,180 @@
+import asyncio
+import os
+from html.parser import HTMLParser
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote_plus
+
+import aiohttp
+import numpy as np
+import orjson
+import regex as re
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.index import VectorIndex, encode
+from personate.embeddings.registry import get_ranker, registry
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_into_chunks(text: str, max_characters: int = 400) -> List[str]:
+    """Splits text into chunks of whole sentences, each at most max_characters long (unless a single sentence is longer), without crossing paragraphs."""
+    chunks: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        chunk = ""
+        for sentence in SENTENCE_END.split(" ".join(paragraph.split())):
+            if chunk and len(chunk) + 1 + len(sentence) > max_characters:
+                chunks.append(chunk)
+                chunk = ""
+            chunk = f"{chunk} {sentence}" if chunk else sentence
+        if chunk:
+            chunks.append(chunk)
+    return chunks
+
+
+class TextExtractor(HTMLParser):
+    """Collects the readable text of an HTML page, a paragraph per block element, leaving out scripts, styles and navigation."""
+
+    skipped = {"script", "style", "noscript", "nav", "header", "footer", "head"}
+    blocks = {"p", "div", "li", "br", "h1", "h2", "h3", "h4", "h5", "h6", "tr"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.parts: List[str] = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag: str, attrs: Any) -> None:
+        if tag in self.skipped:
+            self.skipping += 1
+        elif tag in self.blocks:
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.skipped:
+            self.skipping = max(0, self.skipping - 1)
+
+    def handle_data(self, data: str) -> None:
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+async def read_source(
+    source: str, is_url: bool = False, directory: Optional[str] = None
+) -> Tuple[str, List[str]]:
+    """Reads a knowledge document from a url or a text file, and returns its title and chunks. With a directory, they're also saved there as <url-quoted source>.json, for read_saved to load next time."""
+    if is_url:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(source) as response:
+                response.raise_for_status()
+                page = await response.text()
+        extractor = TextExtractor()
+        extractor.feed(page)
+        title, chunks = source, split_into_chunks(extractor.text())
+    else:
+
+        def read() -> str:
+            with open(source, encoding="utf-8") as f:
+                return f.read()
+
+        title, chunks = source.split("/")[-1], split_into_chunks(await asyncio.to_thread(read))
+    if directory:
+        save_chunks(f"{directory}/{quote_plus(source)}.json", title, chunks)
+    return title, chunks
+
+
+def save_chunks(filename: str, title: str, chunks: List[str]) -> None:
+    with open(filename, "wb") as f:
+        f.write(orjson.dumps({"title": title, "chunks": chunks}))
+
+
+async def read_saved(filename: str) -> Tuple[str, List[str]]:
+    """Loads the title and chunks of a document saved by read_source, or serialised by acrossword. Any vectors saved with it are left behind."""
+    with open(filename, "rb") as f:
+        data = orjson.loads(f.read())
+    if isinstance(data, dict) and "chunks" in data:
+        return data.get("title") or os.path.basename(filename), list(data["chunks"])
+    from acrossword import Document
+
+    document = await Document.deserialise(filename)
+    return document.title, list(document.chunks)
+
+
+class DocumentIndex:
+    """
+    An agent's knowledge: the chunks of its documents, searched by meaning.
+
+    Chunks are embedded with the agent's ranker, in one batch the next time the index is searched after they're added, straight into a VectorIndex – so they're stored at the precision set by configure_quantization, like every other index, instead of as the float32 vectors acrossword keeps on each Document. An int8 index scores every chunk with an int8 query, then rescores the best candidates at full precision.
+    """
+
+    def __init__(self, ranker: Any = None) -> None:
+        self.ranker = ranker or get_ranker()
+        # The ranker set_ranker was given, before fit_ranker fitted a copy of it.
+        self.unfitted = self.ranker
+        self.titles: List[str] = []
+        self.chunks: List[str] = []
+        self.vectors = VectorIndex()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def add(self, title: str, chunks: Iterable[str]) -> None:
+        chunks = [chunk for chunk in chunks if chunk.strip()]
+        self.titles += [title] * len(chunks)
+        self.chunks += chunks
+        self.vectors.append(chunks)
+
+    def add_document(self, document: Any) -> None:
+        """Adds the chunks of an acrossword Document, e.g one deserialised from a precomputed .json file. Its own vectors aren't kept; the chunks are embedded again with the agent's ranker."""
+        self.add(document.title, document.chunks)
+
+    def set_ranker(self, ranker: Any) -> None:
+        self.unfitted = ranker
+        self._use(ranker)
+
+    def _use(self, ranker: Any) -> None:
+        if ranker is not self.ranker:
+            self.vectors = VectorIndex(keys=self.chunks)
+        self.ranker = ranker
+
+    def fit_ranker(self) -> None:
+        """
+        With a ranking backend that learns word weights, like "lexical", switches to a copy fitted on the chunks (see RankerRegistry.fit), so the words that pick a document out from the others count for the most. The agent's own ranker is fitted on its examples and topics, which say little about its documents. Does nothing with a neural model.
+        """
+        model_name = getattr(self.unfitted, "model_name", None)
+        if model_name in registry.backends and self.chunks:
+            self._use(registry.fit(model_name, self.chunks))
+
+    async def embed_missing(self, batch_size: int = 256) -> None:
+        """Embeds every chunk that doesn't have a row in the index yet."""
+        missing = sorted({self.vectors.keys[i] for i in self.vectors.missing()})
+        embedded: Dict[Any, np.ndarray] = {}
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i : i + batch_size]
+            embedded.update(zip(batch, await encode(self.ranker, batch, in_thread=True)))
+        # Chunks may have been added while we were embedding, so match rows by text rather than by position.
+        positions = [
+            i for i in self.vectors.missing() if self.vectors.keys[i] in embedded
+        ]
+        if positions:
+            self.vectors.set_rows(
+                positions,
+                np.stack([embedded[self.vectors.keys[i]] for i in positions]),
+            )
+
+    async def search(
+        self,
+        query: str,
+        top: int = 3,
+        threshold: Optional[float] = None,
+        context: Optional[EmbeddingContext] = None,
+    ) -> List[str]:
+        """Returns the top chunks closest to query, best first. With the turn's context, query is embedded in the same batch as the turn's other texts."""
+        if not self.chunks:
+            return []
+        await self.embed_missing()
+        query_vector = (await embed_in(context, self.ranker, [query]))[0]
+        return [
+            self.chunks[i]
+            for i, _ in self.vectors.search(query_vector, top_k=top, threshold=threshold)
+        ]
@@ -0,0 +1,285 @@
+import asyncio
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from acrossword import Ranker
+from personate.embeddings.quantization import (
+    dequantize,
+    live_indexes,
+    quantize,
+    settings,
+)
+from personate.utils.logger import logger
+
+
+async def embed(ranker: Ranker, texts: Sequence[str]) -> np.ndarray:
+    """Embeds texts with the ranker's default model and returns them as unit-length float32 rows, so that a dot product is a cosine similarity. Requests are batched together with concurrent ones unless batching has been turned off with configure_batching(window=None)."""
+    if len(texts) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    from personate.embeddings.batching import batcher_for
+
+    batcher = batcher_for(ranker)
+    if batcher is not None:
+        return await batcher.embed(texts)
+    return await encode(ranker, texts)
+
+
+async def encode(
+    ranker: Ranker, texts: Sequence[str], in_thread: bool = False
+) -> np.ndarray:
+    """Runs a single forward pass over texts – in a worker process if configure_inference has set some up and the ranker is a registry model, or in this process otherwise (always, for backends like "lexical" that have no model to offload). With in_thread, a forward pass in this process runs in a thread of its own, with its own event loop, so background work (like recall's backlog) doesn't hold up the bot."""
+    from personate.embeddings.registry import RankerHandle, registry
+    from personate.embeddings.workers import NoWorkers, inference_pool
+
+    pool = inference_pool()
+    if (
+        pool is not None
+        and not pool.exhausted
+        and isinstance(ranker, RankerHandle)
+        and ranker.model_name not in registry.backends
+    ):
+        try:
+            vectors = await pool.encode(ranker.model_name, list(texts))
+            return normalise(vectors.reshape(len(texts), -1))
+        except NoWorkers:
+            logger.warning("No inference workers are left; embedding in this process")
+    if in_thread:
+        model_name = ranker.default_model
+        vectors = await asyncio.to_thread(
+            lambda: asyncio.run(
+                ranker.convert(model_name=model_name, sentences=tuple(texts))
+            )
+        )
+    else:
+        vectors = await ranker.convert(
+            model_name=ranker.default_model, sentences=tuple(texts)
+        )
+    return normalise(np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+
+
+def normalise(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Returns the indices of the top_k highest scores, best first, using a partial sort instead of sorting every score."""
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class VectorIndex:
+    """
+    A matrix of unit-normalised embeddings with one key per row, searched with a single matrix product.
+
+    Rows can be inserted before their vectors are known (e.g from a synchronous list.append) – they are tracked as missing until set_rows fills them in, so the caller can embed every missing row in one batch right before searching.
+
+    Rows are stored at the precision set by configure_quantization (or passed in). float16 halves the memory of a float32 index; int8 quarters it, with a per-row scale. int8 searches score every row with an int8 copy of the query, then rescore the best candidates against the full-precision query. A small sample of the original rows is kept so quantization_report can estimate the recall lost.
+    """
+
+    chunk_size = 8192
+    oversample = 4
+    sample_size = 256
+
+    def __init__(
+        self,
+        keys: Iterable[Hashable] = (),
+        matrix: Optional[np.ndarray] = None,
+        precision: Optional[str] = None,
+    ) -> None:
+        self.precision: str = precision or settings.precision
+        self.keys: List[Hashable] = list(keys)
+        self.matrix: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self.sample: Dict[Hashable, np.ndarray] = {}
+        self.filled: np.ndarray = np.full(
+            len(self.keys), matrix is not None, dtype=bool
+        )
+        if matrix is not None:
+            self.matrix, self.scales = self._store(matrix, self.keys)
+        live_indexes.add(self)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return None if self.matrix is None else self.matrix.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        if self.matrix is None:
+            return 0
+        return self.matrix.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    @property
+    def float32_nbytes(self) -> int:
+        return 0 if self.matrix is None else self.matrix.size * 4
+
+    def _store(
+        self, vectors: np.ndarray, keys: Sequence[Hashable] = ()
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self.precision != "float32":
+            for key, vector in zip(keys, vectors):
+                if len(self.sample) >= self.sample_size:
+                    break
+                self.sample[key] = np.asarray(vector, dtype=np.float32)
+        return quantize(vectors, self.precision)
+
+    def missing(self) -> List[int]:
+        return np.flatnonzero(~self.filled).tolist()
+
+    def insert(
+        self,
+        position: int,
+        keys: Sequence[Hashable],
+        vectors: Optional[np.ndarray] = None,
+    ) -> None:
+        position = max(0, min(position, len(self.keys)))
+        self.keys[position:position] = list(keys)
+        self.filled = np.insert(
+            self.filled, position, np.full(len(keys), vectors is not None)
+        )
+        if vectors is not None and self.matrix is None:
+            self.matrix, self.scales = self._store(
+                np.zeros((len(self.keys) - len(keys), vectors.shape[1]))
+            )
+        if self.matrix is not None:
+            rows, scales = self._store(
+                vectors
+                if vectors is not None
+                else np.zeros((len(keys), self.matrix.shape[1])),
+                keys if vectors is not None else (),
+            )
+            self.matrix = np.insert(self.matrix, position, rows, axis=0)
+            if self.scales is not None:
+                self.scales = np.insert(self.scales, position, scales)
+
+    def append(
+        self, keys: Sequence[Hashable], vectors: Optional[np.ndarray] = None
+    ) -> None:
+        self.insert(len(self.keys), keys, vectors)
+
+    def delete(self, positions: Sequence[int]) -> None:
+        positions = sorted(set(positions), reverse=True)
+        for position in positions:
+            self.sample.pop(self.keys[position], None)
+            del self.keys[position]
+        self.filled = np.delete(self.filled, positions)
+        if self.matrix is not None:
+            self.matrix = np.delete(self.matrix, positions, axis=0)
+        if self.scales is not None:
+            self.scales = np.delete(self.scales, positions)
+
+    def set_rows(self, positions: Sequence[int], vectors: np.ndarray) -> None:
+        if self.matrix is None:
+            self.matrix, self.scales = self._store(
+                np.zeros((len(self.keys), vectors.shape[1]))
+            )
+        positions = list(positions)
+        rows, scales = self._store(vectors, [self.keys[i] for i in positions])
+        self.matrix[positions] = rows
+        if self.scales is not None:
+            self.scales[positions] = scales
+        self.filled[positions] = True
+
+    def rows(self, positions: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Returns rows as float32, reading quantized rows back at their stored precision."""
+        if self.matrix is None:
+            return np.zeros((0 if positions is None else len(positions), 0))
+        if positions is None:
+            positions = range(len(self.keys))
+        positions = list(positions)
+        return dequantize(
+            self.matrix[positions],
+            None if self.scales is None else self.scales[positions],
+            self.precision,
+        )
+
+    def position_of(self, key: Hashable) -> Optional[int]:
+        try:
+            return self.keys.index(key)
+        except ValueError:
+            return None
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        if self.matrix is None:
+            return np.zeros(len(self.keys), dtype=np.float32)
+        query = query.reshape(-1).astype(np.float32)
+        if self.precision == "float32":
+            scores = self.matrix @ query
+        elif self.precision == "float16":
+            # Upcast a chunk at a time, so a search never holds a float32 copy of the whole matrix.
+            scores = np.concatenate(
+                [
+                    self.matrix[i : i + self.chunk_size].astype(np.float32) @ query
+                    for i in range(0, len(self.matrix), self.chunk_size)
+                ]
+                or [np.zeros(0, dtype=np.float32)]
+            )
+        else:
+            query_rows, query_scales = quantize(query.reshape(1, -1), "int8")
+            query_int = query_rows[0].astype(np.int32)
+            scores = np.concatenate(
+                [
+                    (self.matrix[i : i + self.chunk_size].astype(np.int32) @ query_int)
+                    * self.scales[i : i + self.chunk_size]  # type: ignore
+                    * query_scales[0]  # type: ignore
+                    for i in range(0, len(self.matrix), self.chunk_size)
+                ]
+                or [np.zeros(0, dtype=np.float32)]
+            ).astype(np.float32)
+        scores[~self.filled] = -np.inf
+        return scores
+
+    def search(
+        self, query: np.ndarray, top_k: int, threshold: Optional[float] = None
+    ) -> List[Tuple[int, float]]:
+        """Returns (position, score) pairs for the top_k rows most similar to query, best first. Rows scoring below threshold are dropped."""
+        scores = self.scores(query)
+        if self.precision == "int8":
+            candidates = top_k_indices(scores, top_k * self.oversample)
+            candidates = candidates[scores[candidates] != -np.inf]
+            rescored = self.rows(candidates) @ query.reshape(-1).astype(np.float32)
+            order = top_k_indices(rescored, top_k)
+            results = [(int(candidates[i]), float(rescored[i])) for i in order]
+        else:
+            results = [
+                (int(i), float(scores[i])) for i in top_k_indices(scores, top_k)
+            ]
+        return [
+            (i, score)
+            for i, score in results
+            if score != -np.inf and (threshold is None or score >= threshold)
+        ]
+
+    def save(self, path: str) -> None:
+        keys = np.array([str(k) for k in self.keys])
+        matrix = self.matrix if self.matrix is not None else np.zeros((0, 0))
+        scales = self.scales if self.scales is not None else np.zeros(0)
+        np.savez(
+            path,
+            keys=keys,
+            matrix=matrix,
+            scales=scales,
+            filled=self.filled,
+            precision=np.array(self.precision),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        data = np.load(path, allow_pickle=False)
+        precision = str(data["precision"]) if "precision" in data else "float32"
+        index = cls(keys=data["keys"].tolist(), precision=precision)
+        if data["matrix"].size:
+            index.matrix = data["matrix"]
+            index.scales = data["scales"] if precision == "int8" else None
+        index.filled = data["filled"].astype(bool)
+        return index
@@ -0,0 +1,98 @@
+"""
+The entry point of an embedding inference worker, run by InferencePool as `python -m personate.embeddings.inference_worker`.
+
+Workers are started from this module rather than through multiprocessing, so they never import (and re-run) the parent's __main__ script. Requests and replies are length-prefixed pickles on the worker's stdin and stdout; vectors travel back through shared memory.
+"""
+import asyncio
+import os
+import pickle
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+frame_header = struct.Struct("!I")
+
+# Filled in by load_worker_models.
+worker_rankers: Dict[Optional[str], object] = {}
+
+
+def pack_frame(message: Any) -> bytes:
+    body = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return frame_header.pack(len(body)) + body
+
+
+def read_frame(stream: IO[bytes]) -> Optional[Any]:
+    """Reads one message from a blocking stream, or returns None once the stream is closed."""
+    header = stream.read(frame_header.size)
+    if len(header) < frame_header.size:
+        return None
+    (length,) = frame_header.unpack(header)
+    return pickle.loads(stream.read(length))
+
+
+def load_worker_models(model_names: Tuple[Optional[str], ...]) -> None:
+    from acrossword import Ranker
+
+    for model_name in model_names:
+        ranker = Ranker()
+        if model_name:
+            ranker.add_model(model_name)
+            ranker.default_model = model_name
+        worker_rankers[model_name] = ranker
+
+
+def encode_in_worker(
+    model_name: Optional[str], texts: List[str]
+) -> Tuple[str, Tuple[int, ...]]:
+    """Runs a forward pass and leaves the result in a shared memory block, returning the block's name and the array's shape."""
+    ranker = worker_rankers.get(model_name)
+    if ranker is None:
+        load_worker_models((model_name,))
+        ranker = worker_rankers[model_name]
+    vectors = np.ascontiguousarray(
+        asyncio.run(
+            ranker.convert(model_name=ranker.default_model, sentences=tuple(texts))
+        ),
+        dtype=np.float32,
+    ).reshape(len(texts), -1)
+    block = shared_memory.SharedMemory(create=True, size=max(vectors.nbytes, 1))
+    np.ndarray(vectors.shape, dtype=np.float32, buffer=block.buf)[:] = vectors
+    # The parent process takes ownership of the block and unlinks it once it has copied the result out.
+    resource_tracker.unregister(block._name, "shared_memory")  # type: ignore
+    block.close()
+    return block.name, vectors.shape
+
+
+def handle(message: Tuple[Any, ...]) -> Any:
+    command, *args = message
+    if command == "load":
+        load_worker_models(*args)
+        return None
+    if command == "encode":
+        return encode_in_worker(*args)
+    raise ValueError(f"Unknown inference worker command {command!r}")
+
+
+def main() -> None:
+    # Replies go out on a private copy of stdout; anything the models print is sent to stderr so it can't corrupt them.
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    requests = sys.stdin.buffer
+    while True:
+        message = read_frame(requests)
+        if message is None:
+            # The parent has gone away.
+            return
+        try:
+            reply = ("ok", handle(message))
+        except Exception as e:
+            reply = ("error", f"{type(e).__name__}: {e}")
+        replies.write(pack_frame(reply))
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
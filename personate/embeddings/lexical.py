@@ -0,0 +1,101 @@
+import hashlib
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+STOPWORDS = frozenset(
+    """a an and are as at be but by for from has have he her his i if in is it its
+    me my no not of on or our she so that the their them they this to was we were
+    what when which who will with you your""".split()
+)
+
+WORD = re.compile(r"\w+")
+
+
+def hashed(feature: str, dimensions: int) -> Tuple[int, float]:
+    """Maps a feature to a column and a sign, so that collisions cancel out on average instead of piling up."""
+    digest = int.from_bytes(
+        hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little"
+    )
+    return digest % dimensions, (1.0 if digest >> 63 else -1.0)
+
+
+class LexicalRanker:
+    """
+    A ranking backend that needs no neural model: texts become hashed TF-IDF vectors of their words and character trigrams.
+
+    It has the same convert/rank/default_model interface as acrossword's Ranker, so it can stand in anywhere personate uses one – activation, example selection, abilities, emoji and CW labels. It loads instantly and its vectors take a few kB each, at the cost of only matching on shared words (trigrams let "zigs" still match "zig").
+
+    Inverse document frequencies start out flat. Calling fit() with a representative corpus (e.g the agent's examples) weights rare words up; do it before anything is embedded, since vectors made before and after a fit aren't comparable. Agent.fit_ranker does this for an agent's examples and topics, and DocumentIndex.fit_ranker for its knowledge documents, through RankerRegistry.fit.
+
+    Select it with get_ranker("lexical"), or with "ranking_backend": "lexical" in an agent's json.
+    """
+
+    default_model = "lexical"
+
+    def __init__(self, dimensions: int = 1024, trigram_weight: float = 0.5) -> None:
+        self.dimensions = dimensions
+        self.trigram_weight = trigram_weight
+        self.idf: Dict[str, float] = {}
+        self.default_idf = 1.0
+
+    def features(self, text: str) -> Counter:
+        words = [w for w in WORD.findall(text.lower()) if w not in STOPWORDS]
+        counts: Counter = Counter(words)
+        for word in words:
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                counts["3:" + padded[i : i + 3]] += self.trigram_weight
+        return counts
+
+    def fit(self, corpus: Iterable[str]) -> None:
+        documents = [set(self.features(text)) for text in corpus]
+        frequencies: Counter = Counter(f for document in documents for f in document)
+        total = len(documents)
+        self.idf = {
+            f: math.log((1 + total) / (1 + count)) + 1
+            for f, count in frequencies.items()
+        }
+        self.default_idf = math.log(1 + total) + 1
+
+    def vector(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature, count in self.features(text).items():
+            column, sign = hashed(feature, self.dimensions)
+            weight = (1 + math.log(count)) if count >= 1 else count
+            vector[column] += sign * weight * self.idf.get(feature, self.default_idf)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def convert(
+        self, model_name: Optional[str] = None, sentences: Sequence[str] = ()
+    ) -> np.ndarray:
+        if isinstance(sentences, str):
+            return self.vector(sentences)
+        return (
+            np.stack([self.vector(s) for s in sentences])
+            if sentences
+            else np.zeros((0, self.dimensions), dtype=np.float32)
+        )
+
+    async def rank(
+        self,
+        texts: Sequence[str],
+        query: str,
+        top_k: int = 5,
+        model: Optional[str] = None,
+        return_none_if_below_threshold: bool = False,
+        threshold: float = 0.0,
+    ) -> Optional[List[str]]:
+        if not texts:
+            return [] if not return_none_if_below_threshold else None
+        scores = await self.convert(sentences=texts) @ self.vector(query)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        if return_none_if_below_threshold:
+            order = [i for i in order if scores[i] >= threshold]
+            if not order:
+                return None
+        return [texts[i] for i in order]
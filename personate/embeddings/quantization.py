@@ -0,0 +1,92 @@
+import weakref
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class QuantizationSettings:
+    def __init__(self, precision: str = "float32") -> None:
+        self.precision = precision
+
+
+settings = QuantizationSettings()
+
+# Every live VectorIndex, so quantization_report can find them.
+live_indexes: "weakref.WeakSet[Any]" = weakref.WeakSet()
+
+
+def configure_quantization(precision: str = "float32") -> None:
+    """
+    Sets the storage precision for vector indexes created from now on: "float32" (no quantization), "float16" (half the memory, practically lossless) or "int8" (a quarter of the memory, with the top candidates rescored against the full-precision query).
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {', '.join(PRECISIONS)}")
+    settings.precision = precision
+
+
+def quantize(
+    vectors: np.ndarray, precision: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Returns the stored form of float32 rows, and the per-row scales needed to read them back for int8."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == "float32":
+        return vectors, None
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    rows = np.round(vectors / scales[:, None]).astype(np.int8)
+    return rows, scales.astype(np.float32)
+
+
+def dequantize(
+    rows: np.ndarray, scales: Optional[np.ndarray], precision: str
+) -> np.ndarray:
+    if precision == "int8":
+        return rows.astype(np.float32) * scales[:, None]  # type: ignore
+    return rows.astype(np.float32)
+
+
+def recall_at_k(originals: np.ndarray, precision: str, top_k: int = 10) -> float:
+    """How many of each sample row's true top_k neighbours (among the sample) survive quantization, on average."""
+    if len(originals) < 2 or precision == "float32":
+        return 1.0
+    top_k = min(top_k, len(originals) - 1)
+    rows, scales = quantize(originals, precision)
+    approximate = dequantize(rows, scales, precision) @ originals.T
+    exact = originals @ originals.T
+    true_top = np.argsort(-exact, axis=0)[:top_k]
+    approximate_top = np.argsort(-approximate, axis=0)[:top_k]
+    hits = [
+        len(set(true_top[:, i]) & set(approximate_top[:, i]))
+        for i in range(len(originals))
+    ]
+    return float(np.mean(hits)) / top_k
+
+
+def quantization_report(top_k: int = 10) -> Dict[str, Any]:
+    """
+    Adds up the memory used by every live vector index, what the same rows would take at float32, and the estimated recall@top_k of the quantized indexes (measured on the sample of original rows each index keeps).
+    """
+    total = 0
+    full_precision = 0
+    recalls = []
+    for index in list(live_indexes):
+        total += index.nbytes
+        full_precision += index.float32_nbytes
+        if index.precision != "float32" and len(index.sample) > 1:
+            recalls.append(
+                recall_at_k(
+                    np.stack(list(index.sample.values())), index.precision, top_k
+                )
+            )
+    return {
+        "precision": settings.precision,
+        "indexes": len(live_indexes),
+        "bytes": total,
+        "float32_bytes": full_precision,
+        "bytes_saved": full_precision - total,
+        f"recall@{top_k}": float(np.mean(recalls)) if recalls else 1.0,
+    }
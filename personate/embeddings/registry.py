@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from acrossword import Ranker
+from personate.embeddings.lexical import LexicalRanker
+from personate.utils.logger import logger
+
+
+def resident_memory() -> int:
+    """Bytes of resident memory used by this process, or 0 if the platform doesn't say."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def parameter_bytes(ranker: Ranker) -> int:
+    """Bytes held by the parameters of any torch models the ranker exposes, or 0 if it doesn't expose any."""
+    total = 0
+    models = getattr(ranker, "models", None)
+    for model in (models.values() if isinstance(models, dict) else []):
+        try:
+            total += sum(p.numel() * p.element_size() for p in model.parameters())
+        except AttributeError:
+            continue
+    return total
+
+
+class RankerHandle:
+    """
+    A stand-in for a Ranker that belongs to a RankerRegistry. It can be handed out and stored anywhere a Ranker is expected; the model behind it is only loaded the first time one of its attributes is used, and every handle for the same model shares one loaded instance.
+    """
+
+    def __init__(self, registry: "RankerRegistry", model_name: Optional[str]) -> None:
+        self._registry = registry
+        self._model_name = model_name
+
+    @property
+    def model_name(self) -> Optional[str]:
+        return self._model_name
+
+    @property
+    def loaded(self) -> bool:
+        return self._model_name in self._registry.rankers
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._registry.load(self._model_name), name)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<RankerHandle {self._model_name or 'default'} ({state})>"
+
+
+class RankerRegistry:
+    """
+    Owns every embedding model loaded in this process.
+
+    Everything in personate asks the registry for a ranker instead of constructing one, so hosting many agents in one process only loads each model once. Models are loaded lazily, the first time a handle is actually used.
+
+    Names registered with register_backend are built by their factory instead of being loaded as a SentenceTransformers model into acrossword's Ranker. A backend only needs a default_model attribute and the async convert(model_name, sentences) (and, for older callers, rank) methods that acrossword's Ranker has; personate ships the model-free "lexical" backend.
+
+    Example:
+        ranker = registry.get()  # nothing is loaded yet
+        await ranker.rank(...)   # loads the default model
+        registry.report()        # {"default": {"loaded": True, "bytes": ..., ...}}
+        registry.get("lexical")  # a hashed TF-IDF backend, no model needed
+    """
+
+    def __init__(self) -> None:
+        self.backends: Dict[str, Callable[[], Any]] = {}
+        self.rankers: Dict[Optional[str], Ranker] = {}
+        self.handles: Dict[Optional[str], RankerHandle] = {}
+        self.stats: Dict[Optional[str], Dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, model_name: Optional[str] = None) -> RankerHandle:
+        """Returns the shared handle for model_name (or the default model), without loading it."""
+        with self.lock:
+            if model_name not in self.handles:
+                self.handles[model_name] = RankerHandle(self, model_name)
+            return self.handles[model_name]
+
+    def load(self, model_name: Optional[str] = None) -> Ranker:
+        ranker = self.rankers.get(model_name)
+        if ranker is not None:
+            return ranker
+        with self.lock:
+            if model_name in self.rankers:
+                return self.rankers[model_name]
+            memory_before = resident_memory()
+            started = time.perf_counter()
+            if model_name in self.backends:
+                ranker = self.backends[model_name]()
+            else:
+                ranker = Ranker()
+                if model_name:
+                    ranker.add_model(model_name)
+                    ranker.default_model = model_name
+            memory_used = parameter_bytes(ranker) or max(
+                0, resident_memory() - memory_before
+            )
+            self.stats[model_name] = {
+                "bytes": memory_used,
+                "load_seconds": time.perf_counter() - started,
+            }
+            self.rankers[model_name] = ranker
+            logger.info(
+                f"Loaded embedding model {model_name or 'default'} in {self.stats[model_name]['load_seconds']:.1f}s using {memory_used / 2**20:.0f} MB"
+            )
+            return ranker
+
+    def register_backend(self, name: str, factory: Callable[[], Any]) -> None:
+        """Makes get(name) hand out whatever factory builds, instead of a Ranker for a model called name."""
+        self.backends[name] = factory
+
+    def fit(self, model_name: str, corpus: Iterable[str]) -> RankerHandle:
+        """
+        Returns a handle for a copy of the backend model_name fitted on corpus, for backends that learn from text (like "lexical"), or model_name's own handle for those that don't. The copy is registered as "<model_name>-<digest of corpus>", so agents fitted on the same corpus share it, and vectors from different fits are never mixed – saved vector files and recall vectors are kept per model name.
+        """
+        corpus = list(corpus)
+        factory = self.backends[model_name]
+        if not hasattr(self.load(model_name), "fit"):
+            return self.get(model_name)
+        digest = hashlib.blake2b(
+            "\0".join(corpus).encode(), digest_size=6
+        ).hexdigest()
+        fitted_name = f"{model_name}-{digest}"
+
+        def build() -> Any:
+            ranker = factory()
+            ranker.fit(corpus)
+            return ranker
+
+        if fitted_name not in self.backends:
+            self.register_backend(fitted_name, build)
+        return self.get(fitted_name)
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the load state, memory use (in bytes) and load time of every model that has been asked for."""
+        return {
+            (name or "default"): {
+                "loaded": name in self.rankers,
+                **self.stats.get(name, {"bytes": 0, "load_seconds": 0.0}),
+            }
+            for name in self.handles
+        }
+
+    def unload(self, model_name: Optional[str] = None) -> None:
+        """Drops the loaded model. Its handles stay valid and will load it again if they are used."""
+        with self.lock:
+            self.rankers.pop(model_name, None)
+            self.stats.pop(model_name, None)
+
+
+registry = RankerRegistry()
+registry.register_backend("lexical", LexicalRanker)
+
+
+def get_ranker(model_name: Optional[str] = None) -> RankerHandle:
+    return registry.get(model_name)
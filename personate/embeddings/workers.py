@@ -0,0 +1,207 @@
+import asyncio
+import pickle
+import sys
+from multiprocessing import shared_memory
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from personate.utils.logger import logger
+
+
+class WorkerExited(RuntimeError):
+    """The worker process died, or its pipe broke, so it can't answer any more requests."""
+
+
+class NoWorkers(RuntimeError):
+    """Every worker has died and none could be started in their place."""
+
+
+class InferenceWorker:
+    """One worker process, started from personate.embeddings.inference_worker, that answers one request at a time."""
+
+    def __init__(self, process: asyncio.subprocess.Process) -> None:
+        self.process = process
+
+    @classmethod
+    async def start(
+        cls, preload: Tuple[Optional[str], ...], timeout: float
+    ) -> "InferenceWorker":
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "personate.embeddings.inference_worker",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        worker = cls(process)
+        try:
+            await asyncio.wait_for(worker.request(("load", preload)), timeout)
+        except asyncio.TimeoutError:
+            worker.kill()
+            raise RuntimeError(
+                f"Inference worker didn't load its models within {timeout:.0f}s"
+            )
+        except BaseException:
+            worker.kill()
+            raise
+        return worker
+
+    async def request(self, message: Tuple[Any, ...]) -> Any:
+        # Imported here, so a worker starting up (which imports this package) doesn't import its own module before running it as __main__.
+        from personate.embeddings.inference_worker import frame_header, pack_frame
+
+        try:
+            self.process.stdin.write(pack_frame(message))  # type: ignore
+            await self.process.stdin.drain()  # type: ignore
+            header = await self.process.stdout.readexactly(frame_header.size)  # type: ignore
+            (length,) = frame_header.unpack(header)
+            status, payload = pickle.loads(
+                await self.process.stdout.readexactly(length)  # type: ignore
+            )
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            raise WorkerExited(
+                f"Inference worker {self.process.pid} has exited (code {self.process.returncode})"
+            ) from e
+        if status == "error":
+            raise RuntimeError(f"Inference worker failed: {payload}")
+        return payload
+
+    def kill(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+
+
+class InferencePool:
+    """
+    Runs embedding model inference in a pool of worker processes, so CPU-bound forward passes never block the event loop (and with it, the Discord gateway heartbeat).
+
+    Workers are started on first use, in the running event loop, as `python -m personate.embeddings.inference_worker` – they never import the parent's __main__ script. Each loads its own copy of the models it is asked for, and results come back through shared memory rather than being pickled across the process boundary. If the workers can't start (or load their models within start_timeout seconds), encode raises instead of waiting for them.
+
+    A worker that dies fails the request it was answering, and is replaced in the background. If none are left and none can be started, encode raises NoWorkers, and embed falls back to running the model in this process.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        preload: Tuple[Optional[str], ...] = (None,),
+        start_timeout: float = 300.0,
+    ):
+        self.workers = workers
+        self.preload = preload
+        self.start_timeout = start_timeout
+        self.processes: List[InferenceWorker] = []
+        self.idle: Optional[asyncio.Queue] = None
+        self.starting: Optional[asyncio.Future] = None
+        self.replacing = 0
+
+    async def start(self) -> None:
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self._start())
+        # A failed start stays failed, so every later call raises the same error instead of respawning workers each turn.
+        await asyncio.shield(self.starting)
+
+    async def _start(self) -> None:
+        started = await asyncio.gather(
+            *(
+                InferenceWorker.start(self.preload, self.start_timeout)
+                for _ in range(self.workers)
+            ),
+            return_exceptions=True,
+        )
+        self.processes = [w for w in started if isinstance(w, InferenceWorker)]
+        failures = [w for w in started if not isinstance(w, InferenceWorker)]
+        if failures:
+            self.shutdown()
+            raise RuntimeError(
+                f"{len(failures)} of {self.workers} inference workers failed to start: {failures[0]}"
+            ) from failures[0]
+        self.idle = asyncio.Queue()
+        for worker in self.processes:
+            self.idle.put_nowait(worker)
+        logger.info(f"Started {self.workers} inference workers")
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether every worker has died with none starting in their place."""
+        return self.idle is not None and not self.processes and not self.replacing
+
+    async def encode(self, model_name: Optional[str], texts: List[str]) -> np.ndarray:
+        await self.start()
+        worker = await self.idle.get()  # type: ignore
+        if worker is None:
+            # Put back for the next waiter, who has nothing to wait for either.
+            self.idle.put_nowait(None)  # type: ignore
+            raise NoWorkers("Every inference worker has exited")
+        # Shielded so that a cancelled caller can't leave a reply unread in the worker's pipe, or a shared memory block un-unlinked.
+        return await asyncio.shield(
+            asyncio.ensure_future(self._encode_on(worker, model_name, texts))
+        )
+
+    async def _encode_on(
+        self, worker: InferenceWorker, model_name: Optional[str], texts: List[str]
+    ) -> np.ndarray:
+        try:
+            name, shape = await worker.request(("encode", model_name, texts))
+        except WorkerExited:
+            self.replace(worker)
+            raise
+        except BaseException:
+            # The model failed, but the worker is fine.
+            self.idle.put_nowait(worker)  # type: ignore
+            raise
+        self.idle.put_nowait(worker)  # type: ignore
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            return np.ndarray(shape, dtype=np.float32, buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+
+    def replace(self, worker: InferenceWorker) -> None:
+        """Drops a dead worker and starts another in its place."""
+        worker.kill()
+        if worker in self.processes:
+            self.processes.remove(worker)
+        self.replacing += 1
+        asyncio.ensure_future(self._replace())
+
+    async def _replace(self) -> None:
+        try:
+            worker = await InferenceWorker.start(self.preload, self.start_timeout)
+        except Exception as e:
+            logger.warning(f"Couldn't replace an inference worker that exited: {e}")
+            worker = None
+        finally:
+            self.replacing -= 1
+        if worker is not None:
+            self.processes.append(worker)
+            self.idle.put_nowait(worker)  # type: ignore
+            logger.info("Replaced an inference worker that exited")
+        elif self.exhausted:
+            # Wakes whoever is waiting for a worker, so they can fall back.
+            self.idle.put_nowait(None)  # type: ignore
+
+    def shutdown(self) -> None:
+        for worker in self.processes:
+            worker.kill()
+        self.processes = []
+
+
+pool: Optional[InferencePool] = None
+
+
+def configure_inference(workers: int = 0, start_timeout: float = 300.0) -> None:
+    """
+    Sets how many worker processes run embedding inference. With workers=0 (the default) inference runs in the event loop's process, as before. The workers start the first time something is embedded.
+    """
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+    if workers > 0:
+        pool = InferencePool(workers, start_timeout=start_timeout)
+        logger.info(f"Running embedding inference in {workers} worker processes")
+
+
+def inference_pool() -> Optional[InferencePool]:
+    return pool
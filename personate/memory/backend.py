@@ -0,0 +1,163 @@
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
+
+import discord
+from personate.swarm.internal_message import InternalMessage
+
+
+class MemoryBackend(ABC):
+    """
+    What an Agent needs from its memory: storing messages, reading them back by id and by reply chain, per-channel history watermarks, user profiles and a few other values.
+
+    Memory (a local SQLite file) and RedisMemory (a Redis server, shared by every process running the agent) implement it. The features only Memory (and ShardedMemory) has – full-text search, summaries, recall vectors, retention and export – aren't part of the interface; Agent refuses to turn them on for a backend without them.
+    """
+
+    # Fetches messages a reply chain refers to that aren't stored; see set_fetcher.
+    fetcher: Optional[Any] = None
+
+    @abstractmethod
+    async def insert_message(self, message_id: int, message: InternalMessage): ...
+
+    @abstractmethod
+    async def insert_missing(self, messages: Iterable[InternalMessage]) -> int:
+        """Stores the messages that aren't stored yet, leaving the rest untouched. Returns how many were new."""
+
+    @abstractmethod
+    async def get_many(
+        self, message_ids: Iterable[int], channel_id: Optional[int] = None
+    ) -> Dict[int, InternalMessage]:
+        """Returns every message in message_ids that is stored, by id."""
+
+    async def get_message(
+        self, message_id: int, channel_id: Optional[int] = None
+    ) -> Optional[InternalMessage]:
+        return (await self.get_many([message_id], channel_id)).get(message_id)
+
+    async def has_message(
+        self, message_id: int, channel_id: Optional[int] = None
+    ) -> bool:
+        return await self.get_message(message_id, channel_id) is not None
+
+    async def is_stored(
+        self, message_id: int, channel_id: Optional[int] = None
+    ) -> bool:
+        """Whether a reply chain that stops at message_id stopped because of its budget rather than a missing message."""
+        return await self.has_message(message_id, channel_id)
+
+    @abstractmethod
+    async def get_watermark(self, channel_id: int) -> int: ...
+
+    @abstractmethod
+    async def advance_watermark(self, channel_id: int, message_id: int) -> None: ...
+
+    @abstractmethod
+    async def get_value(self, key: str, default: Any = None) -> Any: ...
+
+    @abstractmethod
+    async def set_value(self, key: str, value: Any) -> None: ...
+
+    @abstractmethod
+    async def get_profile(self, author_id: int) -> Dict[str, str]: ...
+
+    @abstractmethod
+    async def set_profile_value(
+        self, author_id: int, key: str, value: Optional[str]
+    ) -> None: ...
+
+    @abstractmethod
+    async def past_messages(
+        self,
+        reply_to: int,
+        window_size: int,
+        characters: int,
+        max_characters: int,
+        channel_id: Optional[int] = None,
+    ) -> List[InternalMessage]:
+        """
+        Returns the stored messages above a reply to reply_to, oldest first: at most window_size - 1 of them, and only while they and the characters already used add up to at most max_characters.
+        """
+
+    def set_fetcher(self, fetcher: Optional[Any]) -> None:
+        """With a ReplyFetcher, retrieve_reply_chain reads through to Discord for messages a chain refers to that aren't stored, and stores them."""
+        self.fetcher = fetcher
+
+    async def retrieve_reply_chain(
+        self,
+        message: Union[discord.Message, InternalMessage],
+        window_size: int = 15,
+        max_characters: int = 800,
+    ) -> List[InternalMessage]:
+        """
+        Returns message and up to window_size - 1 of the messages it replies to, oldest first. Like a conversation window, a reply is only included while the messages after it add up to at most max_characters.
+
+        With a fetcher set, a walk that stops at a message that isn't stored fetches it from Discord, stores it and carries on. Each round asks the fetcher for every link known to be missing at once, so they're fetched concurrently, within the fetcher's limit.
+        """
+        if window_size < 1:
+            return []
+        if isinstance(message, discord.Message):
+            msg = InternalMessage.from_discord_message(message)
+        else:
+            msg = message
+        characters = len(msg.internal_content)
+        reply_to = getattr(msg, "reply_to", 0)
+        channel_id = getattr(msg, "channel_id", 0)
+        past_messages = await self.past_messages(
+            reply_to, window_size, characters, max_characters, channel_id
+        )
+        fetched_ids: Set[int] = set()
+        referenced: List[int] = []
+        for _ in range(self.fetcher.max_rounds if self.fetcher else 0):
+            stopped_at = past_messages[0].reply_to if past_messages else reply_to
+            if not stopped_at or len(past_messages) + 1 >= window_size:
+                break
+            # A link's parent is only known once the link has been read, so each round can only ask for the ids known to be missing so far: where the walk stopped, and the parents of what the last round fetched.
+            candidates = [
+                i for i in dict.fromkeys([stopped_at, *referenced]) if i not in fetched_ids
+            ]
+            stored = await asyncio.gather(
+                *[self.is_stored(i, channel_id) for i in candidates]
+            )
+            missing = [i for i, is_stored in zip(candidates, stored) if not is_stored]
+            if stopped_at not in missing:
+                break
+            fetched = await self.fetcher.fetch(channel_id, missing)  # type: ignore
+            fetched_ids.update(missing)
+            if not fetched:
+                break
+            fetched_ids.update(m.id for m in fetched)
+            referenced = [m.reply_to for m in fetched if m.reply_to]
+            await self.insert_missing(fetched)
+            past_messages = await self.past_messages(
+                reply_to, window_size, characters, max_characters, channel_id
+            )
+        return past_messages + [msg]
+
+    async def retrieve_all_messages(
+        self,
+        msg: discord.Message,
+        window_size: int = 15,
+        max_characters: int = 800,
+    ) -> List[InternalMessage]:
+        """This function uses pycord's api"""
+        history = await msg.channel.history().flatten()
+        history.reverse()
+        past_messages: List[discord.Message] = []
+        for message in history[:window_size]:
+            past_messages.append(message)
+            if sum([len(m.content) for m in past_messages]) > max_characters:
+                break
+        past_messages.reverse()
+        converted_past_messages: List[InternalMessage] = [
+            InternalMessage.from_discord_message(m) for m in past_messages
+        ]
+        return converted_past_messages
+
+    def flush(self) -> int:
+        return 0
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {}
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,140 @@
+import sys
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from personate.swarm.internal_message import InternalMessage
+
+ChainKey = Tuple[int, int, int]
+
+
+def message_size(message: InternalMessage) -> int:
+    """Roughly how many bytes a cached message holds on to."""
+    return (
+        sys.getsizeof(message)
+        + sys.getsizeof(getattr(message, "name", ""))
+        + sys.getsizeof(getattr(message, "internal_content", ""))
+        + sys.getsizeof(getattr(message, "external_content", ""))
+    )
+
+
+class MessageCache:
+    """
+    A bounded LRU of recent messages and the reply chains computed from them, kept in front of a Memory.
+
+    It is write-through: Memory puts every message it stores into the cache as well, so the messages of an active conversation (and the chains built from them) are answered without touching SQLite. Messages are evicted least recently used first, once there are more than max_messages or they add up to more than max_bytes.
+
+    A chain is stored as the ids of the messages above a reply, plus the id it stopped at. Storing a message that is in a chain – or is the one it stopped at, e.g a missing parent that turns up later – drops the chain, and so does removing one, so cached chains never go stale.
+    """
+
+    def __init__(
+        self,
+        max_messages: int = 4096,
+        max_bytes: int = 8 * 2**20,
+        max_chains: int = 512,
+    ) -> None:
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_chains = max_chains
+        self.messages: "OrderedDict[int, InternalMessage]" = OrderedDict()
+        self.sizes: Dict[int, int] = {}
+        self.nbytes = 0
+        self.chains: "OrderedDict[ChainKey, Tuple[Tuple[int, ...], int]]" = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+        self.chain_hits = 0
+        self.chain_misses = 0
+
+    def __contains__(self, message_id: Hashable) -> bool:
+        return message_id in self.messages
+
+    def get(self, message_id: int) -> Optional[InternalMessage]:
+        message = self.messages.get(message_id)
+        if message is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.messages.move_to_end(message_id)
+        return message
+
+    def put(self, message_id: int, message: InternalMessage) -> None:
+        if message_id in self.messages:
+            self.nbytes -= self.sizes[message_id]
+        self.messages[message_id] = message
+        self.messages.move_to_end(message_id)
+        self.sizes[message_id] = message_size(message)
+        self.nbytes += self.sizes[message_id]
+        self.invalidate_chains(message_id)
+        while self.messages and (
+            len(self.messages) > self.max_messages or self.nbytes > self.max_bytes
+        ):
+            evicted, _ = self.messages.popitem(last=False)
+            self.nbytes -= self.sizes.pop(evicted)
+
+    def get_chain(self, key: ChainKey) -> Optional[List[InternalMessage]]:
+        entry = self.chains.get(key)
+        if entry is not None:
+            messages = [self.messages.get(i) for i in entry[0]]
+            if all(m is not None for m in messages):
+                self.chain_hits += 1
+                self.chains.move_to_end(key)
+                for i in entry[0]:
+                    self.messages.move_to_end(i)
+                return messages  # type: ignore
+            del self.chains[key]
+        self.chain_misses += 1
+        return None
+
+    def put_chain(
+        self, key: ChainKey, messages: List[InternalMessage], stopped_at: int
+    ) -> None:
+        for message in messages:
+            if message.id not in self.messages:
+                self.put(message.id, message)
+        self.chains[key] = (tuple(m.id for m in messages), stopped_at)
+        self.chains.move_to_end(key)
+        while len(self.chains) > self.max_chains:
+            self.chains.popitem(last=False)
+
+    def invalidate_chains(self, message_id: int) -> None:
+        self.invalidate_chains_of([message_id])
+
+    def invalidate_chains_of(self, message_ids: Iterable[int]) -> None:
+        """Drops every chain that contains, or stopped at, any of message_ids."""
+        message_ids = set(message_ids)
+        if not message_ids:
+            return
+        stale = [
+            key
+            for key, (ids, stopped_at) in self.chains.items()
+            if stopped_at in message_ids or not message_ids.isdisjoint(ids)
+        ]
+        for key in stale:
+            del self.chains[key]
+
+    def forget(self, message_ids: Iterable[int]) -> None:
+        """Drops messages that are no longer stored (e.g compacted out), and every chain they were part of."""
+        message_ids = set(message_ids)
+        for message_id in message_ids:
+            if message_id in self.messages:
+                del self.messages[message_id]
+                self.nbytes -= self.sizes.pop(message_id)
+        self.invalidate_chains_of(message_ids)
+
+    def clear(self) -> None:
+        self.messages.clear()
+        self.sizes.clear()
+        self.chains.clear()
+        self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "messages": len(self.messages),
+            "bytes": self.nbytes,
+            "chains": len(self.chains),
+            "hits": self.hits,
+            "misses": self.misses,
+            "chain_hits": self.chain_hits,
+            "chain_misses": self.chain_misses,
+        }
@@ -0,0 +1,204 @@
+import asyncio
+import gzip
+import os
+import time
+from itertools import islice
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import ujson as json
+from personate.memory.memory import COLUMN_NAMES, message_from_row, message_to_row
+from personate.swarm.internal_message import InternalMessage
+
+FORMATS = ("jsonl", "msgpack")
+VERSION = 1
+
+Progress = Callable[[int, Optional[int]], Any]
+
+
+def format_of(path: str) -> str:
+    """Guesses the format from the file name: msgpack for e.g "backup.msgpack.gz", gzipped JSONL for anything else."""
+    return "msgpack" if ".msgpack" in os.path.basename(path) else "jsonl"
+
+
+def _msgpack() -> Any:
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError(
+            "Exporting or importing msgpack needs the msgpack package (pip install msgpack), or use a .jsonl.gz file instead"
+        )
+    return msgpack
+
+
+def message_record(message: InternalMessage) -> Dict[str, Any]:
+    return {
+        "type": "message",
+        **dict(zip(COLUMN_NAMES, message_to_row(message.id, message))),
+    }
+
+
+def record_message(record: Dict[str, Any]) -> InternalMessage:
+    return message_from_row(tuple(record.get(c) for c in COLUMN_NAMES))  # type: ignore
+
+
+def _write_records(f: IO[bytes], records: List[Dict[str, Any]], fmt: str) -> None:
+    if fmt == "msgpack":
+        packer = _msgpack().Packer()
+        f.write(b"".join(packer.pack(record) for record in records))
+    else:
+        f.write(
+            "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode(
+                "utf-8"
+            )
+        )
+
+
+def _read_records(f: IO[bytes], fmt: str) -> Iterator[Dict[str, Any]]:
+    if fmt == "msgpack":
+        yield from _msgpack().Unpacker(f, raw=False, strict_map_key=False)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _require_local(memory: Any, method: str) -> None:
+    if not hasattr(memory, method):
+        raise TypeError(
+            f"{type(memory).__name__} can't be exported or imported; only Memory and ShardedMemory can"
+        )
+
+
+def _in_range(
+    message: InternalMessage,
+    created_at: float,
+    after: Optional[float],
+    before: Optional[float],
+    channels: Optional[set],
+) -> bool:
+    return (
+        (after is None or created_at >= after)
+        and (before is None or created_at < before)
+        and (channels is None or message.channel_id in channels)
+    )
+
+
+async def export_memory(
+    memory: Any,
+    path: str,
+    fmt: Optional[str] = None,
+    after: Optional[float] = None,
+    before: Optional[float] = None,
+    channels: Optional[Iterable[int]] = None,
+    profiles: bool = True,
+    page_size: int = 1000,
+    progress: Optional[Progress] = None,
+) -> int:
+    """
+    Streams a Memory's messages sent between the unix times after and before, in channels (or every channel), and its user profiles, to a gzipped file at path: JSONL, or msgpack with fmt="msgpack" or a ".msgpack" file name. Returns how many messages were exported.
+
+    It reads and writes a page at a time, compressing off the event loop, so it runs in constant memory and the bot can keep going while it does. progress, if given, is called after each page with the number of messages written so far and the total. The file only appears at path once it's complete.
+
+    Summaries, recall vectors and db values aren't exported; summaries and vectors are made again from the messages.
+
+    Example:
+        await export_memory(agent.memory, "backup.jsonl.gz", after=time.time() - 30 * DAY, progress=print)
+    """
+    _require_local(memory, "iter_messages")
+    fmt = fmt or format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {', '.join(FORMATS)}")
+    channels = None if channels is None else [int(c) for c in channels]
+    total = await memory.count_messages(after, before, channels)
+    header = {
+        "type": "header",
+        "version": VERSION,
+        "exported_at": time.time(),
+        "after": after,
+        "before": before,
+        "channels": channels,
+        "messages": total,
+    }
+    exported = 0
+    try:
+        with gzip.open(path + ".tmp", "wb") as f:
+            await asyncio.to_thread(_write_records, f, [header], fmt)
+            async for page in memory.iter_messages(after, before, channels, page_size):
+                await asyncio.to_thread(
+                    _write_records, f, [message_record(m) for m in page], fmt
+                )
+                exported += len(page)
+                if progress:
+                    progress(exported, total)
+            if profiles:
+                async for rows in memory.iter_profiles(page_size):
+                    records = [
+                        {"type": "profile", "author_id": a, "key": k, "value": v}
+                        for a, k, v in rows
+                    ]
+                    await asyncio.to_thread(_write_records, f, records, fmt)
+    except BaseException:
+        # Don't leave half an export behind.
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+    os.replace(path + ".tmp", path)
+    return exported
+
+
+async def import_memory(
+    memory: Any,
+    path: str,
+    fmt: Optional[str] = None,
+    after: Optional[float] = None,
+    before: Optional[float] = None,
+    channels: Optional[Iterable[int]] = None,
+    profiles: bool = True,
+    page_size: int = 1000,
+    progress: Optional[Progress] = None,
+) -> int:
+    """
+    Streams an export_memory file back into a Memory (or a ShardedMemory), a page at a time, replacing any messages it already has with the same ids. after, before and channels import only part of the file. progress is called after each page with the number of messages read so far and the number the file says it holds. Returns how many messages were imported.
+    """
+    _require_local(memory, "insert_many")
+    fmt = fmt or format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {', '.join(FORMATS)}")
+    channel_set = None if channels is None else {int(c) for c in channels}
+    imported = 0
+    read = 0
+    total: Optional[int] = None
+    with gzip.open(path, "rb") as f:
+        records = _read_records(f, fmt)
+        while True:
+            page = await asyncio.to_thread(lambda: list(islice(records, page_size)))
+            if not page:
+                break
+            messages: List[InternalMessage] = []
+            profile_rows = []
+            for record in page:
+                kind = record.get("type")
+                if kind == "header":
+                    total = record.get("messages")
+                elif kind == "message":
+                    read += 1
+                    message = record_message(record)
+                    if _in_range(
+                        message,
+                        record.get("created_at") or 0,
+                        after,
+                        before,
+                        channel_set,
+                    ):
+                        messages.append(message)
+                elif kind == "profile" and profiles:
+                    profile_rows.append(
+                        (record["author_id"], record["key"], record["value"])
+                    )
+            if messages:
+                imported += await memory.insert_many(messages)
+            if profile_rows:
+                await memory.insert_profiles(profile_rows)
+            if progress:
+                progress(read, total)
+    return imported
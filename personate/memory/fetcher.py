@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+import discord
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+def internal_message_from(message: discord.Message) -> InternalMessage:
+    """Converts a message fetched from Discord, following the reply even when Discord didn't resolve it, and a Personate bot's reply footer."""
+    internal = InternalMessage.from_discord_message(message)
+    if not internal.reply_to and message.reference and message.reference.message_id:
+        internal.reply_to = message.reference.message_id
+    try:
+        internal.reply_to = int(str(message.embeds[0].footer.text))
+    except (IndexError, ValueError, TypeError, AttributeError):
+        pass
+    return internal
+
+
+class ReplyFetcher:
+    """
+    Fetches messages a reply chain refers to but Memory doesn't have, so Memory.retrieve_reply_chain can read through to Discord instead of stopping short.
+
+    At most max_concurrent fetches are in flight at once, across every chain, and concurrent requests for the same id share one fetch. Ids Discord says don't exist (or the bot can't see) are remembered for negative_ttl seconds, so they aren't asked for again on every reply. A fetched message usually comes with the message it replies to, which is returned as well – so each request fills in up to two links.
+    """
+
+    def __init__(
+        self,
+        client: discord.Client,
+        max_concurrent: int = 4,
+        negative_ttl: float = 6 * 60 * 60,
+        max_negative: int = 10000,
+        max_rounds: int = 8,
+    ) -> None:
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        # How many times one chain may go back to Discord before it settles for what it has.
+        self.max_rounds = max_rounds
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.absent: "OrderedDict[int, float]" = OrderedDict()
+        self.inflight: Dict[int, "asyncio.Future[List[InternalMessage]]"] = {}
+        self.fetched = 0
+
+    def is_absent(self, message_id: int) -> bool:
+        expiry = self.absent.get(message_id)
+        if expiry is None:
+            return False
+        if expiry < time.time():
+            del self.absent[message_id]
+            return False
+        return True
+
+    def mark_absent(self, message_id: int) -> None:
+        self.absent[message_id] = time.time() + self.negative_ttl
+        self.absent.move_to_end(message_id)
+        while len(self.absent) > self.max_negative:
+            self.absent.popitem(last=False)
+
+    async def _channel(self, channel_id: int) -> Any:
+        channel = self.client.get_channel(channel_id)
+        if channel is None:
+            channel = await self.client.fetch_channel(channel_id)
+        return channel
+
+    async def _fetch_one(self, channel_id: int, message_id: int) -> List[InternalMessage]:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self.semaphore:
+            try:
+                channel = await self._channel(channel_id)
+                message = await channel.fetch_message(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                self.mark_absent(message_id)
+                return []
+            except discord.HTTPException as e:
+                # Probably transient, so it isn't cached.
+                logger.debug(f"Couldn't fetch message {message_id}: {e}")
+                return []
+        self.fetched += 1
+        messages = [internal_message_from(message)]
+        parent = message.reference.resolved if message.reference else None
+        if isinstance(parent, discord.Message):
+            messages.append(internal_message_from(parent))
+        return messages
+
+    async def fetch(
+        self, channel_id: int, message_ids: Iterable[int]
+    ) -> List[InternalMessage]:
+        """Fetches the messages with message_ids from a channel, concurrently, skipping ids known to be absent. Returns what was found, plus the messages they reply to where Discord included them."""
+        tasks = []
+        for message_id in dict.fromkeys(message_ids):
+            if not message_id or self.is_absent(message_id):
+                continue
+            task = self.inflight.get(message_id)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_one(channel_id, message_id))
+                self.inflight[message_id] = task
+                task.add_done_callback(
+                    lambda _, message_id=message_id: self.inflight.pop(message_id, None)
+                )
+            tasks.append(task)
+        found: List[InternalMessage] = []
+        for messages in await asyncio.gather(*tasks):
+            found += messages
+        return found
@@ -1,78 +1,1286 @@
-from typing import List, Union, Optional, Any
-import discord
+import asyncio
+import atexit
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import ujson as json
 from sqlitedict import SqliteDict
+from personate.memory.backend import MemoryBackend
+from personate.memory.cache import MessageCache
+from personate.memory.retention import RetentionPolicy, SegmentArchive
 from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+DISCORD_EPOCH = 1420070400000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    reply_to INTEGER NOT NULL DEFAULT 0,
+    channel_id INTEGER NOT NULL DEFAULT 0,
+    author_id INTEGER,
+    name TEXT NOT NULL DEFAULT '',
+    internal_content TEXT NOT NULL DEFAULT '',
+    external_content TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_reply_to ON messages (reply_to);
+CREATE INDEX IF NOT EXISTS messages_channel_created ON messages (channel_id, created_at);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (author_id);
+CREATE INDEX IF NOT EXISTS messages_created ON messages (created_at);
+CREATE TABLE IF NOT EXISTS summaries (
+    upto_id INTEGER PRIMARY KEY,
+    summary TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS message_vectors (
+    id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL,
+    scale REAL NOT NULL,
+    vector BLOB NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS message_vectors_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM message_vectors WHERE id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_vectors_update AFTER UPDATE OF internal_content ON messages
+WHEN old.internal_content != new.internal_content BEGIN
+    DELETE FROM message_vectors WHERE id = old.id;
+END;
+CREATE TABLE IF NOT EXISTS profiles (
+    author_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (author_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archived (
+    id INTEGER PRIMARY KEY,
+    segment INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    channel_id INTEGER PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+"""
+
+# A full-text index of messages, kept up to date by triggers. It's an external content table, so the text itself is only stored once, in messages.
+FULL_TEXT_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    name, internal_content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, name, internal_content) VALUES (new.id, new.name, new.internal_content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, name, internal_content) VALUES ('delete', old.id, old.name, old.internal_content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF name, internal_content ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, name, internal_content) VALUES ('delete', old.id, old.name, old.internal_content);
+    INSERT INTO messages_fts (rowid, name, internal_content) VALUES (new.id, new.name, new.internal_content);
+END;
+"""
+
+COLUMNS = "id, reply_to, channel_id, author_id, name, internal_content, external_content, created_at"
+COLUMN_NAMES = [column.strip() for column in COLUMNS.split(",")]
+
+# Walks up the reply_to links from a message. Each step carries the characters of the messages after it (starting from the message itself), so the walk stops as soon as that passes max_characters, or once the chain is window_size long.
+REPLY_CHAIN = f"""
+WITH RECURSIVE chain ({COLUMNS}, depth, characters) AS (
+    SELECT {COLUMNS}, 2, :characters + length(internal_content)
+    FROM messages
+    WHERE id = :reply_to AND :characters <= :max_characters AND :window_size >= 2
+    UNION ALL
+    SELECT m.id, m.reply_to, m.channel_id, m.author_id, m.name, m.internal_content, m.external_content, m.created_at,
+        chain.depth + 1, chain.characters + length(m.internal_content)
+    FROM messages m JOIN chain ON m.id = chain.reply_to
+    WHERE chain.characters <= :max_characters AND chain.depth < :window_size
+)
+SELECT {COLUMNS} FROM chain ORDER BY depth DESC
+"""
+
+# The messages from a message up to (but not including) stop_at, at most :limit of them, oldest first.
+ANCESTORS = f"""
+WITH RECURSIVE chain ({COLUMNS}, depth) AS (
+    SELECT {COLUMNS}, 1 FROM messages WHERE id = :id AND id != :stop_at
+    UNION ALL
+    SELECT m.id, m.reply_to, m.channel_id, m.author_id, m.name, m.internal_content, m.external_content, m.created_at,
+        chain.depth + 1
+    FROM messages m JOIN chain ON m.id = chain.reply_to
+    WHERE m.id != :stop_at AND chain.depth < :limit
+)
+SELECT {COLUMNS} FROM chain ORDER BY depth DESC
+"""
+
+# The closest summary of a message's thread: its own, or failing that the nearest of its ancestors'.
+NEAREST_SUMMARY = """
+WITH RECURSIVE chain (id, reply_to, depth) AS (
+    SELECT id, reply_to, 0 FROM messages WHERE id = :id
+    UNION ALL
+    SELECT m.id, m.reply_to, chain.depth + 1
+    FROM messages m JOIN chain ON m.id = chain.reply_to
+    WHERE chain.depth < :limit
+)
+SELECT s.upto_id, s.summary FROM chain JOIN summaries s ON s.upto_id = chain.id
+ORDER BY chain.depth LIMIT 1
+"""
+
+# Every summary that includes a message: its own and those of every reply below it.
+FORGET_SUMMARIES = """
+WITH RECURSIVE below (id) AS (
+    SELECT :id
+    UNION
+    SELECT m.id FROM messages m JOIN below ON m.reply_to = below.id
+)
+DELETE FROM summaries WHERE upto_id IN below
+"""
+
+# An upsert rather than INSERT OR REPLACE, so that replacing a message fires the update trigger (REPLACE's implicit delete doesn't fire delete triggers).
+UPSERT = f"""
+INSERT INTO messages ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    reply_to = excluded.reply_to, channel_id = excluded.channel_id, author_id = excluded.author_id, name = excluded.name,
+    internal_content = excluded.internal_content, external_content = excluded.external_content, created_at = excluded.created_at
+"""
+
+# Messages long enough to be worth embedding that have no vector from model yet, newest first.
+UNEMBEDDED = """
+SELECT m.id, m.channel_id, m.internal_content FROM messages m LEFT JOIN message_vectors v ON v.id = m.id AND v.model = :model
+WHERE v.id IS NULL AND length(m.internal_content) >= :min_characters
+ORDER BY m.id DESC LIMIT :limit
+"""
+
+# A page of stored vectors in scope, newest first, starting below the id the last page ended at.
+VECTOR_PAGE = """
+SELECT v.id, v.scale, v.vector FROM message_vectors v JOIN messages m ON m.id = v.id
+WHERE v.model = :model AND v.id < :below
+    AND (:channel IS NULL OR m.channel_id = :channel) AND (:author IS NULL OR m.author_id = :author)
+    AND (:after IS NULL OR m.created_at >= :after) AND (:before IS NULL OR m.created_at < :before)
+ORDER BY v.id DESC LIMIT :limit
+"""
+
+# Which messages an export covers: a range of unix times, and a json list of channel ids (or null for every channel).
+IN_RANGE = """
+(:after IS NULL OR created_at >= :after) AND (:before IS NULL OR created_at < :before)
+AND (:channels IS NULL OR channel_id IN (SELECT value FROM json_each(:channels)))
+"""
+
+WORD = re.compile(r"\w+")
+
+Row = Tuple[int, int, int, Optional[int], str, str, str, float]
+
+
+def snowflake_time(snowflake: int) -> float:
+    """The unix time (in seconds) a Discord id was created at."""
+    try:
+        return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+    except (TypeError, ValueError):
+        return 0.0
+
 
+def message_to_row(message_id: int, message: InternalMessage) -> Row:
+    return (
+        int(message_id),
+        int(getattr(message, "reply_to", 0) or 0),
+        int(getattr(message, "channel_id", 0) or 0),
+        getattr(message, "author_id", None),
+        getattr(message, "name", "") or "",
+        getattr(message, "internal_content", "") or "",
+        getattr(message, "external_content", "") or "",
+        snowflake_time(message_id),
+    )
 
-class Memory:
+
+def message_from_row(row: Row) -> InternalMessage:
+    message = InternalMessage()
+    (
+        message.id,
+        message.reply_to,
+        message.channel_id,
+        author_id,
+        message.name,
+        message.internal_content,
+        message.external_content,
+        _,
+    ) = row
+    if author_id is not None:
+        message.author_id = author_id
+    return message
+
+
+class Memory(MemoryBackend):
     """
-    This class manages access to an internal database, and is usually responsible for retrieving conversation history. But you can also use it to store other events that might be relevant to your Agent / Swarm."""
+    This class manages access to an internal database, and is usually responsible for retrieving conversation history. But you can also use it to store other events that might be relevant to your Agent / Swarm.
+
+    Messages live in an indexed "messages" table, one column per field, so looking one up is a primary key read rather than unpickling a whole object. Only the fields personate reads back are kept – embeds and files aren't (a Personate bot's reply footer is already folded into reply_to). What users tell the agent about themselves (e.g pronouns) goes in a profiles table, one row per user and key. Anything else still goes in db, a SqliteDict in the same file.
+
+    Databases written by older versions, which pickled every InternalMessage into the SqliteDict, are migrated into the messages table the first time they're opened.
+    """
+
+    migration_batch_size = 500
+    # Cold messages moved out per query-thread job when compacting, and so per archive segment.
+    compaction_batch_size = 1000
+    profile_cache_size = 4096
 
     @classmethod
-    def from_db(cls, db_path: str) -> "Memory":
+    def from_db(
+        cls,
+        db_path: str,
+        flush_interval: Optional[float] = None,
+        flush_size: int = 256,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> "Memory":
         """
         Initialise a Memory object from an existing database, or create a new one.
         """
-        db = SqliteDict(db_path, autocommit=True)
-        return cls(db=db)
+        db = SqliteDict(db_path, autocommit=True, journal_mode="WAL")
+        return cls(
+            db=db,
+            flush_interval=flush_interval,
+            flush_size=flush_size,
+            retention=retention,
+        )
 
-    def __init__(self, db: Optional[SqliteDict] = None):
+    def __init__(
+        self,
+        db: Optional[SqliteDict] = None,
+        cache: Optional[MessageCache] = None,
+        flush_interval: Optional[float] = None,
+        flush_size: int = 256,
+        retention: Optional[RetentionPolicy] = None,
+    ):
+        """
+        With a flush_interval (in seconds), inserts are written behind: they go into the cache straight away, and are committed to disk together every flush_interval seconds, or as soon as flush_size of them are waiting. Anything still waiting is flushed by close() and when the process exits. Without one, every insert is committed as it happens.
+
+        With a retention policy, cold messages are compacted out of the database in the background every retention.interval seconds, into the archive next to it (<db>-archive/). Their space is reused by new messages, and given back to the file system once enable_incremental_vacuum has been run on the database.
+        """
         if db is None:
-            db = SqliteDict("messages.sqlite", autocommit=True)
+            db = SqliteDict("messages.sqlite", autocommit=True, journal_mode="WAL")
         self.db: SqliteDict = db
+        self.cache = cache or MessageCache()
+        # lock guards the connection, state_lock the cache and the pending writes. The event loop only ever takes state_lock, so it never waits on a slow query.
+        self.lock = threading.RLock()
+        self.state_lock = threading.RLock()
+        # Every query runs on this one thread, so disk I/O never blocks the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self.conn = sqlite3.connect(
+            db.filename, check_same_thread=False, isolation_level=None
+        )
+        # WAL lets readers carry on while a batch commits, and with synchronous=NORMAL a commit doesn't wait for an fsync.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.full_text = self._create_full_text_index()
+        self.migrate()
+        self.migrate_pronouns()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.write_behind = bool(flush_interval)
+        self.pending: Dict[int, Row] = {}
+        # Rows taken from pending by a flush that hasn't committed yet, so reads can still find them.
+        self.flushing: Dict[int, Row] = {}
+        # The newest message id already read from each channel's history.
+        self.watermarks: Dict[int, int] = {}
+        # Recently read user profiles, by author id.
+        self.profiles: "OrderedDict[int, Dict[str, str]]" = OrderedDict()
+        # Called with the ids of newly stored messages, e.g to embed them in the background.
+        self.listeners: List[Callable[[List[int]], None]] = []
+        # The loop listeners are called on, as seen by the last query.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.closed = threading.Event()
+        if self.write_behind:
+            threading.Thread(
+                target=self._flush_periodically, name="memory flusher", daemon=True
+            ).start()
+            atexit.register(self.flush)
+        self.archive = SegmentArchive(os.path.splitext(db.filename)[0] + "-archive")
+        self.retention = retention
+        self.compacting = threading.Lock()
+        if retention:
+            threading.Thread(
+                target=self._compact_periodically, name="memory compactor", daemon=True
+            ).start()
+
+    def _create_full_text_index(self) -> bool:
+        """Creates the full-text index if it doesn't exist yet, indexing the messages already stored. Returns False if this SQLite was built without FTS5."""
+        with self.lock:
+            existed = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone()
+            try:
+                self.conn.executescript(FULL_TEXT_SCHEMA)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Full-text search is unavailable, falling back to LIKE: {e}")
+                return False
+            if not existed:
+                self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+
+    def migrate(self) -> int:
+        """
+        Moves pickled InternalMessages out of the SqliteDict and into the messages table, a batch at a time so the whole table never has to be in memory. Returns how many were moved.
+        """
+        table = self.db.tablename
+        moved = 0
+        last_rowid = 0
+        with self.lock:
+            while True:
+                batch = self.conn.execute(
+                    f'SELECT rowid, key, value FROM "{table}" WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, self.migration_batch_size),
+                ).fetchall()
+                if not batch:
+                    break
+                last_rowid = batch[-1][0]
+                rows: List[Row] = []
+                keys = []
+                for _, key, value in batch:
+                    try:
+                        message = self.db.decode(value)
+                    except Exception:
+                        continue
+                    if not isinstance(message, InternalMessage):
+                        continue
+                    try:
+                        rows.append(message_to_row(int(key), message))
+                    except (TypeError, ValueError):
+                        continue
+                    keys.append((key,))
+                if not rows:
+                    continue
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    f"INSERT OR IGNORE INTO messages ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self.conn.executemany(f'DELETE FROM "{table}" WHERE key = ?', keys)
+                self.conn.execute("COMMIT")
+                moved += len(rows)
+        if moved:
+            logger.info(f"Migrated {moved} messages from {self.db.filename}")
+        return moved
+
+    def migrate_pronouns(self) -> int:
+        """Moves the "pronouns" dict older versions kept in db into the profiles table, one row per user. Returns how many were moved."""
+        pronouns = self.db.get("pronouns", None)
+        if not isinstance(pronouns, dict):
+            return 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO profiles (author_id, key, value) VALUES (?, 'pronouns', ?)",
+                [(int(author_id), str(p)) for author_id, p in pronouns.items()],
+            )
+            self.conn.execute("COMMIT")
+        del self.db["pronouns"]
+        logger.info(f"Migrated pronouns of {len(pronouns)} users from {self.db.filename}")
+        return len(pronouns)
+
+    async def _in_thread(self, func: Callable[..., Any], *args: Any) -> Any:
+        self.loop = asyncio.get_running_loop()
+        return await self.loop.run_in_executor(self.executor, func, *args)
 
-    def insert_message(self, message_id: int, message: InternalMessage):
-        files = message.files
-        del message.files
-        self.db[message_id] = message
-        message.files = files
+    def _flush_periodically(self) -> None:
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.executor.submit(self.flush)
+            except RuntimeError:
+                # The executor has been shut down by close().
+                return
 
-    async def retrieve_reply_chain(
+    def _write(self, rows: List[Row]) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(UPSERT, rows)
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def flush(self) -> int:
+        """Commits every insert that is waiting to be written, in one transaction. Returns how many there were."""
+        with self.lock:
+            with self.state_lock:
+                if not self.pending or self.closed.is_set():
+                    return 0
+                self.flushing, self.pending = self.pending, {}
+            try:
+                self._write(list(self.flushing.values()))
+            except sqlite3.Error as e:
+                logger.warning(f"Couldn't flush messages to {self.db.filename}: {e}")
+                with self.state_lock:
+                    self.pending = {**self.flushing, **self.pending}
+                return 0
+            finally:
+                with self.state_lock:
+                    flushed, self.flushing = self.flushing, {}
+            self._notify_written(list(flushed))
+            return len(flushed)
+
+    def _notify_written(self, message_ids: List[int]) -> None:
+        """Tells listeners, on the event loop, about written-behind messages that have just been committed, so readers that only see what's on disk (like recall's unembedded) can pick them up."""
+        if not self.listeners or self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._notify, message_ids)
+        except RuntimeError:
+            # The loop has been closed, e.g by the final flush at exit.
+            pass
+
+    def _unwritten(self, message_id: int) -> Optional[Row]:
+        return self.pending.get(message_id) or self.flushing.get(message_id)
+
+    def _unwritten_walk(
+        self, message_id: int, limit: int, stop_at: int = 0
+    ) -> Tuple[List[Row], int]:
+        """
+        Follows reply_to links from message_id through messages still waiting to be written, for at most limit of them and not past stop_at. Returns them, newest first, and the id the walk stopped at, for a query to carry on from.
+
+        Readers walk these first and then query from where they stopped, rather than flushing before every query. The query can only miss something if a stored message replies to one that is still waiting (e.g a parent fetched after its reply), so walks that stop at one flush and start again.
+        """
+        rows: List[Row] = []
+        with self.state_lock:
+            while message_id and message_id != stop_at and len(rows) < limit:
+                row = self._unwritten(message_id)
+                if row is None:
+                    break
+                rows.append(row)
+                message_id = row[1]
+        return rows, message_id
+
+    def _unwritten_matches(
         self,
-        message: Union[discord.Message, InternalMessage],
-        window_size: int = 15,
-        max_characters: int = 800,
-    ) -> List[InternalMessage]:
-        past_messages: List[InternalMessage] = []
-        if isinstance(message, discord.Message):
-            msg = InternalMessage.from_discord_message(message)
+        words: List[str],
+        channel: Optional[int],
+        author: Optional[int],
+        match_all: bool,
+    ) -> bool:
+        """Whether any message still waiting to be written would be found by a search for words."""
+        with self.state_lock:
+            rows = [*self.flushing.values(), *self.pending.values()]
+        words = [word.lower() for word in words]
+        for row in rows:
+            if (channel is not None and row[2] != channel) or (
+                author is not None and row[3] != author
+            ):
+                continue
+            text = f"{row[4]} {row[5]}".lower()
+            found = [word in text for word in words]
+            if all(found) if match_all else any(found):
+                return True
+        return False
+
+    def _select(self, message_ids: List[int]) -> List[Row]:
+        rows: List[Row] = []
+        with self.lock:
+            # Stay under SQLite's limit on the number of parameters in a query.
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i : i + 500]
+                rows += self.conn.execute(
+                    f"SELECT {COLUMNS} FROM messages WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+        return rows
+
+    def _stored_ids(self, message_ids: List[int]) -> set:
+        return {row[0] for row in self._select(message_ids)}
+
+    def _insert_missing(self, rows: List[Row]) -> List[Row]:
+        with self.lock:
+            existing = self._stored_ids([row[0] for row in rows])
+            new_rows = [row for row in rows if row[0] not in existing]
+            if new_rows:
+                self._write(new_rows)
+            return new_rows
+
+    def _chain(self, parameters: Dict[str, Any]) -> List[Row]:
+        reply_to, characters = parameters["reply_to"], parameters["characters"]
+        max_characters, window_size = parameters["max_characters"], parameters["window_size"]
+        unwritten, next_id = self._unwritten_walk(reply_to, window_size - 1)
+        newest: List[Row] = []
+        for row in unwritten:
+            if characters > max_characters:
+                return newest[::-1]
+            newest.append(row)
+            characters += len(row[5])
+        if not next_id or len(newest) >= window_size - 1:
+            return newest[::-1]
+        with self.lock:
+            rows = self.conn.execute(
+                REPLY_CHAIN,
+                {
+                    "reply_to": next_id,
+                    "characters": characters,
+                    "max_characters": max_characters,
+                    "window_size": window_size - len(newest),
+                },
+            ).fetchall()
+        characters += sum(len(row[5]) for row in rows)
+        stopped_at = rows[0][1] if rows else next_id
+        cut_short = len(rows) < window_size - len(newest) - 1 and characters <= max_characters
+        if cut_short and self._unwritten(stopped_at):
+            self.flush()
+            with self.lock:
+                return self.conn.execute(REPLY_CHAIN, parameters).fetchall()
+        return rows + newest[::-1]
+
+    async def insert_message(self, message_id: int, message: InternalMessage):
+        row = message_to_row(message_id, message)
+        with self.state_lock:
+            previous = self.cache.messages.get(row[0])
+            edited = previous is not None and previous.internal_content != row[5]
+            # The cache keeps its own copy, as stored, so later changes to message don't leak into it.
+            self.cache.put(row[0], message_from_row(row))
+            written_behind = False
+            if self.write_behind:
+                self.pending[row[0]] = row
+                written_behind = len(self.pending) < self.flush_size and not edited
+        if written_behind:
+            # Listeners are told now, and again once it has been written (see flush), for readers like recall's unembedded that only see what's on disk.
+            self._notify([row[0]])
+            return
+        if self.write_behind:
+            await self._in_thread(self.flush)
         else:
-            msg = message
-        last_id = msg.id
-        for _ in range(window_size):
-            past_messages.append(msg)
-            # try:
-            # if isinstance(msg, discord.Message) and msg.reference and msg.reference.resolved:
-            # last_id = msg.reference.resolved.id
-            # except AttributeError:
-            if hasattr(msg, "reply_to") and isinstance(msg, InternalMessage):
-                last_id = msg.reply_to
-            else:
-                break
-            msg = self.db.get(last_id, None)
-            if not msg:
-                break
-            if sum([len(m.internal_content) for m in past_messages]) > max_characters:
+            await self._in_thread(self._write, [row])
+        if edited:
+            await self._in_thread(self._forget_summaries, row[0])
+        self._notify([row[0]])
+
+    async def insert_missing(self, messages: Iterable[InternalMessage]) -> int:
+        """Stores the messages Memory doesn't have yet, in one transaction (or, when writing behind, along with the other waiting inserts), leaving the ones it has untouched. Returns how many were new."""
+        rows: Dict[int, Row] = {}
+        with self.state_lock:
+            for message in messages:
+                if message.id in self.cache or self._unwritten(message.id):
+                    continue
+                rows[message.id] = message_to_row(message.id, message)
+        if not rows:
+            return 0
+        if not self.write_behind:
+            new_rows = await self._in_thread(self._insert_missing, list(rows.values()))
+        else:
+            existing = await self._in_thread(self._stored_ids, list(rows))
+            with self.state_lock:
+                new_rows = [
+                    row
+                    for row in rows.values()
+                    if row[0] not in existing and not self._unwritten(row[0])
+                ]
+                self.pending.update((row[0], row) for row in new_rows)
+                full = len(self.pending) >= self.flush_size
+            if full:
+                await self._in_thread(self.flush)
+        with self.state_lock:
+            for row in new_rows:
+                self.cache.put(row[0], message_from_row(row))
+        if new_rows:
+            self._notify([row[0] for row in new_rows])
+        return len(new_rows)
+
+    def add_listener(self, listener: Callable[[List[int]], None]) -> None:
+        """Calls listener, on the event loop, with the ids of the messages each insert stores. It shouldn't block."""
+        self.listeners.append(listener)
+
+    def _notify(self, message_ids: List[int]) -> None:
+        for listener in self.listeners:
+            listener(message_ids)
+
+    def _unembedded(
+        self, model: str, limit: int, min_characters: int
+    ) -> List[Tuple[int, int, str]]:
+        # Messages still waiting to be written are left for later: listeners are told again once they're committed.
+        with self.lock:
+            return self.conn.execute(
+                UNEMBEDDED,
+                {"model": model, "limit": limit, "min_characters": min_characters},
+            ).fetchall()
+
+    def _write_vectors(self, model: str, vectors: List[Tuple[int, float, bytes]]) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO message_vectors (id, model, scale, vector) VALUES (?, ?, ?, ?)",
+                    [(i, model, scale, vector) for i, scale, vector in vectors],
+                )
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _vector_page(
+        self,
+        model: str,
+        consumer: Callable[[List[Tuple[int, float, bytes]]], None],
+        scope: Dict[str, Any],
+        below: int,
+        limit: int,
+    ) -> Tuple[int, int]:
+        with self.lock:
+            page = self.conn.execute(
+                VECTOR_PAGE, {"model": model, "below": below, "limit": limit, **scope}
+            ).fetchall()
+        if page:
+            consumer(page)
+        return len(page), page[-1][0] if page else below
+
+    async def unembedded(
+        self, model: str, limit: int = 64, min_characters: int = 1
+    ) -> List[Tuple[int, int, str]]:
+        """Returns (id, channel_id, internal_content) for up to limit of the newest messages with at least min_characters that have no vector from model."""
+        return await self._in_thread(self._unembedded, model, limit, min_characters)
+
+    async def store_vectors(
+        self,
+        model: str,
+        vectors: List[Tuple[int, float, bytes]],
+        channel_id: Optional[int] = None,
+    ) -> None:
+        """Stores (message id, scale, int8 vector bytes) for each message, as embedded by model. A message's vector is dropped when the message is changed or compacted out."""
+        await self._in_thread(self._write_vectors, model, vectors)
+
+    async def scan_vectors(
+        self,
+        model: str,
+        consumer: Callable[[List[Tuple[int, float, bytes]]], None],
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        page_size: int = 4096,
+        max_rows: Optional[int] = None,
+    ) -> int:
+        """
+        Reads the stored vectors from model of messages in scope (a channel, an author, and unix times after and before), newest first, and passes them to consumer a page of (id, scale, vector bytes) at a time, on Memory's thread – so however many there are, only one page is in memory at once, and other queries aren't held up for more than a page. Stops after max_rows. Returns how many were read.
+        """
+        scope = {"channel": channel, "author": author, "after": after, "before": before}
+        # No need to flush: messages still waiting to be written haven't been embedded yet.
+        scanned = 0
+        below = 2**63 - 1
+        while max_rows is None or scanned < max_rows:
+            limit = page_size if max_rows is None else min(page_size, max_rows - scanned)
+            # Each page is a job of its own on Memory's thread, so reads and inserts queued meanwhile run in between pages.
+            read, below = await self._in_thread(
+                self._vector_page, model, consumer, scope, below, limit
+            )
+            if not read:
                 break
-        past_messages.reverse()
-        return past_messages
+            scanned += read
+        return scanned
+
+    def _ancestors(self, message_id: int, stop_at: int, limit: int) -> List[Row]:
+        unwritten, next_id = self._unwritten_walk(message_id, limit, stop_at)
+        if not next_id or next_id == stop_at or len(unwritten) >= limit:
+            return unwritten[::-1]
+        with self.lock:
+            rows = self.conn.execute(
+                ANCESTORS,
+                {"id": next_id, "stop_at": stop_at, "limit": limit - len(unwritten)},
+            ).fetchall()
+        stopped_at = rows[0][1] if rows else next_id
+        cut_short = len(rows) < limit - len(unwritten) and stopped_at != stop_at
+        if cut_short and self._unwritten(stopped_at):
+            self.flush()
+            with self.lock:
+                return self.conn.execute(
+                    ANCESTORS, {"id": message_id, "stop_at": stop_at, "limit": limit}
+                ).fetchall()
+        return rows + unwritten[::-1]
 
-    async def retrieve_all_messages(
+    def _nearest_summary(self, message_id: int, limit: int) -> Optional[Tuple[int, str]]:
+        unwritten, next_id = self._unwritten_walk(message_id, limit + 1)
+        with self.lock:
+            if unwritten:
+                ids = [row[0] for row in unwritten]
+                summaries = dict(
+                    self.conn.execute(
+                        f"SELECT upto_id, summary FROM summaries WHERE upto_id IN ({', '.join('?' * len(ids))})",
+                        ids,
+                    ).fetchall()
+                )
+                for upto_id in ids:
+                    if upto_id in summaries:
+                        return upto_id, summaries[upto_id]
+            if not next_id or len(unwritten) > limit:
+                return None
+            found = self.conn.execute(
+                NEAREST_SUMMARY, {"id": next_id, "limit": limit - len(unwritten)}
+            ).fetchone()
+        if found is None:
+            # The thread might carry on through a message that is still waiting to be written.
+            with self.lock:
+                rows = self.conn.execute(
+                    ANCESTORS,
+                    {"id": next_id, "stop_at": 0, "limit": limit + 1 - len(unwritten)},
+                ).fetchall()
+            cut_short = len(rows) < limit + 1 - len(unwritten)
+            if cut_short and rows and self._unwritten(rows[0][1]):
+                self.flush()
+                with self.lock:
+                    return self.conn.execute(
+                        NEAREST_SUMMARY, {"id": message_id, "limit": limit}
+                    ).fetchone()
+        return found
+
+    def _write_summary(self, message_id: int, summary: str) -> None:
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries (upto_id, summary, created_at) VALUES (?, ?, ?)",
+                (message_id, summary, time.time()),
+            )
+
+    def _forget_summaries(self, message_id: int) -> None:
+        self.flush()
+        with self.lock:
+            self.conn.execute(FORGET_SUMMARIES, {"id": message_id})
+
+    async def ancestors(
         self,
-        msg: discord.Message,
-        window_size: int = 15,
-        max_characters: int = 800,
+        message_id: int,
+        stop_at: int = 0,
+        limit: int = 50,
+        channel_id: Optional[int] = None,
     ) -> List[InternalMessage]:
-        """This function uses pycord's api"""
-        history = await msg.channel.history().flatten()
-        history.reverse()
-        past_messages: List[discord.Message] = []
-        for message in history[:window_size]:
-            past_messages.append(message)
-            if sum([len(m.content) for m in past_messages]) > max_characters:
-                break
-        past_messages.reverse()
-        converted_past_messages: List[InternalMessage] = [
-            InternalMessage.from_discord_message(m) for m in past_messages
+        """Returns the message with message_id and the messages it replies to, up to (but not including) stop_at and at most limit of them, oldest first."""
+        rows = await self._in_thread(self._ancestors, message_id, stop_at, limit)
+        return [message_from_row(row) for row in rows]
+
+    async def get_summary(
+        self, message_id: int, max_hops: int = 100, channel_id: Optional[int] = None
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Returns (upto_id, summary) for the closest summary of the thread ending at message_id: the thread's own summary if it has one (upto_id == message_id), or else that of the nearest of its last max_hops ancestors.
+        """
+        return await self._in_thread(self._nearest_summary, message_id, max_hops)
+
+    async def set_summary(
+        self, message_id: int, summary: str, channel_id: Optional[int] = None
+    ) -> None:
+        """Stores a summary of the thread ending at (and including) message_id. It's forgotten if a message in the thread is changed."""
+        await self._in_thread(self._write_summary, message_id, summary)
+
+    def _search(
+        self,
+        words: List[str],
+        channel: Optional[int],
+        author: Optional[int],
+        limit: int,
+        match_all: bool,
+    ) -> List[Tuple[float, Row]]:
+        if self._unwritten_matches(words, channel, author, match_all):
+            self.flush()
+        filters = "AND (:channel IS NULL OR m.channel_id = :channel) AND (:author IS NULL OR m.author_id = :author)"
+        parameters: Dict[str, Any] = {"channel": channel, "author": author, "limit": limit}
+        with self.lock:
+            if self.full_text:
+                # Each word is quoted, so nothing in a query is read as FTS5 syntax.
+                parameters["query"] = (" AND " if match_all else " OR ").join(
+                    '"' + word + '"' for word in words
+                )
+                return [
+                    (row[0], row[1:])
+                    for row in self.conn.execute(
+                        f"SELECT bm25(messages_fts), {', '.join('m.' + c for c in COLUMN_NAMES)} "
+                        f"FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                        f"WHERE messages_fts MATCH :query {filters} ORDER BY bm25(messages_fts) LIMIT :limit",
+                        parameters,
+                    )
+                ]
+            likes = []
+            for i, word in enumerate(words):
+                parameters[f"word{i}"] = f"%{word}%"
+                likes.append(f"m.internal_content LIKE :word{i}")
+            return [
+                (0.0, row)
+                for row in self.conn.execute(
+                    f"SELECT {', '.join('m.' + c for c in COLUMN_NAMES)} FROM messages m "
+                    f"WHERE ({(' AND ' if match_all else ' OR ').join(likes)}) {filters} "
+                    f"ORDER BY m.created_at DESC LIMIT :limit",
+                    parameters,
+                )
+            ]
+
+    async def search_scored(
+        self,
+        query: str,
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        limit: int = 20,
+        match_all: bool = True,
+    ) -> List[Tuple[float, InternalMessage]]:
+        """Like search_messages, but with each message's BM25 score (lower is a better match)."""
+        words = WORD.findall(query)
+        if not words or limit < 1:
+            return []
+        results = await self._in_thread(
+            self._search, words, channel, author, limit, match_all
+        )
+        return [(score, message_from_row(row)) for score, row in results]
+
+    async def search_messages(
+        self,
+        query: str,
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        limit: int = 20,
+        match_all: bool = True,
+    ) -> List[InternalMessage]:
+        """
+        Returns up to limit stored messages containing the words in query (or any of them, if match_all is False), best matches first. channel and author are ids to narrow the search to.
+        """
+        return [
+            message
+            for _, message in await self.search_scored(
+                query, channel, author, limit, match_all
+            )
         ]
-        return converted_past_messages
+
+    def _read_watermark(self, channel_id: int) -> int:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_id FROM watermarks WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def _write_watermark(self, channel_id: int, message_id: int) -> None:
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO watermarks (channel_id, last_id) VALUES (?, ?) "
+                "ON CONFLICT (channel_id) DO UPDATE SET last_id = max(last_id, excluded.last_id)",
+                (channel_id, message_id),
+            )
+
+    async def get_watermark(self, channel_id: int) -> int:
+        """The newest message id already read from channel_id's history, or 0 if it hasn't been read."""
+        if channel_id not in self.watermarks:
+            self.watermarks[channel_id] = await self._in_thread(
+                self._read_watermark, channel_id
+            )
+        return self.watermarks[channel_id]
+
+    async def advance_watermark(self, channel_id: int, message_id: int) -> None:
+        if message_id <= await self.get_watermark(channel_id):
+            return
+        self.watermarks[channel_id] = message_id
+        await self._in_thread(self._write_watermark, channel_id, message_id)
+
+    async def get_many(
+        self, message_ids: Iterable[int], channel_id: Optional[int] = None
+    ) -> Dict[int, InternalMessage]:
+        """Returns every message in message_ids that Memory has, by id, reading any that aren't cached in a single query. channel_id isn't needed here, but lets a ShardedMemory go straight to the right shard."""
+        found: Dict[int, InternalMessage] = {}
+        missing: List[int] = []
+        with self.state_lock:
+            for message_id in dict.fromkeys(message_ids):
+                message = self.cache.get(message_id)
+                row = None if message is not None else self._unwritten(message_id)
+                if row is not None:
+                    message = message_from_row(row)
+                    self.cache.put(message_id, message)
+                if message is not None:
+                    found[message_id] = message
+                else:
+                    missing.append(message_id)
+        if missing:
+            rows = await self._in_thread(self._select, missing)
+            with self.state_lock:
+                for row in rows:
+                    message = message_from_row(row)
+                    self.cache.put(message.id, message)
+                    found[message.id] = message
+        return found
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        """Reads something other than a message or a profile from db, off the event loop."""
+        return await self._in_thread(self.db.get, key, default)
+
+    async def set_value(self, key: str, value: Any) -> None:
+        await self._in_thread(self.db.__setitem__, key, value)
+
+    def _read_profile(self, author_id: int) -> Dict[str, str]:
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    "SELECT key, value FROM profiles WHERE author_id = ?", (author_id,)
+                ).fetchall()
+            )
+
+    def _write_profile_value(self, author_id: int, key: str, value: Optional[str]) -> None:
+        with self.lock:
+            if value is None:
+                self.conn.execute(
+                    "DELETE FROM profiles WHERE author_id = ? AND key = ?",
+                    (author_id, key),
+                )
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO profiles (author_id, key, value) VALUES (?, ?, ?)",
+                    (author_id, key, value),
+                )
+
+    async def get_profile(self, author_id: int) -> Dict[str, str]:
+        """
+        Returns what's known about a user (e.g {"pronouns": "they/them", "language": "fr"}), or {} if nothing is. Recently read profiles are answered from a cache, so it's cheap enough to call every turn. Don't change the dict returned; use set_profile_value.
+        """
+        with self.state_lock:
+            profile = self.profiles.get(author_id)
+            if profile is not None:
+                self.profiles.move_to_end(author_id)
+                return profile
+        profile = await self._in_thread(self._read_profile, author_id)
+        with self.state_lock:
+            self.profiles[author_id] = profile
+            while len(self.profiles) > self.profile_cache_size:
+                self.profiles.popitem(last=False)
+        return profile
+
+    async def set_profile_value(
+        self, author_id: int, key: str, value: Optional[str]
+    ) -> None:
+        """Sets one thing about a user, e.g set_profile_value(id, "pronouns", "she/her"), writing only that row. A value of None removes it."""
+        await self._in_thread(self._write_profile_value, author_id, key, value)
+        with self.state_lock:
+            self.profiles.pop(author_id, None)
+
+    async def past_messages(
+        self,
+        reply_to: int,
+        window_size: int,
+        characters: int,
+        max_characters: int,
+        channel_id: Optional[int] = None,
+    ) -> List[InternalMessage]:
+        """The whole walk up the reply_to links is one recursive query, with the window and the character budget enforced in SQLite – unless the chain is already in the cache."""
+        # What's above a message only depends on where it starts, the window and the characters the message leaves in the budget.
+        key = (reply_to, window_size, max_characters - characters)
+        with self.state_lock:
+            past_messages = self.cache.get_chain(key)
+        if past_messages is None:
+            rows = await self._in_thread(
+                self._chain,
+                {
+                    "reply_to": reply_to,
+                    "characters": characters,
+                    "max_characters": max_characters,
+                    "window_size": window_size,
+                },
+            )
+            past_messages = [message_from_row(row) for row in rows]
+            stopped_at = past_messages[0].reply_to if past_messages else reply_to
+            with self.state_lock:
+                self.cache.put_chain(key, past_messages, stopped_at)
+        return past_messages
+
+    def _is_archived(self, message_id: int) -> bool:
+        with self.lock:
+            return (
+                self.conn.execute(
+                    "SELECT 1 FROM archived WHERE id = ?", (message_id,)
+                ).fetchone()
+                is not None
+            )
+
+    async def is_stored(self, message_id: int, channel_id: Optional[int] = None) -> bool:
+        # An archived message was stored once; fetching it again would undo the retention policy.
+        return await self.has_message(message_id) or await self._in_thread(
+            self._is_archived, message_id
+        )
+
+    def _cold_rows(self, policy: RetentionPolicy, limit: int) -> List[Row]:
+        """Returns up to limit of the oldest messages that policy says shouldn't be in the database any more."""
+        now = time.time()
+        for channel_id, max_age in policy.channel_max_age.items():
+            rows = self.conn.execute(
+                f"SELECT {COLUMNS} FROM messages WHERE channel_id = ? AND created_at < ? ORDER BY created_at LIMIT ?",
+                (channel_id, now - max_age, limit),
+            ).fetchall()
+            if rows:
+                return rows
+        if policy.max_age is not None:
+            excluded = list(policy.channel_max_age)
+            rows = self.conn.execute(
+                f"SELECT {COLUMNS} FROM messages WHERE created_at < ? AND channel_id NOT IN ({', '.join('?' * len(excluded))}) ORDER BY created_at LIMIT ?",
+                (now - policy.max_age, *excluded, limit),
+            ).fetchall()
+            if rows:
+                return rows
+        if policy.max_rows is not None:
+            excess = (
+                self.conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+                - policy.max_rows
+            )
+            if excess > 0:
+                return self.conn.execute(
+                    f"SELECT {COLUMNS} FROM messages ORDER BY created_at LIMIT ?",
+                    (min(excess, limit),),
+                ).fetchall()
+        return []
+
+    def _cold_batch(self, policy: RetentionPolicy) -> Tuple[List[Row], int]:
+        """Returns the next batch of cold rows, and the archive segment they'd go in. Messages still waiting to be written are left for the next compaction."""
+        with self.lock:
+            rows = self._cold_rows(policy, self.compaction_batch_size)
+            segment = (
+                self.conn.execute("SELECT coalesce(max(segment), 0) FROM archived").fetchone()[0]
+                + 1
+            )
+            return rows, segment
+
+    def _remove_cold(self, rows: List[Row], segment: Optional[int]) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if segment is not None:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO archived (id, segment) VALUES (?, ?)",
+                        [(row[0], segment) for row in rows],
+                    )
+                self.conn.executemany(
+                    "DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows]
+                )
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        with self.state_lock:
+            self.cache.forget(row[0] for row in rows)
+
+    def _compact(self, policy: RetentionPolicy) -> int:
+        """
+        Moves cold messages out a batch at a time, then gives back the pages they used. Runs on the calling thread: only the short select and delete of each batch go through the query thread, so reads and inserts get it in between, and the archive is written and the file vacuumed without holding it.
+        """
+        compacted = 0
+        with self.compacting:
+            while not self.closed.is_set():
+                rows, segment = self.executor.submit(self._cold_batch, policy).result()
+                if not rows:
+                    break
+                if policy.archive:
+                    self.archive.write(
+                        segment, (dict(zip(COLUMN_NAMES, row)) for row in rows)
+                    )
+                self.executor.submit(
+                    self._remove_cold, rows, segment if policy.archive else None
+                ).result()
+                compacted += len(rows)
+            if compacted:
+                self._vacuum()
+        return compacted
+
+    def _vacuum(self, pages: int = 1024) -> None:
+        """Gives free pages back to the file system a few at a time, on a connection of its own, so each write lock it takes is short. Only databases with incremental auto-vacuum (see enable_incremental_vacuum) can do this; others reuse their free pages instead."""
+        conn = sqlite3.connect(self.db.filename, timeout=30, isolation_level=None)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return
+            while not self.closed.is_set():
+                if not conn.execute("PRAGMA freelist_count").fetchone()[0]:
+                    break
+                conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        finally:
+            conn.close()
+
+    def _enable_incremental_vacuum(self) -> None:
+        conn = sqlite3.connect(self.db.filename, timeout=60, isolation_level=None)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+    async def enable_incremental_vacuum(self) -> None:
+        """
+        Switches the database to incremental auto-vacuum, so compaction can give the space it frees back to the file system. This rewrites the whole file with a full VACUUM, during which writes wait, so it's a one-off step to take while the agent is quiet rather than something compaction does by itself.
+        """
+        await asyncio.to_thread(self._enable_incremental_vacuum)
+
+    def _compact_periodically(self) -> None:
+        while not self.closed.wait(self.retention.interval):  # type: ignore
+            try:
+                compacted = self._compact(self.retention)  # type: ignore
+                if compacted:
+                    logger.info(f"Compacted {compacted} messages out of {self.db.filename}")
+            except RuntimeError:
+                # The executor has been shut down by close().
+                return
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Couldn't compact {self.db.filename}: {e}")
+
+    async def compact(self, policy: Optional[RetentionPolicy] = None) -> int:
+        """Moves every message that policy (or the Memory's retention policy) says is cold out of the database, then gives the space back. Returns how many messages were moved."""
+        policy = policy or self.retention
+        if policy is None:
+            return 0
+        return await asyncio.to_thread(self._compact, policy)
+
+    def _thread_rows(self, message_id: int, window_size: int) -> List[Row]:
+        rows: List[Row] = []
+        next_id = message_id
+        with self.lock:
+            while next_id and len(rows) < window_size:
+                with self.state_lock:
+                    unwritten = self._unwritten(next_id)
+                found = [unwritten] if unwritten else self._select([next_id])
+                if not found:
+                    archived = self.conn.execute(
+                        "SELECT segment FROM archived WHERE id = ?", (next_id,)
+                    ).fetchone()
+                    record = archived and self.archive.get(archived[0], next_id)
+                    if not record:
+                        break
+                    found = [tuple(record[c] for c in COLUMN_NAMES)]  # type: ignore
+                rows.append(found[0])
+                next_id = found[0][1]
+        rows.reverse()
+        return rows
+
+    async def retrieve_archived_thread(
+        self, message_id: int, window_size: int = 15, channel_id: Optional[int] = None
+    ) -> List[InternalMessage]:
+        """Returns the message with message_id and up to window_size - 1 of the messages it replies to, oldest first, reading them back from the archive where they've been compacted out of the database."""
+        rows = await self._in_thread(self._thread_rows, message_id, window_size)
+        return [message_from_row(row) for row in rows]
+
+    def _count_range(self, scope: Dict[str, Any]) -> int:
+        self.flush()
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT count(*) FROM messages WHERE {IN_RANGE}", scope
+            ).fetchone()[0]
+
+    def _page_range(self, scope: Dict[str, Any], above: int, limit: int) -> List[Row]:
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT {COLUMNS} FROM messages WHERE id > :above AND {IN_RANGE} ORDER BY id LIMIT :limit",
+                {**scope, "above": above, "limit": limit},
+            ).fetchall()
+
+    def _page_profiles(
+        self, above: Tuple[int, str], limit: int
+    ) -> List[Tuple[int, str, str]]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT author_id, key, value FROM profiles WHERE (author_id, key) > (?, ?) ORDER BY author_id, key LIMIT ?",
+                (*above, limit),
+            ).fetchall()
+
+    def _write_profiles(self, rows: List[Tuple[int, str, str]]) -> None:
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO profiles (author_id, key, value) VALUES (?, ?, ?)",
+                    rows,
+                )
+            except sqlite3.Error:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    @staticmethod
+    def _range(
+        after: Optional[float], before: Optional[float], channels: Optional[Iterable[int]]
+    ) -> Dict[str, Any]:
+        return {
+            "after": after,
+            "before": before,
+            "channels": None if channels is None else json.dumps([int(c) for c in channels]),
+        }
+
+    async def count_messages(
+        self,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        channels: Optional[Iterable[int]] = None,
+    ) -> int:
+        """How many messages were sent between the unix times after and before, in channels (or any channel)."""
+        return await self._in_thread(self._count_range, self._range(after, before, channels))
+
+    async def iter_messages(
+        self,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        channels: Optional[Iterable[int]] = None,
+        page_size: int = 1000,
+    ) -> AsyncIterator[List[InternalMessage]]:
+        """
+        Yields the messages sent between the unix times after and before, in channels (or any channel), a page at a time in id order. Only one page is read at once and nothing is locked in between, so it can walk a database of any size while the bot carries on using it.
+        """
+        scope = self._range(after, before, channels)
+        await self._in_thread(self.flush)
+        above = -1
+        while True:
+            rows = await self._in_thread(self._page_range, scope, above, page_size)
+            if not rows:
+                return
+            above = rows[-1][0]
+            yield [message_from_row(row) for row in rows]
+
+    async def insert_many(self, messages: Iterable[InternalMessage]) -> int:
+        """Stores messages in one transaction, replacing any Memory already has with the same ids. Returns how many there were."""
+        rows = [message_to_row(message.id, message) for message in messages]
+        if not rows:
+            return 0
+        with self.state_lock:
+            for row in rows:
+                # An older version still waiting to be written would overwrite this one.
+                self.pending.pop(row[0], None)
+                if row[0] in self.cache:
+                    self.cache.put(row[0], message_from_row(row))
+            # Chains that stopped at a message that was missing until now have to be walked again.
+            self.cache.invalidate_chains_of(row[0] for row in rows)
+        await self._in_thread(self._write, rows)
+        self._notify([row[0] for row in rows])
+        return len(rows)
+
+    async def iter_profiles(
+        self, page_size: int = 1000
+    ) -> AsyncIterator[List[Tuple[int, str, str]]]:
+        """Yields every (author_id, key, value) in the profiles table, a page at a time."""
+        above: Tuple[int, str] = (-(2**63), "")
+        while True:
+            rows = await self._in_thread(self._page_profiles, above, page_size)
+            if not rows:
+                return
+            above = rows[-1][:2]
+            yield rows
+
+    async def insert_profiles(self, rows: List[Tuple[int, str, str]]) -> None:
+        await self._in_thread(self._write_profiles, rows)
+        with self.state_lock:
+            for author_id, _, _ in rows:
+                self.profiles.pop(author_id, None)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit and miss counts, and the size, of the message and chain cache."""
+        with self.state_lock:
+            return self.cache.stats()
+
+    def close(self) -> None:
+        """Waits for queued queries, writes anything still pending and closes the database."""
+        self.executor.shutdown(wait=True)
+        # Nothing can query the database after this, so listeners aren't told about the last writes.
+        self.loop = None
+        with self.lock:
+            self.flush()
+            self.closed.set()
+            self.conn.close()
+        atexit.unregister(self.flush)
+        self.db.close()
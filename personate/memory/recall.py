@@ -0,0 +1,149 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.index import encode, top_k_indices
+from personate.embeddings.quantization import quantize
+from personate.embeddings.registry import get_ranker
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+class MessageRecall:
+    """
+    Semantic search over everything in a Memory, not just the current reply chain.
+
+    Every stored message is embedded in the background – newly inserted ones as they arrive, and any backlog (e.g a database from before recall was turned on) newest first, a batch at a time. Vectors are kept in Memory's database as int8, a quarter of the size of float32, and dropped when their message is changed or compacted out.
+
+    A search scans the stored vectors a page at a time, keeping only the best so far, so memory use stays flat however many messages there are, and Memory's other queries run between pages. Narrowing it to a channel, an author or a time range is done in SQL, before any vectors are read. With max_rows, only that many of the newest vectors in scope are scored, which bounds the cost of a search however large the database grows, at the price of never recalling anything older; a search the cap cuts short is logged.
+    """
+
+    def __init__(
+        self,
+        memory: Any,
+        ranker: Any = None,
+        batch_size: int = 64,
+        min_characters: int = 12,
+        page_size: int = 4096,
+        max_rows: Optional[int] = None,
+    ) -> None:
+        self.memory = memory
+        self.ranker = ranker or get_ranker()
+        self.batch_size = batch_size
+        self.min_characters = min_characters
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.warned_about_cap = False
+        self.wake: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+        memory.add_listener(self.notify)
+
+    @property
+    def model(self) -> str:
+        return getattr(self.ranker, "model_name", None) or self.ranker.default_model
+
+    def set_ranker(self, ranker: Any) -> None:
+        """Switches to another model. Messages are embedded again with it in the background; until then, they can't be recalled."""
+        self.ranker = ranker
+        self.notify([])
+
+    def notify(self, message_ids: List[int]) -> None:
+        """Wakes the background embedder. Memory calls this whenever messages are inserted."""
+        if self.worker is None or self.worker.done():
+            self.wake = asyncio.Event()
+            self.worker = asyncio.create_task(self._embed_in_background())
+        self.wake.set()  # type: ignore
+
+    async def _embed_in_background(self) -> None:
+        while True:
+            await self.wake.wait()  # type: ignore
+            self.wake.clear()  # type: ignore
+            try:
+                while await self.embed_pending():
+                    pass
+            except Exception as e:
+                logger.warning(f"Couldn't embed messages for recall: {e}")
+
+    async def embed_pending(self) -> int:
+        """Embeds and stores the next batch of messages that have no vector yet. Returns how many there were."""
+        model = self.model
+        batch = await self.memory.unembedded(
+            model, self.batch_size, self.min_characters
+        )
+        if not batch:
+            return 0
+        # Straight to the model rather than through the batcher, and off the event loop, so a backlog doesn't hold up replies.
+        rows, scales = quantize(
+            await encode(self.ranker, [text for _, _, text in batch], in_thread=True),
+            "int8",
+        )
+        by_channel: Dict[int, List[Tuple[int, float, bytes]]] = defaultdict(list)
+        for (message_id, channel_id, _), row, scale in zip(batch, rows, scales):  # type: ignore
+            by_channel[channel_id].append((message_id, float(scale), row.tobytes()))
+        for channel_id, vectors in by_channel.items():
+            await self.memory.store_vectors(model, vectors, channel_id)
+        return len(batch)
+
+    async def search(
+        self,
+        query: str,
+        top_k: int = 5,
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        exclude: Iterable[int] = (),
+        min_score: float = 0.0,
+        context: Optional[EmbeddingContext] = None,
+    ) -> List[Tuple[float, InternalMessage]]:
+        """
+        Returns up to top_k (cosine similarity, message) pairs for the stored messages closest to query, best first. channel and author are ids, after and before unix times; exclude is message ids to leave out (e.g the conversation query came from). With the turn's context, query is embedded in the same batch as the turn's other texts.
+        """
+        self.notify([])
+        exclude = set(exclude)
+        wanted = top_k + len(exclude)
+        query_vector = (await embed_in(context, self.ranker, [query]))[0].astype(
+            np.float32
+        )
+        best_ids = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+
+        def consume(page: List[Tuple[int, float, bytes]]) -> None:
+            nonlocal best_ids, best_scores
+            vectors = np.frombuffer(b"".join(v for _, _, v in page), dtype=np.int8)
+            if vectors.size != len(page) * len(query_vector):
+                # Vectors from a model with a different dimension; they'll be replaced once that model's are.
+                return
+            scores = (
+                vectors.reshape(len(page), -1).astype(np.float32) @ query_vector
+            ) * np.array([scale for _, scale, _ in page], dtype=np.float32)
+            ids = np.concatenate([best_ids, [i for i, _, _ in page]])
+            scores = np.concatenate([best_scores, scores])
+            keep = top_k_indices(scores, wanted)
+            best_ids, best_scores = ids[keep], scores[keep]
+
+        scanned = await self.memory.scan_vectors(
+            self.model,
+            consume,
+            channel=channel,
+            author=author,
+            after=after,
+            before=before,
+            page_size=self.page_size,
+            max_rows=self.max_rows,
+        )
+        if self.max_rows is not None and scanned >= self.max_rows:
+            log = logger.debug if self.warned_about_cap else logger.warning
+            log(
+                f"Recall only searched the newest {self.max_rows} messages in scope; older ones can't be recalled unless max_rows is raised or unset."
+            )
+            self.warned_about_cap = True
+        hits = [
+            (float(score), int(message_id))
+            for message_id, score in zip(best_ids, best_scores)
+            if int(message_id) not in exclude and score >= min_score
+        ][:top_k]
+        messages = await self.memory.get_many([i for _, i in hits], channel)
+        return [(score, messages[i]) for score, i in hits if i in messages]
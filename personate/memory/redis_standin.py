@@ -0,0 +1,207 @@
+"""
+A small in-process server that speaks enough of the Redis protocol for RedisMemory, so it can be tried and tested without a Redis server.
+
+Example:
+    server = RedisStandIn()
+    await server.start()
+    memory = RedisMemory.from_url(server.url)
+    ...
+    await server.close()
+
+Or from a shell: python -m personate.memory.redis_standin --port 6379
+"""
+import argparse
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+Reply = Any
+
+
+class Error(str):
+    """An error reply."""
+
+
+def encode_reply(reply: Reply) -> bytes:
+    if isinstance(reply, Error):
+        return b"-%s\r\n" % reply.encode("utf-8")
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        return b":%d\r\n" % int(reply)
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode("utf-8")
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode_reply(r) for r in reply)
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # An inline command, as typed into telnet.
+        return line.split()
+    arguments = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readline())[1:-2])
+        arguments.append((await reader.readexactly(length + 2))[:-2])
+    return arguments
+
+
+class RedisStandIn:
+    """
+    Keeps strings and hashes in dicts, one pair per database number, and answers the commands RedisMemory sends: PING, AUTH, SELECT, GET, SET (with NX), MGET, DEL, HGET, HSET, HDEL, HGETALL and FLUSHDB. Nothing is persisted.
+    """
+
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 0, password: Optional[str] = None
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.password = password
+        self.strings: Dict[int, Dict[bytes, bytes]] = {}
+        self.hashes: Dict[int, Dict[bytes, Dict[bytes, bytes]]] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[asyncio.StreamReader, asyncio.Task] = {}
+        self.commands: Dict[bytes, Callable[..., Reply]] = {
+            b"GET": self.get,
+            b"SET": self.set,
+            b"MGET": self.mget,
+            b"DEL": self.delete,
+            b"HGET": self.hget,
+            b"HSET": self.hset,
+            b"HDEL": self.hdel,
+            b"HGETALL": self.hgetall,
+            b"FLUSHDB": self.flushdb,
+        }
+
+    @property
+    def url(self) -> str:
+        password = f":{self.password}@" if self.password else ""
+        return f"redis://{password}{self.host}:{self.port}/0"
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.serve, self.host, self.port)
+        # With port=0 the system picks a free one.
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self.server is None:
+            return
+        self.server.close()
+        # Ends every connection as if its client had hung up, and waits for them to finish.
+        for reader in self.clients:
+            reader.feed_eof()
+        await asyncio.gather(*self.clients.values())
+        await self.server.wait_closed()
+
+    async def serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.clients[reader] = asyncio.current_task()  # type: ignore
+        db = 0
+        authenticated = self.password is None
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                if not command:
+                    continue
+                name, args = command[0].upper(), command[1:]
+                if name == b"PING":
+                    reply: Reply = "PONG"
+                elif name == b"AUTH":
+                    authenticated = args[-1].decode("utf-8") == self.password
+                    reply = "OK" if authenticated else Error("WRONGPASS invalid password")
+                elif not authenticated:
+                    reply = Error("NOAUTH Authentication required.")
+                elif name == b"SELECT":
+                    db = int(args[0])
+                    reply = "OK"
+                elif name in self.commands:
+                    try:
+                        reply = self.commands[name](db, *args)
+                    except TypeError:
+                        reply = Error(f"ERR wrong number of arguments for '{name.decode().lower()}' command")
+                else:
+                    reply = Error(f"ERR unknown command '{name.decode()}'")
+                writer.write(encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.pop(reader, None)
+            writer.close()
+
+    def _strings(self, db: int) -> Dict[bytes, bytes]:
+        return self.strings.setdefault(db, {})
+
+    def _hash(self, db: int, key: bytes) -> Dict[bytes, bytes]:
+        return self.hashes.setdefault(db, {}).setdefault(key, {})
+
+    def get(self, db: int, key: bytes) -> Reply:
+        return self._strings(db).get(key)
+
+    def set(self, db: int, key: bytes, value: bytes, *options: bytes) -> Reply:
+        strings = self._strings(db)
+        if b"NX" in (o.upper() for o in options) and key in strings:
+            return None
+        strings[key] = value
+        return "OK"
+
+    def mget(self, db: int, *keys: bytes) -> Reply:
+        strings = self._strings(db)
+        return [strings.get(key) for key in keys]
+
+    def delete(self, db: int, *keys: bytes) -> Reply:
+        strings = self._strings(db)
+        hashes = self.hashes.setdefault(db, {})
+        return sum(
+            (strings.pop(key, None) is not None) + (hashes.pop(key, None) is not None)
+            for key in keys
+        )
+
+    def hget(self, db: int, key: bytes, field: bytes) -> Reply:
+        return self._hash(db, key).get(field)
+
+    def hset(self, db: int, key: bytes, *pairs: bytes) -> Reply:
+        if not pairs or len(pairs) % 2:
+            raise TypeError
+        values = self._hash(db, key)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+        return added
+
+    def hdel(self, db: int, key: bytes, *fields: bytes) -> Reply:
+        values = self._hash(db, key)
+        return sum(values.pop(field, None) is not None for field in fields)
+
+    def hgetall(self, db: int, key: bytes) -> Reply:
+        return [part for pair in self._hash(db, key).items() for part in pair]
+
+    def flushdb(self, db: int) -> Reply:
+        self.strings.pop(db, None)
+        self.hashes.pop(db, None)
+        return "OK"
+
+
+async def serve_forever(host: str, port: int, password: Optional[str]) -> None:
+    server = RedisStandIn(host, port, password)
+    await server.start()
+    print(f"Serving {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=RedisStandIn.__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password", default=None)
+    arguments = parser.parse_args()
+    asyncio.run(serve_forever(arguments.host, arguments.port, arguments.password))
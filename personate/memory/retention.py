@@ -0,0 +1,101 @@
+import gzip
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+import ujson as json
+
+DAY = 24 * 60 * 60
+
+
+class RetentionPolicy:
+    """
+    How long an agent's messages stay in its database.
+
+    A message is cold once it is older than max_age seconds (or its channel's entry in channel_max_age), or once there are more than max_rows newer messages. Cold messages are moved to the archive by Memory.compact – or deleted, if archive is False.
+
+    Example (in an agent's json):
+        "retention": {"max_age_days": 180, "max_rows": 500000, "channels": {"1234": 7}, "interval_hours": 6}
+    """
+
+    def __init__(
+        self,
+        max_age: Optional[float] = None,
+        max_rows: Optional[int] = None,
+        channel_max_age: Optional[Dict[int, float]] = None,
+        archive: bool = True,
+        interval: float = 6 * 60 * 60,
+    ) -> None:
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.channel_max_age = channel_max_age or {}
+        self.archive = archive
+        self.interval = interval
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RetentionPolicy":
+        max_age_days = data.get("max_age_days", None)
+        return cls(
+            max_age=max_age_days * DAY if max_age_days is not None else None,
+            max_rows=data.get("max_rows", None),
+            channel_max_age={
+                int(channel): days * DAY
+                for channel, days in data.get("channels", {}).items()
+            },
+            archive=data.get("archive", True),
+            interval=data.get("interval_hours", 6) * 60 * 60,
+        )
+
+
+class SegmentArchive:
+    """
+    Append-only storage for archived messages: each compaction writes its messages, one JSON object per line, to a new gzipped segment file, which is never changed again. Memory keeps which segment each archived message went to, so a thread can be read back on demand without scanning the archive.
+    """
+
+    def __init__(self, directory: str, cached_segments: int = 4) -> None:
+        self.directory = directory
+        self.cached_segments = cached_segments
+        self.segments: "OrderedDict[int, Dict[int, Dict[str, Any]]]" = OrderedDict()
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:06d}.jsonl.gz")
+
+    def write(self, segment: int, records: Iterable[Dict[str, Any]]) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(segment)
+        # Written under a temporary name first, so a crash never leaves a truncated segment behind.
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def read(self, segment: int) -> Dict[int, Dict[str, Any]]:
+        """Returns the records in a segment by message id, keeping the last few segments read in memory."""
+        if segment in self.segments:
+            self.segments.move_to_end(segment)
+            return self.segments[segment]
+        records: Dict[int, Dict[str, Any]] = {}
+        try:
+            with gzip.open(self.path(segment), "rt", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    records[record["id"]] = record
+        except FileNotFoundError:
+            pass
+        self.segments[segment] = records
+        while len(self.segments) > self.cached_segments:
+            self.segments.popitem(last=False)
+        return records
+
+    def get(self, segment: int, message_id: int) -> Optional[Dict[str, Any]]:
+        return self.read(segment).get(message_id)
+
+    def segment_paths(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".jsonl.gz")
+        )
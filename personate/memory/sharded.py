@@ -0,0 +1,530 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from personate.memory.backend import MemoryBackend
+from personate.memory.cache import MessageCache
+from personate.memory.memory import Memory
+from personate.memory.retention import RetentionPolicy
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+class ShardedMemory(MemoryBackend):
+    """
+    A Memory split into one database file per guild or channel, so that a busy server's writes never wait on another's, and a guild's history can be moved or deleted on its own.
+
+    It has the same async API as Memory. Messages are routed by channel id: with shard_by="channel" (the default) each channel has its own shard, and with shard_by="guild" each guild does. A channel's guild is taken from the guild_id of the messages stored in it and remembered in the root database, so it doesn't depend on which channels the bot happens to have cached; DMs, and channels no message with a guild has been stored for, get a shard of their own. At most max_open shards are kept open; the least recently used idle shard is flushed and closed to make room. Shards are opened and closed on a thread, never on the event loop. Anything that isn't a message (e.g profiles) lives in the root database at db_path.
+
+    Messages are always stored and read with a channel id, which every Discord message has. Looking a message up without one only has to search every shard for ids it hasn't seen recently; an author's vectors are only looked for in the shards they have written in.
+    """
+
+    # How many message ids to remember the shard of, for lookups made without a channel.
+    max_locations = 65536
+
+    def __init__(
+        self,
+        db_path: str,
+        shard_by: str = "channel",
+        max_open: int = 32,
+        directory: Optional[str] = None,
+        cache_messages: int = 1024,
+        **memory_options: Any,
+    ) -> None:
+        if shard_by not in ("channel", "guild"):
+            raise ValueError('shard_by must be "channel" or "guild"')
+        self.root = Memory.from_db(db_path)
+        self.shard_by = shard_by
+        self.max_open = max_open
+        self.directory = directory or os.path.splitext(db_path)[0] + "-shards"
+        os.makedirs(self.directory, exist_ok=True)
+        self.cache_messages = cache_messages
+        self.memory_options = memory_options
+        self.shards: "OrderedDict[int, Memory]" = OrderedDict()
+        self.opening: Dict[int, asyncio.Future] = {}
+        self.closing: Dict[int, asyncio.Future] = {}
+        self.users: Dict[int, int] = defaultdict(int)
+        # Guards self.shards for flush, cache_stats and close, which may be called off the event loop.
+        self.lock = threading.Lock()
+        self.listeners: List[Callable[[List[int]], None]] = []
+        self.known: Optional[Set[int]] = None
+        # Channel id -> guild id (or 0 if none is known), with shard_by="guild".
+        self.guilds: Dict[int, int] = {}
+        # Author id -> the shards they've written in.
+        self.authors: Dict[int, Set[int]] = {}
+        # Message id -> shard, for recently stored or found messages.
+        self.locations: "OrderedDict[int, int]" = OrderedDict()
+        # Model -> the shards that may still have messages it hasn't embedded.
+        self.backlog: Dict[str, Set[int]] = {}
+
+    def path(self, key: int) -> str:
+        return os.path.join(self.directory, f"{key}.sqlite")
+
+    def _list_shards(self) -> Set[int]:
+        return {
+            int(name[: -len(".sqlite")])
+            for name in os.listdir(self.directory)
+            if name.endswith(".sqlite")
+            and name[: -len(".sqlite")].lstrip("-").isdigit()
+        }
+
+    async def known_shards(self) -> List[int]:
+        """Every shard on disk. The directory is only listed once; shards opened since are added as they're created."""
+        if self.known is None:
+            self.known = await asyncio.to_thread(self._list_shards)
+        return sorted(self.known)
+
+    def _create(self, key: int) -> Memory:
+        shard = Memory.from_db(self.path(key), **self.memory_options)
+        shard.cache = MessageCache(
+            max_messages=self.cache_messages, max_bytes=self.cache_messages * 2048
+        )
+        # Shared, so listeners added later reach the shards that are already open.
+        shard.listeners = self.listeners
+        return shard
+
+    async def _load(self, key: int) -> None:
+        try:
+            shard = await asyncio.to_thread(self._create, key)
+            with self.lock:
+                self.shards[key] = shard
+            if self.known is not None:
+                self.known.add(key)
+        finally:
+            self.opening.pop(key, None)
+
+    async def _close(self, key: int, shard: Memory) -> None:
+        try:
+            # Closing flushes and waits for the shard's queries.
+            await asyncio.to_thread(shard.close)
+        except Exception as e:
+            logger.warning(f"Couldn't close shard {key} cleanly: {e}")
+        finally:
+            self.closing.pop(key, None)
+
+    async def _open(self, key: int) -> Memory:
+        while key not in self.shards:
+            # A shard that's still being closed is only opened again once everything it had waiting to be written is on disk.
+            pending = self.closing.get(key) or self.opening.get(key)
+            if pending is None:
+                pending = self.opening[key] = asyncio.ensure_future(self._load(key))
+            await asyncio.shield(pending)
+        self.shards.move_to_end(key)
+        return self.shards[key]
+
+    def _trim(self) -> None:
+        # Only shards no coroutine is using can be closed; the pool goes over max_open for a while rather than pull one out from under a query.
+        idle = [key for key in self.shards if not self.users[key]]
+        while len(self.shards) > self.max_open and idle:
+            key = idle.pop(0)
+            with self.lock:
+                evicted = self.shards.pop(key)
+            self.closing[key] = asyncio.ensure_future(self._close(key, evicted))
+
+    @asynccontextmanager
+    async def lease(self, key: int) -> AsyncIterator[Memory]:
+        """Opens shard key if it isn't open, and keeps it open until the with block ends."""
+        shard = await self._open(key)
+        self.users[key] += 1
+        try:
+            yield shard
+        finally:
+            self.users[key] -= 1
+            self._trim()
+
+    async def shard_key(self, channel_id: Optional[int]) -> int:
+        channel_id = channel_id or 0
+        if self.shard_by == "channel":
+            return channel_id
+        if channel_id not in self.guilds:
+            self.guilds[channel_id] = await self.root.get_value(
+                f"shard_guild:{channel_id}", 0
+            )
+        return self.guilds[channel_id] or channel_id
+
+    async def key_for(self, message: InternalMessage) -> int:
+        """The shard message belongs in, remembering the guild of its channel if it has one."""
+        channel_id = getattr(message, "channel_id", 0) or 0
+        guild_id = getattr(message, "guild_id", 0) or 0
+        if self.shard_by == "guild" and guild_id and self.guilds.get(channel_id) != guild_id:
+            self.guilds[channel_id] = guild_id
+            await self.root.set_value(f"shard_guild:{channel_id}", guild_id)
+        return await self.shard_key(channel_id)
+
+    @asynccontextmanager
+    async def shard(self, channel_id: Optional[int]) -> AsyncIterator[Memory]:
+        """Leases the shard channel_id's messages are in."""
+        async with self.lease(await self.shard_key(channel_id)) as shard:
+            yield shard
+
+    def _locate(self, message_ids: Iterable[int], key: int) -> None:
+        for message_id in message_ids:
+            self.locations[message_id] = key
+            self.locations.move_to_end(message_id)
+        while len(self.locations) > self.max_locations:
+            self.locations.popitem(last=False)
+
+    async def _author_shards(self, author_id: int) -> Set[int]:
+        if author_id not in self.authors:
+            self.authors[author_id] = set(
+                await self.root.get_value(f"shard_author:{author_id}", [])
+            )
+        return self.authors[author_id]
+
+    async def _stored(self, key: int, messages: List[InternalMessage]) -> None:
+        """Records where messages went, for lookups made without a channel."""
+        self._locate((m.id for m in messages), key)
+        for model in self.backlog.values():
+            model.add(key)
+        for author_id in {getattr(m, "author_id", None) for m in messages}:
+            if author_id is None:
+                continue
+            keys = await self._author_shards(author_id)
+            if key not in keys:
+                keys.add(key)
+                await self.root.set_value(f"shard_author:{author_id}", sorted(keys))
+
+    async def _by_shard(
+        self, messages: Iterable[InternalMessage]
+    ) -> Dict[int, List[InternalMessage]]:
+        by_key: Dict[int, List[InternalMessage]] = defaultdict(list)
+        for message in messages:
+            by_key[await self.key_for(message)].append(message)
+        return by_key
+
+    async def _find(self, message_ids: List[int]) -> Dict[int, InternalMessage]:
+        found: Dict[int, InternalMessage] = {}
+        located: Dict[int, List[int]] = defaultdict(list)
+        for message_id in message_ids:
+            if message_id in self.locations:
+                located[self.locations[message_id]].append(message_id)
+        for key, ids in located.items():
+            async with self.lease(key) as shard:
+                found.update(await shard.get_many(ids))
+        missing = [i for i in message_ids if i not in found]
+        if not missing:
+            return found
+        logger.debug(
+            f"Looking {len(missing)} messages up in every shard, since no channel was given"
+        )
+        for key in await self.known_shards():
+            if not missing:
+                break
+            async with self.lease(key) as shard:
+                more = await shard.get_many(missing)
+            self._locate(more, key)
+            found.update(more)
+            missing = [i for i in missing if i not in more]
+        return found
+
+    async def insert_message(self, message_id: int, message: InternalMessage):
+        key = await self.key_for(message)
+        async with self.lease(key) as shard:
+            await shard.insert_message(message_id, message)
+        await self._stored(key, [message])
+
+    async def insert_missing(self, messages: Iterable[InternalMessage]) -> int:
+        added = 0
+        for key, shard_messages in (await self._by_shard(messages)).items():
+            async with self.lease(key) as shard:
+                added += await shard.insert_missing(shard_messages)
+            await self._stored(key, shard_messages)
+        return added
+
+    async def get_many(
+        self, message_ids: Iterable[int], channel_id: Optional[int] = None
+    ) -> Dict[int, InternalMessage]:
+        message_ids = list(message_ids)
+        if channel_id is None:
+            return await self._find(message_ids)
+        async with self.shard(channel_id) as shard:
+            return await shard.get_many(message_ids)
+
+    async def get_message(
+        self, message_id: int, channel_id: Optional[int] = None
+    ) -> Optional[InternalMessage]:
+        return (await self.get_many([message_id], channel_id)).get(message_id)
+
+    async def has_message(
+        self, message_id: int, channel_id: Optional[int] = None
+    ) -> bool:
+        return await self.get_message(message_id, channel_id) is not None
+
+    async def get_watermark(self, channel_id: int) -> int:
+        async with self.shard(channel_id) as shard:
+            return await shard.get_watermark(channel_id)
+
+    async def advance_watermark(self, channel_id: int, message_id: int) -> None:
+        async with self.shard(channel_id) as shard:
+            await shard.advance_watermark(channel_id, message_id)
+
+    async def ancestors(
+        self,
+        message_id: int,
+        stop_at: int = 0,
+        limit: int = 50,
+        channel_id: Optional[int] = None,
+    ) -> List[InternalMessage]:
+        async with self.shard(channel_id) as shard:
+            return await shard.ancestors(message_id, stop_at, limit)
+
+    async def get_summary(
+        self, message_id: int, max_hops: int = 100, channel_id: Optional[int] = None
+    ) -> Optional[Tuple[int, str]]:
+        async with self.shard(channel_id) as shard:
+            return await shard.get_summary(message_id, max_hops)
+
+    async def set_summary(
+        self, message_id: int, summary: str, channel_id: Optional[int] = None
+    ) -> None:
+        async with self.shard(channel_id) as shard:
+            await shard.set_summary(message_id, summary)
+
+    async def _keys_in_scope(
+        self, channel: Optional[int], author: Optional[int]
+    ) -> List[int]:
+        if channel is not None:
+            return [await self.shard_key(channel)]
+        if author is not None:
+            return sorted(await self._author_shards(author))
+        return await self.known_shards()
+
+    async def search_scored(
+        self,
+        query: str,
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        limit: int = 20,
+        match_all: bool = True,
+    ) -> List[Tuple[float, InternalMessage]]:
+        results: List[Tuple[float, InternalMessage]] = []
+        for key in await self._keys_in_scope(channel, author):
+            async with self.lease(key) as shard:
+                found = await shard.search_scored(
+                    query, channel, author, limit, match_all
+                )
+            self._locate((m.id for _, m in found), key)
+            results += found
+        # Scores from different shards aren't exactly comparable (each has its own term statistics), but they're close enough to merge.
+        results.sort(key=lambda result: result[0])
+        return results[:limit]
+
+    async def search_messages(
+        self,
+        query: str,
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        limit: int = 20,
+        match_all: bool = True,
+    ) -> List[InternalMessage]:
+        return [
+            message
+            for _, message in await self.search_scored(
+                query, channel, author, limit, match_all
+            )
+        ]
+
+    def add_listener(self, listener: Callable[[List[int]], None]) -> None:
+        self.listeners.append(listener)
+
+    async def unembedded(
+        self, model: str, limit: int = 64, min_characters: int = 1
+    ) -> List[Tuple[int, int, str]]:
+        """Like Memory.unembedded, only looking in the shards that have had messages stored since they were last found to have none left to embed."""
+        if model not in self.backlog:
+            self.backlog[model] = set(await self.known_shards())
+        backlog = self.backlog[model]
+        found: List[Tuple[int, int, str]] = []
+        for key in sorted(backlog):
+            if len(found) >= limit:
+                break
+            async with self.lease(key) as shard:
+                batch = await shard.unembedded(
+                    model, limit - len(found), min_characters
+                )
+            if len(batch) < limit - len(found):
+                backlog.discard(key)
+            found += batch
+        return found
+
+    async def store_vectors(
+        self,
+        model: str,
+        vectors: List[Tuple[int, float, bytes]],
+        channel_id: Optional[int] = None,
+    ) -> None:
+        async with self.shard(channel_id) as shard:
+            await shard.store_vectors(model, vectors)
+
+    async def scan_vectors(
+        self,
+        model: str,
+        consumer: Callable[[List[Tuple[int, float, bytes]]], None],
+        channel: Optional[int] = None,
+        author: Optional[int] = None,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        page_size: int = 4096,
+        max_rows: Optional[int] = None,
+    ) -> int:
+        """Like Memory.scan_vectors. With a channel only its shard is read, with an author only the shards they've written in; the shard of every vector read is remembered, so get_many can find its message without a channel."""
+        scanned = 0
+        for key in await self._keys_in_scope(channel, author):
+            if max_rows is not None and scanned >= max_rows:
+                break
+
+            def consume(page: List[Tuple[int, float, bytes]], key: int = key) -> None:
+                consumer(page)
+                self._locate((i for i, _, _ in page), key)
+
+            async with self.lease(key) as shard:
+                scanned += await shard.scan_vectors(
+                    model,
+                    consume,
+                    channel,
+                    author,
+                    after,
+                    before,
+                    page_size,
+                    None if max_rows is None else max_rows - scanned,
+                )
+        return scanned
+
+    async def get_profile(self, author_id: int) -> Dict[str, str]:
+        return await self.root.get_profile(author_id)
+
+    async def set_profile_value(
+        self, author_id: int, key: str, value: Optional[str]
+    ) -> None:
+        await self.root.set_profile_value(author_id, key, value)
+
+    async def _keys_for(self, channels: Optional[Iterable[int]]) -> List[int]:
+        if channels is None:
+            return await self.known_shards()
+        return sorted({await self.shard_key(channel) for channel in channels})
+
+    async def count_messages(
+        self,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        channels: Optional[Iterable[int]] = None,
+    ) -> int:
+        channels = None if channels is None else list(channels)
+        total = 0
+        for key in await self._keys_for(channels):
+            async with self.lease(key) as shard:
+                total += await shard.count_messages(after, before, channels)
+        return total
+
+    async def iter_messages(
+        self,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+        channels: Optional[Iterable[int]] = None,
+        page_size: int = 1000,
+    ) -> AsyncIterator[List[InternalMessage]]:
+        """Like Memory.iter_messages, one shard after another (so in id order within each shard only)."""
+        channels = None if channels is None else list(channels)
+        for key in await self._keys_for(channels):
+            async with self.lease(key) as shard:
+                async for page in shard.iter_messages(
+                    after, before, channels, page_size
+                ):
+                    yield page
+
+    async def insert_many(self, messages: Iterable[InternalMessage]) -> int:
+        inserted = 0
+        for key, shard_messages in (await self._by_shard(messages)).items():
+            async with self.lease(key) as shard:
+                inserted += await shard.insert_many(shard_messages)
+            await self._stored(key, shard_messages)
+        return inserted
+
+    async def iter_profiles(
+        self, page_size: int = 1000
+    ) -> AsyncIterator[List[Tuple[int, str, str]]]:
+        async for page in self.root.iter_profiles(page_size):
+            yield page
+
+    async def insert_profiles(self, rows: List[Tuple[int, str, str]]) -> None:
+        await self.root.insert_profiles(rows)
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        return await self.root.get_value(key, default)
+
+    async def set_value(self, key: str, value: Any) -> None:
+        await self.root.set_value(key, value)
+
+    async def past_messages(
+        self,
+        reply_to: int,
+        window_size: int,
+        characters: int,
+        max_characters: int,
+        channel_id: Optional[int] = None,
+    ) -> List[InternalMessage]:
+        # Replies on Discord are always in the same channel as what they reply to, so the whole chain is in one shard.
+        async with self.shard(channel_id) as shard:
+            return await shard.past_messages(
+                reply_to, window_size, characters, max_characters
+            )
+
+    async def is_stored(self, message_id: int, channel_id: Optional[int] = None) -> bool:
+        async with self.shard(channel_id) as shard:
+            return await shard.is_stored(message_id)
+
+    async def retrieve_archived_thread(
+        self, message_id: int, window_size: int = 15, channel_id: Optional[int] = None
+    ) -> List[InternalMessage]:
+        if channel_id is not None:
+            keys = [await self.shard_key(channel_id)]
+        elif message_id in self.locations:
+            keys = [self.locations[message_id]]
+        else:
+            keys = await self.known_shards()
+        for key in keys:
+            async with self.lease(key) as shard:
+                thread = await shard.retrieve_archived_thread(message_id, window_size)
+            if thread:
+                return thread
+        return []
+
+    async def compact(self, policy: Optional[RetentionPolicy] = None) -> int:
+        compacted = 0
+        for key in await self.known_shards():
+            async with self.lease(key) as shard:
+                compacted += await shard.compact(policy)
+        return compacted
+
+    def flush(self) -> int:
+        with self.lock:
+            return sum(shard.flush() for shard in self.shards.values())
+
+    def cache_stats(self) -> Dict[str, int]:
+        totals: Dict[str, int] = defaultdict(int)
+        with self.lock:
+            for shard in self.shards.values():
+                for name, value in shard.cache_stats().items():
+                    totals[name] += value
+            totals["open_shards"] = len(self.shards)
+        return dict(totals)
+
+    def close(self) -> None:
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards.clear()
+        self.root.close()
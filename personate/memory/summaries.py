@@ -0,0 +1,100 @@
+import asyncio
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from personate.core.completions import default_generator_api
+from personate.swarm.internal_message import InternalMessage
+from personate.utils.logger import logger
+
+
+class ConversationSummariser:
+    """
+    Keeps a rolling summary of each reply chain in Memory, so a prompt can carry a long conversation as a short summary plus its most recent messages.
+
+    Summaries are incremental: a thread's summary is written from the nearest earlier summary and the messages since then, never from the whole thread. They are generated in background tasks, off the path of a reply, so a reply uses the newest summary there is and the next one catches up. Memory forgets a summary when a message it covers is changed.
+    """
+
+    def __init__(
+        self,
+        memory: Any,
+        generator_api: Callable = default_generator_api,
+        window: int = 40,
+        max_characters: int = 600,
+        max_concurrent: int = 2,
+        min_new_messages: int = 6,
+    ) -> None:
+        self.memory = memory
+        self.generator_api = generator_api
+        self.window = window
+        self.max_characters = max_characters
+        self.max_concurrent = max_concurrent
+        self.min_new_messages = min_new_messages
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+
+    async def summary_for(self, chain: List[InternalMessage]) -> str:
+        """
+        Returns the summary of everything before chain, a reply chain as returned by Memory.retrieve_reply_chain, or "" if there isn't one yet. If the summary doesn't reach all the way to chain, a newer one is generated in the background.
+        """
+        if not chain or not chain[0].reply_to:
+            return ""
+        boundary = chain[0].reply_to
+        channel_id = getattr(chain[0], "channel_id", 0)
+        found = await self.memory.get_summary(boundary, channel_id=channel_id)
+        if found is None or found[0] != boundary:
+            self.schedule(boundary, channel_id)
+        return found[1] if found else ""
+
+    def schedule(self, message_id: int, channel_id: int) -> None:
+        """Summarises the thread ending at message_id in the background, unless that's already happening."""
+        key = (channel_id, message_id)
+        if key in self.tasks:
+            return
+        task = asyncio.create_task(self._refresh(message_id, channel_id))
+        self.tasks[key] = task
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    async def _refresh(self, message_id: int, channel_id: int) -> None:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self.semaphore:
+            try:
+                await self.summarise(message_id, channel_id)
+            except Exception as e:
+                logger.warning(
+                    f"Couldn't summarise the thread ending at {message_id}: {e}"
+                )
+
+    async def summarise(self, message_id: int, channel_id: int) -> str:
+        """Writes, stores and returns the summary of the thread ending at message_id."""
+        previous = await self.memory.get_summary(message_id, channel_id=channel_id)
+        if previous and previous[0] == message_id:
+            return previous[1]
+        messages = await self.memory.ancestors(
+            message_id,
+            stop_at=previous[0] if previous else 0,
+            limit=self.window,
+            channel_id=channel_id,
+        )
+        # A summary that's only a few messages behind is kept, rather than paying for a new one every reply.
+        if not messages or (previous and len(messages) < self.min_new_messages):
+            return previous[1] if previous else ""
+        prompt = self.prompt(previous[1] if previous else "", messages)
+        summary = self.clean(await self.generator_api(prompt=prompt))
+        if summary:
+            await self.memory.set_summary(message_id, summary, channel_id=channel_id)
+        return summary
+
+    def prompt(self, previous: str, messages: List[InternalMessage]) -> str:
+        lines = ["(What follows is a conversation, and a short summary of it.)"]
+        if previous:
+            lines.append(f'(Earlier in this conversation: "{previous}")')
+        lines.extend(str(m) for m in messages)
+        lines.append('(Summary of the whole conversation: "')
+        return "\n".join(lines)
+
+    def clean(self, completion: str) -> str:
+        summary = re.sub(r"\s+", " ", completion.split('"')[0]).strip()
+        if len(summary) > self.max_characters:
+            summary = summary[: self.max_characters].rsplit(" ", 1)[0] + "…"
+        return summary
@@ -34,6 +34,9 @@ class AgentFromJSON:
         debug = data.get("debug", False)
         preset = data.get("preset", None)
         no_webhooks: bool = data.get("no_webhooks", False)
+        inference_workers: int = data.get("inference_workers", 0)
+        vector_precision: Optional[str] = data.get("vector_precision", None)
+        ranking_backend: Optional[str] = data.get("ranking_backend", None)
         logger.debug(
             f"Initialising agent from json with {name}, {token}, {reads}, {debug}, {preset}"
         )
@@ -50,6 +53,18 @@ class AgentFromJSON:
         if not name or not token or not preset:
             raise ValueError("\n".join(collected_errors))
 
+        if inference_workers:
+            from personate.embeddings.workers import configure_inference, inference_pool
+
+            # The pool is shared by every agent in the process, so only the first agent to ask for one creates it.
+            if inference_pool() is None:
+                configure_inference(workers=inference_workers)
+
+        if vector_precision:
+            from personate.embeddings.quantization import configure_quantization
+
+            configure_quantization(vector_precision)
+
         home_dir = data.get("home_directory", "temp-" + name)
         if not os.path.exists(home_dir):
             os.mkdir(home_dir)
@@ -107,8 +122,36 @@ class AgentFromJSON:
         agent.use_annotations(template)
 
         db_path = data.get("db_path", home_dir + "/db.sqlite")
-        agent.use_db(db_path)
+        retention = data.get("retention", None)
+        if retention:
+            from personate.memory.retention import RetentionPolicy
+
+            retention = RetentionPolicy.from_dict(retention)
+        # Seconds between batched commits of new messages. Unset, every message is committed as it arrives.
+        agent.use_db(
+            db_path,
+            flush_interval=data.get("db_flush_interval", None),
+            retention=retention,
+            shard_by=data.get("db_shard_by", None),
+        )
         logger.debug(f"Using db {db_path}")
+        if data.get("fetch_missing_replies", False):
+            agent.fetch_missing_replies()
+        recall = data.get("recall", None)
+        if recall:
+            # true for the defaults, or e.g {"limit": 3, "scope": "channel", "min_score": 0.4, "max_rows": 50000} to only search the newest 50000 messages in scope
+            agent.use_recall(**(recall if isinstance(recall, dict) else {}))
+        if data.get("conversation_summaries", False):
+            agent.use_summaries()
+        related_messages = data.get("related_messages", 0)
+        if related_messages:
+            # true for the defaults, how many to show, or e.g {"limit": 3, "scope": null} to search every channel and DM.
+            if isinstance(related_messages, dict):
+                agent.use_related_messages(**related_messages)
+            else:
+                agent.use_related_messages(
+                    3 if related_messages is True else int(related_messages)
+                )
 
         loading_message = data.get(
             "loading_message",
@@ -120,16 +163,6 @@ class AgentFromJSON:
         )
         logger.debug(f"Using avatar {avatar}")
 
-        activators = data.get("activators", [])
-        agent.add_activator(condition="on_ping", name=name)
-        for act in activators:
-            agent.add_activator(
-                condition="on_topic",
-                topic=act.get("listens_to"),
-                ignore_topics=act.get("ignores", []),
-            )
-            logger.debug(f"Using activator {act}")
-
         examples = data.get("examples", [])
         if not examples and not preset == "dm":
             raise ValueError(
@@ -156,6 +189,33 @@ class AgentFromJSON:
                     examples_str += f"<{name}>: {example['agent']}\n\n"
         agent.use_context_from(examples_str.split("\n\n"))
 
+        activators = data.get("activators", [])
+        if ranking_backend:
+            from personate.embeddings.registry import get_ranker
+
+            # Either a registered backend like "lexical", or the name of a SentenceTransformers model.
+            agent.set_ranker(get_ranker(ranking_backend))
+            # A backend that learns word weights (like "lexical") learns them from what the agent will rank: its examples and topics.
+            agent.fit_ranker(
+                [example for example in examples_str.split("\n\n") if example]
+                + [
+                    topic
+                    for act in activators
+                    for topic in [act.get("listens_to"), *act.get("ignores", [])]
+                    if topic
+                ]
+            )
+            logger.debug(f"Using ranking backend {ranking_backend}")
+
+        agent.add_activator(condition="on_ping", name=name)
+        for act in activators:
+            agent.add_activator(
+                condition="on_topic",
+                topic=act.get("listens_to"),
+                ignore_topics=act.get("ignores", []),
+            )
+            logger.debug(f"Using activator {act}")
+
         # if reading list, first check if the urllib-encoded urls already exist in a knowledge subdirectory
         knowledge_directory = data.get("knowledge_directory", home_dir + "/knowledge")
         for file in os.listdir(knowledge_directory):
@@ -179,7 +239,9 @@ class AgentFromJSON:
         if isinstance(content_warning_topics, list):
             from personate.decos.translators.translator import CWTaggerTranslator
 
-            cw_tagger = CWTaggerTranslator(topics=content_warning_topics)
+            cw_tagger = CWTaggerTranslator(
+                topics=content_warning_topics, ranker=agent.ranker
+            )
             agent.add_post_translator(cw_tagger)
             logger.debug(f"Using content warning topics {content_warning_topics}")
 
@@ -195,7 +257,7 @@ class AgentFromJSON:
         if "translate" in preprocessor_list.union(post_processor_list):
             from personate.decos.translators.translator import LanguageTranslator
 
-            translator = LanguageTranslator(default_language_code="en")
+            translator = LanguageTranslator(default_language_code="en", memory=agent.memory)
             if "translate" in preprocessor_list:
                 agent.add_pre_translator(translator)
             if "translate" in post_processor_list:
@@ -225,7 +287,9 @@ class AgentFromJSON:
         if emojis or emoji_file:
             from personate.decos.translators.translator import EmojiTranslator
 
-            emoji_translator = EmojiTranslator(file=emoji_file, emojis=emojis)
+            emoji_translator = EmojiTranslator(
+                file=emoji_file, emojis=emojis, ranker=agent.ranker
+            )
             agent.add_post_translator(emoji_translator)
             logger.debug(f"Using emojis {emojis}")
 
@@ -5,15 +5,25 @@ from rapidfuzz import cpp_fuzz, cpp_process
 import discord
 import asyncio
 from personate.utils.logger import logger
-from acrossword import Ranker
+from personate.embeddings.classifier import LabelClassifier, vectors_path_for
+from personate.embeddings.registry import get_ranker
 
 def icon_to_url(icon: str) -> str:
     return f"https://img.icons8.com/dusk/512/000000/{icon}.png"
 
+icon_classifier: Optional[LabelClassifier] = None
+
 async def get_top_icon(query: str) -> str:
-    from personate.meta.icons.dusk import icons
-    ranker = Ranker()
-    top = await ranker.rank(texts=tuple(icons.split("\n")), query=query, top_k=1, model=ranker.default_model)
+    global icon_classifier
+    if icon_classifier is None:
+        from personate.meta.icons import dusk
+        ranker = get_ranker()
+        icon_classifier = LabelClassifier(
+            dusk.icons.split("\n"),
+            ranker=ranker,
+            vectors_path=vectors_path_for(dusk.__file__, ranker),
+        )
+    top = await icon_classifier.classify(query, top_k=1)
     return top[0]
 
 async def get_top_url(query: str) -> str:
@@ -17,10 +17,9 @@ from typing import (
 
 import discord
 import ujson as json
-from acrossword import Document
-from acrossword.documents.documents import DocumentCollection
 from discord import commands
-from personate.decos.translators.translator import EmojiTranslator
+from personate.embeddings.documents import read_source
+from personate.decos.translators.translator import EmojiTranslator, language_code
 from personate.meta.standard.agents import Agent
 from personate.utils.logger import logger
 from personate.utils.username_generator import username_generator
@@ -47,11 +46,8 @@ def make_agent_modifier(bot: discord.Bot, agent: Agent, agent_dir: str):
             await ctx.channel.send("reading!")
             url_list = to_list(urls)
             documents = [
-                await Document.from_url_or_file(
-                    source=url,
-                    embedding_model=self.agent.ranker.default_model,
-                    is_url=True,
-                    directory_to_dump=self.agent_dir + "/knowledge",
+                await read_source(
+                    url, is_url=True, directory=self.agent_dir + "/knowledge"
                 )
                 for url in url_list
             ]
@@ -59,8 +55,9 @@ def make_agent_modifier(bot: discord.Bot, agent: Agent, agent_dir: str):
             await ctx.channel.send(f"Adding {len(documents)} documents.")
             # documents = await asyncio.gather(*[d for d in docs])
             logger.info(f"Finished processing {len(documents)} documents.")
-            for doc in documents:
-                await self.agent.add_document(doc)
+            for title, chunks in documents:
+                self.agent.knowledge.add(title, chunks)
+            await self.agent.knowledge.embed_missing()
             await ctx.channel.send(
                 f"I have added the following documents to {self.agent.name}'s database: \n{urls}"
             )
@@ -68,21 +65,7 @@ def make_agent_modifier(bot: discord.Bot, agent: Agent, agent_dir: str):
         @cr.register(owner=True)
         async def remember(self, ctx: discord.Message, fact: str):
             await ctx.channel.send("Remembering!")
-            collection: DocumentCollection = self.agent.document_collection
-            try:
-                doc = collection.retrieve("facts")
-                await doc.add_chunk(fact)
-                await doc.serialise()
-            except IndexError:
-                await ctx.channel.send("No facts found. Creating new facts document.")
-                doc = await Document.from_sentences(
-                    source=[fact],
-                    source_name="facts",
-                    directory_to_dump=self.agent_dir + "/knowledge",
-                    embedding_model=self.agent.ranker.default_model,
-                )
-                collection.add_document(doc)
-                await doc.serialise()
+            await self.agent.remember(fact)
             await ctx.channel.send("Remembering complete.")
 
         @cr.register(owner=True)
@@ -150,15 +133,24 @@ def make_agent_modifier(bot: discord.Bot, agent: Agent, agent_dir: str):
             await ctx.channel.send(f"Registering your pronouns as {pronoun}")
             if not self.agent.prompt.memory or not ctx.author:
                 return
-            db = self.agent.prompt.memory.db
-            if not db:
+            await self.agent.prompt.memory.set_profile_value(
+                ctx.author.id, "pronouns", pronoun
+            )
+
+        @cr.register()
+        async def setlanguage(self, ctx: discord.Message, language: str):
+            code = language_code(language)
+            if not code:
+                await ctx.channel.send(
+                    f"I don't know the language {language}; try its name or its ISO 639-1 code, e.g French or fr"
+                )
+                return
+            await ctx.channel.send(f"Registering your language as {code}")
+            if not self.agent.prompt.memory or not ctx.author:
                 return
-            if "pronouns" not in db.keys():
-                db.set("pronouns", {ctx.author.id: pronoun})
-            current_pronouns = db.get("pronouns")
-            current_pronouns[ctx.author.id] = pronoun
-            db.set("pronouns", current_pronouns)
-            db.commit()
+            await self.agent.prompt.memory.set_profile_value(
+                ctx.author.id, "language", code
+            )
 
         @cr.register(owner=True)
         async def addgoal(self, ctx: discord.Message, goal: str):
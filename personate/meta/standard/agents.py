@@ -1,10 +1,10 @@
 # TODO: send messages internally if they contain @system, don't show them to the end-user.
-from typing import AsyncGenerator, Callable, Coroutine, Dict, List, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Coroutine, Dict, Iterable, List, Optional, Tuple, Union
 
 import discord
 import ujson as json
 import uvloop
-from acrossword import Document, DocumentCollection, Ranker
+from acrossword import Document, Ranker
 from personate.activators.activators import Activator
 from asynchronise import Asynchronise
 from personate.decos.filter import Filter
@@ -14,9 +14,21 @@ from personate.decos.translators.translator import (
     MessageTrimmerTranslator,
     Translator,
 )
+from personate.embeddings.classifier import vectors_path_for
+from personate.embeddings.documents import (
+    DocumentIndex,
+    read_saved,
+    read_source,
+    save_chunks,
+)
+from personate.embeddings.registry import get_ranker, registry
 from personate.face.face import Face
+from personate.memory.fetcher import ReplyFetcher
+from personate.memory.backend import MemoryBackend
 from personate.memory.memory import Memory
-from sqlitedict import SqliteDict
+from personate.memory.redis_memory import RedisMemory
+from personate.memory.retention import RetentionPolicy
+from personate.memory.sharded import ShardedMemory
 from personate.swarm.internal_message import InternalMessage
 from personate.swarm.swarm import Swarm
 from personate.utils.logger import logger
@@ -53,7 +65,8 @@ class Agent:
             os.mkdir(f"{self.agent_dir}")
         if not os.path.exists(f"{self.agent_dir}/knowledge"):
             os.mkdir(f"{self.agent_dir}/knowledge")
-        self.ranker = Ranker()
+        self.ranker = get_ranker()
+        self.swarm.set_index_path(self.abilities_index_path())
         self.json_path: Optional[str] = json_path
         self.bot = discord.Bot(
             command_prefix=f"{name}!",
@@ -74,13 +87,13 @@ class Agent:
         self.post_translator: Translator = EmptyTranslator()
         self.post_translator.add_translator(MessageTrimmerTranslator())
         self.post_translator.add_translator(DiscordResponseTranslator())
-        self.document_collection = DocumentCollection(documents=[])
+        self.knowledge = DocumentIndex(self.ranker)
         self.prompt: AgentFrame = AgentFrame(name=self.name, swarm=self.swarm, parent=self)
         self.prompt.set_post_translator(self.post_translator)
         self.prompt.set_pre_translator(self.pre_translator)
         self.face: Optional[Face] = None
         self.document_queue: List[Coroutine] = []
-        self.memory: Optional[Memory] = None
+        self.memory: Optional[MemoryBackend] = None
         self.modifier = None
         self.improv_generator = None
         self.register_all()
@@ -114,8 +127,27 @@ class Agent:
 
     # TODO: Add inbuilt abilities.
 
+    def abilities_index_path(self) -> str:
+        return vectors_path_for(f"{self.agent_dir}/abilities", self.ranker)
+
     def set_ranker(self, ranker: Ranker) -> None:
+        """
+        Switches every ranking this agent does – activation, example selection, abilities and the translators added afterwards – to ranker, e.g get_ranker("lexical") to run without a neural model. Set it before adding activators and translators.
+        """
         self.ranker = ranker
+        self.knowledge.set_ranker(ranker)
+        self.swarm.set_ranker(ranker)
+        self.swarm.set_index_path(self.abilities_index_path())
+        self.prompt.set_ranker(ranker)
+
+    def fit_ranker(self, corpus: Iterable[str]) -> None:
+        """
+        Fits a ranking backend that learns from text, like "lexical", on corpus (e.g the agent's examples and topics) and switches to the fitted copy; see RankerRegistry.fit. Does nothing with a neural model. Like set_ranker, call it before adding activators and translators.
+        """
+        model_name = getattr(self.ranker, "model_name", None)
+        if model_name not in registry.backends:
+            return
+        self.set_ranker(registry.fit(model_name, corpus))
 
     def add_activator(
         self,
@@ -127,6 +159,7 @@ class Agent:
         name: Optional[str] = None,
         **kwargs,
     ) -> None:
+        kwargs.setdefault("ranker", self.ranker)
         self.activator.add_check(
             condition=condition,
             checker=checker,
@@ -177,11 +210,96 @@ class Agent:
         )
         self.prompt.set_introduction(annotations.get("introduction", ""))
 
-    def use_db(self, database_filename: str) -> None:
-        db = SqliteDict(database_filename, autocommit=True)
-        self.memory = Memory(db)
+    def use_db(
+        self,
+        database_filename: str,
+        flush_interval: Optional[float] = None,
+        retention: Optional[RetentionPolicy] = None,
+        shard_by: Optional[str] = None,
+    ) -> None:
+        """
+        With shard_by="channel" or "guild", messages are kept in a separate database per channel or per guild (see ShardedMemory), next to database_filename.
+
+        A redis:// (or rediss://) URL instead of a filename keeps memory in a Redis server, which several processes can share (see RedisMemory).
+        """
+        if database_filename.startswith(("redis://", "rediss://")):
+            unsupported = [
+                option
+                for option, value in (
+                    ("flush_interval", flush_interval),
+                    ("retention", retention),
+                    ("shard_by", shard_by),
+                )
+                if value
+            ]
+            if unsupported:
+                raise ValueError(
+                    f"{', '.join(unsupported)} can't be used with a Redis database; use a local database file instead."
+                )
+            memory: MemoryBackend = RedisMemory.from_url(
+                database_filename, prefix=f"personate:{self.name}"
+            )
+        elif shard_by:
+            memory = ShardedMemory(
+                database_filename,
+                shard_by=shard_by,
+                flush_interval=flush_interval,
+                retention=retention,
+            )
+        else:
+            memory = Memory.from_db(
+                database_filename, flush_interval=flush_interval, retention=retention
+            )
+        try:
+            if self.prompt.summariser:
+                self.require_memory_feature("Conversation summaries", "get_summary", memory)
+            if self.prompt.related_messages:
+                self.require_memory_feature("Related messages", "search_messages", memory)
+            if self.prompt.recall_options is not None:
+                self.require_memory_feature("Recall", "scan_vectors", memory)
+        except ValueError:
+            memory.close()
+            raise
+        self.memory = memory
         self.prompt.set_memory(self.memory)
 
+    def require_memory_feature(
+        self, feature: str, method: str, memory: Optional[MemoryBackend] = None
+    ) -> None:
+        """Raises a ValueError if memory (by default the one set with use_db) can't do what feature needs – e.g full-text search, which RedisMemory doesn't have."""
+        memory = memory or self.memory
+        if memory is not None and not hasattr(memory, method):
+            raise ValueError(
+                f"{feature} can't be used with {type(memory).__name__}; use a local database file instead."
+            )
+
+    def use_summaries(self, **kwargs: Any) -> None:
+        """Keeps rolling summaries of long conversations in memory, and puts them in the prompt ahead of the most recent messages. See ConversationSummariser."""
+        self.require_memory_feature("Conversation summaries", "get_summary")
+        self.prompt.use_summaries(**kwargs)
+
+    def use_related_messages(
+        self, limit: int = 3, scope: Optional[str] = "channel"
+    ) -> None:
+        """Shows the agent up to limit past messages related to the one it's replying to – from the same channel, by the same author, or from anywhere in its memory, DMs included (scope="channel", "author" or None)."""
+        self.require_memory_feature("Related messages", "search_messages")
+        self.prompt.use_related_messages(limit, scope)
+
+    def use_recall(
+        self, limit: int = 3, scope: Optional[str] = "author", **kwargs: Any
+    ) -> None:
+        """Shows the agent up to limit past messages semantically close to the one it's replying to – by the same author, in the same channel, or anywhere (scope="author", "channel" or None). See MessageRecall."""
+        self.require_memory_feature("Recall", "scan_vectors")
+        self.prompt.use_recall(limit=limit, scope=scope, **kwargs)
+
+    def fetch_missing_replies(self, max_concurrent: int = 4, **kwargs: Any) -> None:
+        """Lets memory fetch the messages a conversation replies to from Discord when it doesn't have them, rather than stopping at the latest messages read from the channel. See ReplyFetcher."""
+        if not self.memory:
+            raise Exception("No memory set; call use_db first.")
+        self.memory.set_fetcher(
+            ReplyFetcher(self.bot, max_concurrent=max_concurrent, **kwargs)
+        )
+
     def add_knowledge(
         self,
         filename: str,
@@ -190,28 +308,25 @@ class Agent:
         is_url: bool = False,
         directory: Optional[str] = None,
     ) -> None:
-        doc = None
-        if pre_computed:
-            doc = Document.deserialise(filename)
+        """
+        Queues a knowledge document to be read when the agent starts: a url, a text file, or (pre_computed) a .json file saved by an earlier read or serialised by acrossword. Documents are split into chunks, saved to directory (the agent's knowledge directory by default), and embedded with the agent's ranker into its DocumentIndex when the agent starts.
+        """
         if not directory:
             directory = self.agent_dir + "/knowledge"
-        if is_url:
-            doc = Document.from_url_or_file(
-                source=filename,
-                embedding_model=self.ranker.default_model,
-                is_url=True,
-                directory_to_dump=directory,
-                split_into_sentences=False,
-            )
-        elif is_text:
-            doc = Document.from_url_or_file(
-                source=filename,
-                embedding_model=self.ranker.default_model,
-                is_file=True,
-                directory_to_dump=directory,
+        if pre_computed:
+            self.document_queue.append(read_saved(filename))
+        elif is_url or is_text:
+            # A text file that's already in directory would be read twice next time if it was saved there too.
+            in_directory = is_text and os.path.abspath(
+                os.path.dirname(filename)
+            ) == os.path.abspath(directory)
+            self.document_queue.append(
+                read_source(
+                    filename,
+                    is_url=is_url,
+                    directory=None if in_directory else directory,
+                )
             )
-        if doc:
-            self.document_queue.append(doc)
 
     def add_knowledge_directory(self, directory_name: str):
         files = os.listdir(directory_name)
@@ -226,10 +341,16 @@ class Agent:
                 )
 
     async def assemble_documents(self):
-        documents: tuple[Document] = await asyncio.gather(*self.document_queue)
+        documents: List[Tuple[str, List[str]]] = await asyncio.gather(
+            *self.document_queue
+        )
         self.document_queue.clear()
-        self.document_collection.extend_documents(list(documents))
-        self.prompt.set_document_collection(self.document_collection)
+        for title, chunks in documents:
+            self.knowledge.add(title, chunks)
+        self.knowledge.fit_ranker()
+        await self.knowledge.embed_missing()
+        self.prompt.set_documents(self.knowledge)
+        await self.swarm.index_abilities()
 
     async def start(self):
         # tasks: List[Union[Coroutine, asyncio.Future]] = []
@@ -270,7 +391,17 @@ class Agent:
                 continue
 
     async def add_document(self, doc: Document):
-        self.document_collection.add_document(doc)
+        self.knowledge.add_document(doc)
+
+    async def remember(self, fact: str) -> None:
+        """Adds fact to the agent's knowledge, and to the facts document in its knowledge directory, which is read back in when the agent next starts."""
+        self.knowledge.add("facts", [fact])
+        await self.knowledge.embed_missing()
+        filename = f"{self.agent_dir}/knowledge/facts.json"
+        facts: List[str] = []
+        if os.path.exists(filename):
+            _, facts = await read_saved(filename)
+        save_chunks(filename, "facts", facts + [fact])
 
     def register_listeners(self):
         @self.bot.listen("on_message")
@@ -311,9 +442,15 @@ class Agent:
                 or not self.memory
             ):
                 return
-            agent_message: InternalMessage = self.memory.db[agent_message_id]
-            user_message_id = agent_message.reply_to
-            user_message: InternalMessage = self.memory.db[user_message_id]
+            channel_id = reaction.message.channel.id
+            agent_message = await self.memory.get_message(agent_message_id, channel_id)
+            if agent_message is None:
+                return
+            user_message = await self.memory.get_message(
+                agent_message.reply_to, channel_id
+            )
+            if user_message is None:
+                return
             interaction = str(user_message) + "\n" + str(agent_message)
             logger.debug(
                 f"{self.name} received positive feedback from this interaction: {interaction}"
@@ -346,9 +483,22 @@ class Agent:
     def register_all(self):
         self.register_listeners()
 
-async def add_replies_to_memory(memory: Memory, message: discord.Message, name: str):
-    last_20_messages = await message.channel.history(limit=10).flatten()
+async def add_replies_to_memory(memory: MemoryBackend, message: discord.Message, name: str):
+    """Stores the channel's recent messages, only asking Discord for the ones newer than the last message it read from the channel."""
+    watermark = await memory.get_watermark(message.channel.id)
+    if watermark:
+        history = message.channel.history(
+            limit=10, after=discord.Object(id=watermark), oldest_first=False
+        )
+    else:
+        history = message.channel.history(limit=10)
+    last_20_messages = await history.flatten()
+    if not last_20_messages:
+        return
+    internal_msgs = []
     for msg in last_20_messages:
+        if msg.author.name == name:
+            continue
         internal_msg = InternalMessage.from_discord_message(msg)
         try:
             reply_to = int(str(msg.embeds[0].footer.text))
@@ -356,7 +506,9 @@ async def add_replies_to_memory(memory: Memory, message: discord.Message, name:
             logger.debug("I found a message by a Personate chatbot and added a reply to it")
         except:
             pass
-        if not msg.id in memory.db.keys() and msg.author.name != name:
-            memory.db[msg.id] = internal_msg
-        else:
-            logger.debug(f"I already have a message with id {internal_msg.id}")
+        internal_msgs.append(internal_msg)
+    added = await memory.insert_missing(internal_msgs)
+    logger.debug(f"Added {added} of the last {len(last_20_messages)} messages to memory")
+    await memory.advance_watermark(
+        message.channel.id, max(msg.id for msg in last_20_messages)
+    )
@@ -1,4 +1,5 @@
 import asyncio
+import copy
 from typing import (
     Any,
     Coroutine,
@@ -10,12 +11,16 @@ from typing import (
 )
 
 import discord
-from acrossword import Document, DocumentCollection
 from personate.core.completions import default_generator_api
 from personate.core.frame import Frame
 from personate.decos.filter import Filter, DefaultFilter
 from personate.decos.translators.translator import EmptyTranslator, Translator
-from personate.memory.memory import Memory
+from personate.embeddings.context import EmbeddingContext
+from personate.embeddings.documents import DocumentIndex
+from personate.embeddings.registry import get_ranker
+from personate.memory.backend import MemoryBackend
+from personate.memory.recall import MessageRecall
+from personate.memory.summaries import ConversationSummariser
 from personate.decos.translators.translator import (
     DiscordResponseTranslator,
     MessageTrimmerTranslator,
@@ -40,6 +45,8 @@ class Turn:
         self.external_message_agent: Optional[discord.Message] = None
         self.internal_message_user: Optional[InternalMessage] = None
         self.external_message_user: Optional[discord.Message] = None
+        # Every stage of the turn embeds through this, so each distinct text is only embedded once.
+        self.embedding_context = EmbeddingContext(get_ranker())
         self.__dict__.update(kwargs)
 
 
@@ -54,6 +61,9 @@ class AgentFrame:
                 ("introduction", ""),
                 ("examples", ""),
                 ("pre_conversation_annotation", ""),
+                ("related_messages", ""),
+                ("recalled", ""),
+                ("conversation_summary", ""),
                 ("current_conversation", ""),
                 ("pre_response_annotation", ""),
                 ("reading_cue", ""),
@@ -65,11 +75,17 @@ class AgentFrame:
         self.name = name
         self.parent = parent
         self.swarm = swarm
+        self.ranker = get_ranker()
         self.examples = SemanticList()
         self.frame.filters = [DefaultFilter()]
-        self.memory: Optional[Memory] = None
+        self.memory: Optional[MemoryBackend] = None
+        self.summariser: Optional[ConversationSummariser] = None
+        self.related_messages: int = 0
+        self.related_scope: Optional[str] = "channel"
+        self.recall: Optional[MessageRecall] = None
+        self.recall_options: Optional[Dict[str, Any]] = None
         self.turns: Dict[int, Turn] = {}
-        self.document_collection: Optional[DocumentCollection] = None
+        self.documents: Optional[DocumentIndex] = None
         self.max_characters: int = 1000
         self.__dict__.update(kwargs)
         self.asyncer = Asynchronise(name="agent frame asyncer")
@@ -80,8 +96,113 @@ class AgentFrame:
     def add_filter(self, filter: Filter):
         self.frame.filters.append(filter)
 
-    def set_memory(self, mem: Memory):
+    def set_memory(self, mem: MemoryBackend):
         self.memory = mem
+        if self.summariser:
+            self.summariser.memory = mem
+        if self.recall_options is not None:
+            self.recall = MessageRecall(mem, self.ranker, **self.recall_options)
+
+    def use_summaries(self, **kwargs: Any):
+        """Puts a rolling summary of what came before the reply chain into the prompt. kwargs are passed to ConversationSummariser."""
+        kwargs.setdefault("generator_api", self.frame.generator_api)
+        self.summariser = ConversationSummariser(self.memory, **kwargs)
+
+    def use_related_messages(self, limit: int = 3, scope: Optional[str] = "channel"):
+        """
+        Puts up to limit past messages that share words with the user's message into the prompt, found with Memory's full-text index. They come from the same channel (scope="channel"), the same author (scope="author") or anywhere the agent has been, including DMs (scope=None).
+        """
+        if scope not in ("channel", "author", None):
+            raise ValueError('scope must be "channel", "author" or None')
+        self.related_messages = limit
+        self.related_scope = scope
+
+    async def related_to(
+        self, message: InternalMessage, conversation: List[InternalMessage]
+    ) -> str:
+        if not (self.related_messages and self.memory):
+            return ""
+        in_conversation = {m.id for m in conversation}
+        related = [
+            m
+            for m in await self.memory.search_messages(
+                message.internal_content,
+                channel=getattr(message, "channel_id", None)
+                if self.related_scope == "channel"
+                else None,
+                author=getattr(message, "author_id", None)
+                if self.related_scope == "author"
+                else None,
+                limit=self.related_messages + len(in_conversation),
+                match_all=False,
+            )
+            if m.id not in in_conversation and m.internal_content
+        ][: self.related_messages]
+        if not related:
+            return ""
+        return "(From earlier conversations:)\n" + "\n".join(str(m) for m in related)
+
+    def use_recall(
+        self,
+        limit: int = 3,
+        scope: Optional[str] = "author",
+        min_score: float = 0.3,
+        **kwargs: Any,
+    ):
+        """
+        Puts up to limit past messages that are semantically close to the user's message into the prompt, from the same author (scope="author"), the same channel (scope="channel") or anywhere (scope=None). kwargs are passed to MessageRecall.
+        """
+        self.recall_limit = limit
+        self.recall_scope = scope
+        self.recall_min_score = min_score
+        self.recall_options = kwargs
+        if self.memory:
+            self.recall = MessageRecall(self.memory, self.ranker, **kwargs)
+
+    async def recall_for(
+        self,
+        message: InternalMessage,
+        conversation: List[InternalMessage],
+        context: Optional[EmbeddingContext] = None,
+    ) -> str:
+        if not self.recall or not message.internal_content:
+            return ""
+        recalled = await self.recall.search(
+            message.internal_content,
+            top_k=self.recall_limit,
+            channel=getattr(message, "channel_id", None)
+            if self.recall_scope == "channel"
+            else None,
+            author=getattr(message, "author_id", None)
+            if self.recall_scope == "author"
+            else None,
+            exclude=[m.id for m in conversation],
+            min_score=self.recall_min_score,
+            context=context,
+        )
+        if not recalled:
+            return ""
+        return "(Recalled from earlier conversations:)\n" + "\n".join(
+            str(m) for _, m in recalled
+        )
+
+    def prefetch_for(
+        self,
+        context: EmbeddingContext,
+        current_conversation: str,
+        message: InternalMessage,
+    ) -> asyncio.Task:
+        """Starts embedding what the examples and the swarm will ask context for – the end of the conversation and, if there are abilities to pick from, the swarm's query – in one batch."""
+        texts = [current_conversation[-120:]]
+        if self.swarm.abilities:
+            texts.append(self.swarm.ability_query(message.internal_content))
+        return context.prefetch(texts)
+
+    async def summarise_before(self, conversation: List[InternalMessage]) -> str:
+        if not self.summariser:
+            return ""
+        summary = await self.summariser.summary_for(conversation)
+        return f'(Earlier in this conversation: "{summary}")' if summary else ""
 
     def set_pre_translator(self, translator: Translator):
         self.pre_translator = translator
@@ -89,8 +210,8 @@ class AgentFrame:
     def set_post_translator(self, translator: Translator):
         self.post_translator = translator
 
-    def set_document_collection(self, collection: DocumentCollection):
-        self.document_collection = collection
+    def set_documents(self, documents: DocumentIndex):
+        self.documents = documents
 
     # def add_reading_cue(self, sources: str):
     # self.frame.field_values["reading_cue"] = f'(Sources: "{sources}")'
@@ -109,12 +230,43 @@ class AgentFrame:
     # [str(c) for c in conversation]
     # )
 
+    def set_ranker(self, ranker: Any):
+        self.ranker = ranker
+        self.examples.set_ranker(ranker)
+        if self.recall:
+            self.recall.set_ranker(ranker)
+
     def set_examples(self, examples: List[Any]):
         self.examples = SemanticList([str(c) for c in examples if len(str(c)) > 0])
+        self.examples.set_ranker(self.ranker)
 
     def set_introduction(self, introduction: str):
         self.frame.field_values["introduction"] = introduction
 
+    async def render(self, messages: List[InternalMessage]) -> str:
+        """Renders messages for the prompt, one per line, showing each author's pronouns, if they've set any with addpronouns, next to their name. The messages themselves (and so what's stored) are left as they are."""
+        pronouns: Dict[int, str] = {}
+        if self.memory:
+            author_ids = list(
+                {getattr(m, "author_id", None) for m in messages} - {None}
+            )
+            profiles = await asyncio.gather(
+                *(self.memory.get_profile(a) for a in author_ids)
+            )
+            pronouns = {
+                a: p["pronouns"]
+                for a, p in zip(author_ids, profiles)
+                if p.get("pronouns")
+            }
+        lines = []
+        for message in messages:
+            author_pronouns = pronouns.get(getattr(message, "author_id", None))  # type: ignore
+            if author_pronouns:
+                message = copy.copy(message)
+                message.name = f"{message.name} ({author_pronouns})"
+            lines.append(str(message))
+        return "\n".join(lines)
+
     async def retrieve_reply_chain(
         self, internal_message_user: InternalMessage
     ) -> List[InternalMessage]:
@@ -143,6 +295,7 @@ class AgentFrame:
             external_message_agent=external_message_agent,
             internal_message_user=internal_message_user,
             internal_message_agent=internal_message_agent,
+            embedding_context=EmbeddingContext(self.ranker),
         )
         self.turns[turn.id] = turn
 
@@ -155,47 +308,58 @@ class AgentFrame:
             and turn.external_message_agent
         ):
             raise Exception("No user message set.")
-        # pronouns = self.memory.db.get("pronouns", {}).get(turn.internal_message_user.author_id, None)
-        # logger.debug(f"Pronouns: {pronouns}")
-        # logger.debug(f'Pronouns db: {self.memory.db.get("pronouns", None)}')
-        # if pronouns:
-        # turn.internal_message_user.name += f" ({pronouns})"
-        # logger.debug(f"Name of user: {turn.internal_message_user.name}")
         # if not external_message_user.id in self.memory.db.keys():
         await self.pre_translator.translate(
             processed_user_message=turn.internal_message_user,
             original_user_message=turn.external_message_user,
         )
-        if not external_message_user.id in self.memory.db.keys():
-            self.memory.insert_message(external_message_user.id, turn.internal_message_user)
+        await self.memory.insert_missing([turn.internal_message_user])
         # else:
         # turn.internal_message_user = self.memory.db[external_message_user.id]
 
         frame = self.frame.clone()
 
-        frame.field_values["current_conversation"] = "\n".join(
-            [
-                str(c)
-                for c in await self.memory.retrieve_reply_chain(
-                    message=turn.internal_message_user,
-                    max_characters=self.max_characters,
-                )
-            ]
+        conversation = await self.memory.retrieve_reply_chain(
+            message=turn.internal_message_user,
+            max_characters=self.max_characters,
+        )
+        frame.field_values["current_conversation"] = await self.render(conversation)
+        (
+            frame.field_values["conversation_summary"],
+            frame.field_values["related_messages"],
+            frame.field_values["recalled"],
+        ) = await asyncio.gather(
+            self.summarise_before(conversation),
+            self.related_to(turn.internal_message_user, conversation),
+            self.recall_for(
+                turn.internal_message_user, conversation, turn.embedding_context
+            ),
+        )
+        self.prefetch_for(
+            turn.embedding_context,
+            frame.field_values["current_conversation"],
+            turn.internal_message_user,
         )
 
         frame.field_values["examples"] = await self.examples.reordered(
-            query=frame.field_values["current_conversation"][-120:]
+            query=frame.field_values["current_conversation"][-120:],
+            context=turn.embedding_context,
         )
 
         api_result_task = asyncio.create_task(
-            self.swarm.solve(turn.internal_message_user.internal_content)
+            self.swarm.solve(
+                turn.internal_message_user.internal_content,
+                context=turn.embedding_context,
+            )
         )
 
-        if self.document_collection and len(self.document_collection.documents) > 0:
+        if self.documents and len(self.documents) > 0:
             top_results = [
                 r.replace("\n", " ")
-                for r in await self.document_collection.search(
-                    frame.field_values["current_conversation"][-120:], top=3
+                for r in await self.documents.search(
+                    frame.field_values["current_conversation"][-120:],
+                    top=3,
+                    context=turn.embedding_context,
                 )
             ]
             as_str = "\n".join(top_results)
@@ -216,8 +380,9 @@ class AgentFrame:
             agent_message=turn.internal_message_agent,
             user_message=turn.external_message_user,
             processed_user_message=turn.internal_message_user,
+            embedding_context=turn.embedding_context,
         )
-        self.memory.insert_message(
+        await self.memory.insert_message(
             external_message_agent.id, turn.internal_message_agent
         )
         return turn.internal_message_agent
@@ -234,9 +399,13 @@ class AgentFrame:
         ):
             yield external_message_user, "external_message_user"
             yield external_message_agent, "external_message_agent"
+            yield EmbeddingContext(self.ranker), "embedding_context"
             if not self.memory:
                 return
-            if not external_message_user.id in self.memory.db.keys():
+            stored_message_user = await self.memory.get_message(
+                external_message_user.id, external_message_user.channel.id
+            )
+            if stored_message_user is None:
                 internal_message_user = InternalMessage.from_discord_message(
                     external_message_user
                 )
@@ -248,7 +417,7 @@ class AgentFrame:
                     pass
                 logger.debug(f"User message was not in db: {internal_message_user}")
             else:
-                internal_message_user = self.memory.db[external_message_user.id]
+                internal_message_user = stored_message_user
                 logger.debug(f"User message was in db: {internal_message_user}")
             internal_message_agent = InternalMessage.from_discord_message(
                 external_message_agent
@@ -257,7 +426,7 @@ class AgentFrame:
                 processed_user_message=internal_message_user,
                 original_user_message=external_message_user,
             )
-            self.memory.insert_message(external_message_user.id, internal_message_user)
+            await self.memory.insert_message(external_message_user.id, internal_message_user)
             yield internal_message_user, "internal_message_user"
             yield internal_message_agent, "internal_message_agent"
 
@@ -269,37 +438,81 @@ class AgentFrame:
     def register_listeners(self):
         @self.asyncer.send
         @self.asyncer.collect(
-            {"internal_message_user": (InternalMessage, "internal_message_user", None)}
+            {
+                "internal_message_user": (
+                    InternalMessage,
+                    "internal_message_user",
+                    None,
+                ),
+                "embedding_context": (EmbeddingContext, "embedding_context", None),
+            }
         )
-        async def get_current_conversation(internal_message_user: InternalMessage):
+        async def get_current_conversation(
+            internal_message_user: InternalMessage,
+            embedding_context: EmbeddingContext,
+        ):
             if not self.memory:
+                yield None, "conversation_summary"
+                yield None, "related_messages"
+                yield None, "recalled"
                 yield None, "current_conversation"
                 return
             conversation = await self.memory.retrieve_reply_chain(
                 message=internal_message_user, max_characters=self.max_characters
             )
-            yield "\n".join([str(c) for c in conversation]), "current_conversation"
+            summary, related, recalled = await asyncio.gather(
+                self.summarise_before(conversation),
+                self.related_to(internal_message_user, conversation),
+                self.recall_for(
+                    internal_message_user, conversation, embedding_context
+                ),
+            )
+            yield summary, "conversation_summary"
+            yield related, "related_messages"
+            yield recalled, "recalled"
+            current_conversation = await self.render(conversation)
+            self.prefetch_for(
+                embedding_context, current_conversation, internal_message_user
+            )
+            yield current_conversation, "current_conversation"
 
         @self.asyncer.send
         @self.asyncer.collect(
-            {"internal_message_user": (InternalMessage, "internal_message_user", None)}
+            {
+                "internal_message_user": (
+                    InternalMessage,
+                    "internal_message_user",
+                    None,
+                ),
+                "embedding_context": (EmbeddingContext, "embedding_context", None),
+            }
         )
-        async def get_api_result(internal_message_user: InternalMessage):
-            api_result = await self.swarm.solve(internal_message_user.internal_content)
+        async def get_api_result(
+            internal_message_user: InternalMessage,
+            embedding_context: EmbeddingContext,
+        ):
+            api_result = await self.swarm.solve(
+                internal_message_user.internal_content, context=embedding_context
+            )
             yield api_result, "api_result"
 
         @self.asyncer.send
         @self.asyncer.collect(
-            {"current_conversation": (str, "current_conversation", None)}
+            {
+                "current_conversation": (str, "current_conversation", None),
+                "embedding_context": (EmbeddingContext, "embedding_context", None),
+            }
         )
-        async def get_document_results(current_conversation: str):
-            if not self.document_collection:
+        async def get_document_results(
+            current_conversation: str, embedding_context: EmbeddingContext
+        ):
+            if not self.documents:
                 yield None, "reading_cue"
                 return
             top_results = [
                 r.replace("\n", " ")
-                for r in await self.document_collection.search(
-                    current_conversation[-120:], top=3
+                for r in await self.documents.search(
+                    current_conversation[-120:], top=3, context=embedding_context
                 )
             ]
             yield "\n".join(top_results), "reading_cue"
@@ -308,27 +521,45 @@ class AgentFrame:
         @self.asyncer.collect(
             {
                 "current_conversation": (str, "current_conversation", None),
+                "embedding_context": (EmbeddingContext, "embedding_context", None),
             }
         )
-        async def get_examples(current_conversation: str):
+        async def get_examples(
+            current_conversation: str, embedding_context: EmbeddingContext
+        ):
             yield await self.examples.reordered(
-                query=current_conversation[-120:]
+                query=current_conversation[-120:], context=embedding_context
             ), "examples"
 
         @self.asyncer.send
         @self.asyncer.collect(
             {
                 "current_conversation": (str, "current_conversation", None),
+                "conversation_summary": (None, "conversation_summary", None),
+                "related_messages": (None, "related_messages", None),
+                "recalled": (None, "recalled", None),
                 "api_result": (None, "api_result", None),
                 "reading_cue": (None, "reading_cue", None),
                 "examples": (None, "examples", None),
             }
         )
         async def get_frame(
-            current_conversation: str, api_result: str, reading_cue: str, examples: str
+            current_conversation: str,
+            conversation_summary: str,
+            related_messages: str,
+            recalled: str,
+            api_result: str,
+            reading_cue: str,
+            examples: str,
         ):
             frame = self.frame.clone()
             frame.field_values["current_conversation"] = current_conversation
+            if conversation_summary:
+                frame.field_values["conversation_summary"] = conversation_summary
+            if related_messages:
+                frame.field_values["related_messages"] = related_messages
+            if recalled:
+                frame.field_values["recalled"] = recalled
             if api_result:
                 frame.field_values["api_result"] = f'(API result: "{api_result}")'
             if reading_cue:
@@ -359,12 +590,14 @@ class AgentFrame:
                     "external_message_user",
                     None,
                 ),
+                "embedding_context": (EmbeddingContext, "embedding_context", None),
             }
         )
         async def post_translation(
             internal_message_agent: InternalMessage,
             completion: str,
             external_message_user: discord.Message,
+            embedding_context: EmbeddingContext,
         ):
             internal_message_agent.reply_to = external_message_user.id
             internal_message_agent.external_content = completion
@@ -375,11 +608,12 @@ class AgentFrame:
                 agent_message=internal_message_agent,
                 user_message=external_message_user,
                 processed_user_message=internal_message_agent,
+                embedding_context=embedding_context,
             )
             yield internal_message_agent, "internal_message_agent_complete"
             if not self.memory:
                 return
-            self.memory.insert_message(
+            await self.memory.insert_message(
                 internal_message_agent.id, internal_message_agent
             )
 
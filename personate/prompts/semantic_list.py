@@ -1,9 +1,17 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
 from acrossword import Ranker
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.index import VectorIndex, embed
+from personate.embeddings.registry import get_ranker
 
 
 class SemanticList(list):
     """A list with an additional method called reorder that takes:
-    - query: a string to rank the list's contents by"""
+    - query: a string to rank the list's contents by
+
+    It keeps an embedding matrix aligned with its items. Items added with append/extend/insert are embedded lazily in one batch the next time the list is reordered, and removed items take their rows with them, so reordering only has to embed the query."""
 
     def set_maximum(self, maximum: int) -> None:
         self.maximum = maximum
@@ -12,17 +20,105 @@ class SemanticList(list):
         self.delimiter = delimiter
 
     def set_ranker(self, ranker: Ranker) -> None:
+        if ranker is not self.ranker:
+            self.vectors = VectorIndex(keys=[str(item) for item in self])
         self.ranker = ranker
 
-    async def reordered(self, query: str) -> list:
-        contents = [str(item) for item in self]
-        ranked = await self.ranker.rank(
-            texts=tuple(contents),
-            query=query,
-            top_k=999999,
-            model=self.ranker.default_model,
+    async def embed_missing(self) -> None:
+        """Embeds every item that doesn't have a row in the matrix yet."""
+        missing = sorted({self.vectors.keys[i] for i in self.vectors.missing()})
+        if not missing:
+            return
+        embedded: Dict[Any, np.ndarray] = dict(
+            zip(missing, await embed(self.ranker, missing))
+        )
+        # The list may have changed while we were embedding, so match rows by text rather than by position.
+        positions = [
+            i for i in self.vectors.missing() if self.vectors.keys[i] in embedded
+        ]
+        if positions:
+            self.vectors.set_rows(
+                positions,
+                np.stack([embedded[self.vectors.keys[i]] for i in positions]),
+            )
+
+    async def reordered(
+        self, query: str, context: Optional[EmbeddingContext] = None
+    ) -> list:
+        if len(self) == 0:
+            return []
+        await self.embed_missing()
+        query_vector = (await embed_in(context, self.ranker, [query]))[0]
+        ranked = [
+            self.vectors.keys[i]
+            for i, _ in self.vectors.search(query_vector, top_k=self.maximum)
+        ]
+        return list(reversed(ranked))
+
+    def _realign(self) -> None:
+        """Rebuilds the matrix after a mutation that can move items around arbitrarily, reusing the rows of items that were already embedded."""
+        old = self.vectors
+        filled = np.flatnonzero(old.filled).tolist()
+        known = dict(zip([old.keys[i] for i in filled], old.rows(filled)))
+        self.vectors = VectorIndex(keys=[str(item) for item in self])
+        positions = [i for i, key in enumerate(self.vectors.keys) if key in known]
+        if positions:
+            self.vectors.set_rows(
+                positions, np.stack([known[self.vectors.keys[i]] for i in positions])
+            )
+
+    def append(self, item: Any) -> None:
+        super().append(item)
+        self.vectors.append([str(item)])
+
+    def extend(self, items: Iterable[Any]) -> None:
+        items = list(items)
+        super().extend(items)
+        self.vectors.append([str(item) for item in items])
+
+    def insert(self, position: int, item: Any) -> None:
+        if position < 0:
+            position = max(0, len(self) + position)
+        position = min(position, len(self))
+        super().insert(position, item)
+        self.vectors.insert(position, [str(item)])
+
+    def pop(self, position: int = -1) -> Any:
+        item = super().pop(position)
+        self.vectors.delete([position % (len(self) + 1)])
+        return item
+
+    def remove(self, item: Any) -> None:
+        del self[self.index(item)]
+
+    def clear(self) -> None:
+        super().clear()
+        self.vectors = VectorIndex()
+
+    def __delitem__(self, key) -> None:
+        positions: List[int] = (
+            list(range(len(self))[key])
+            if isinstance(key, slice)
+            else [range(len(self))[key]]
         )
-        return list(reversed(ranked[: self.maximum]))
+        super().__delitem__(key)
+        self.vectors.delete(positions)
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self._realign()
+
+    def __iadd__(self, items: Iterable[Any]) -> "SemanticList":
+        self.extend(items)
+        return self
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self._realign()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._realign()
 
     def __str__(self):
         return self.delimiter.join(self[: self.maximum])
@@ -34,4 +130,5 @@ class SemanticList(list):
         super().__init__(*args, **kwargs)
         self.maximum = 5
         self.delimiter = "\n"
-        self.ranker = Ranker()
+        self.ranker = get_ranker()
+        self.vectors = VectorIndex(keys=[str(item) for item in self])
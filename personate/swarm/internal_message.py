@@ -39,6 +39,7 @@ class InternalMessage:
             pass
         setattr(new_instance, "id", message.id)
         setattr(new_instance, "channel_id", message.channel.id)
+        setattr(new_instance, "guild_id", message.guild.id if message.guild else 0)
         setattr(new_instance, "files", [])
         return new_instance
 
@@ -58,6 +59,7 @@ class InternalMessage:
         "internal_content",
         "external_content",
         "channel_id",
+        "guild_id",
         "embeds",
         "files",
         "author_id",
@@ -70,6 +72,7 @@ class InternalMessage:
         self.internal_content = ""
         self.external_content = ""
         self.channel_id = 0
+        self.guild_id = 0
         self.embeds = []
         self.files = []
 
@@ -1,32 +1,107 @@
-from typing import Dict, Callable, Any
+from typing import Dict, Callable, Any, Optional
 import ast
+import hashlib
+import os
+import numpy as np
 from pyai21 import get
 import inspect
 from personate.utils.logger import logger
 from personate.swarm.swarm_prompt import prompt
+from personate.embeddings.context import EmbeddingContext, embed_in
+from personate.embeddings.index import VectorIndex, embed
+from personate.embeddings.registry import get_ranker
 import importlib
 
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
 class Swarm:
     def __init__(self, Ranker=None):
         self.abilities: Dict[str, Callable] = {}
         self.prompt = prompt
-        if not Ranker:
-            from acrossword import Ranker
-            self.ranker = Ranker()
+        if Ranker:
+            self.ranker = Ranker
+        else:
+            self.ranker = get_ranker()
+        # Rows are keyed by the content hash of each ability's description. Vectors saved by a previous run (with an index_path) wait in known_vectors until their ability is registered, and are reused instead of embedded again.
+        self.index = VectorIndex()
+        self.descriptions: Dict[str, str] = {}
+        self.known_vectors: Dict[str, np.ndarray] = {}
+        self.index_path: Optional[str] = None
+
+    def set_ranker(self, ranker) -> None:
+        """Switches the ranker used to pick abilities. Vectors from different rankers can't be compared, so every ability is embedded again (or loaded from the next set_index_path)."""
+        if ranker is self.ranker:
+            return
+        self.ranker = ranker
+        self.index = VectorIndex(keys=self.index.keys)
+        self.known_vectors = {}
+
+    def set_index_path(self, path: str) -> None:
+        """Persists ability vectors to path (an .npz file), and loads any that were saved there before."""
+        self.index_path = path
+        if not os.path.exists(path):
+            return
+        saved = VectorIndex.load(path)
+        filled = np.flatnonzero(saved.filled).tolist()
+        self.known_vectors.update(
+            zip([saved.keys[i] for i in filled], saved.rows(filled))
+        )
+        missing = self.index.missing()
+        reusable = [i for i in missing if self.index.keys[i] in self.known_vectors]
+        if reusable:
+            self.index.set_rows(
+                reusable,
+                np.stack(
+                    [self.known_vectors.pop(self.index.keys[i]) for i in reusable]
+                ),
+            )
 
     def use(self, func: Callable) -> Callable:
         """This inserts a function into self.abilities, with the key as the function's docstring, and the value as the function itself"""
 
         if func.__doc__:
-            self.abilities[func.__doc__] = func
+            description = func.__doc__
         else:
             try:
-                source = inspect.getsource(func)
-                self.abilities[source] = func
+                description = inspect.getsource(func)
             except Exception as e:
-                self.abilities[func.__name__] = func
+                description = func.__name__
+        self.abilities[description] = func
+        key = content_hash(description)
+        if key not in self.descriptions:
+            self.descriptions[key] = description
+            vector = self.known_vectors.pop(key, None)
+            self.index.append(
+                [key], None if vector is None else vector.reshape(1, -1)
+            )
         return func
 
+    async def index_abilities(self) -> None:
+        """Embeds every registered ability that isn't in the index yet, in one batch. solve() calls this itself, but calling it at startup keeps the cost off the first message."""
+        missing = self.index.missing()
+        if not missing:
+            return
+        keys = [self.index.keys[i] for i in missing]
+        vectors = await embed(self.ranker, [self.descriptions[k] for k in keys])
+        # Abilities registered while we were embedding will be picked up next time, so match by key.
+        positions = [self.index.position_of(k) for k in keys]
+        self.index.set_rows(positions, vectors)
+        if self.index_path:
+            filled = np.flatnonzero(self.index.filled).tolist()
+            saved = VectorIndex(
+                keys=[self.index.keys[i] for i in filled],
+                matrix=self.index.rows(filled),
+                precision=self.index.precision,
+            )
+            if self.known_vectors:
+                saved.append(
+                    list(self.known_vectors.keys()),
+                    np.stack(list(self.known_vectors.values())),
+                )
+            saved.save(self.index_path)
+
     def use_module(self, filename: str, register_all: bool = True) -> None:
         """
         This imports a module and adds all of its functions to self.abilities, but only those defined in the top-level. So if you're importing other functions into your module, it won't register those. You can turn this off by passing register_all=True.
@@ -42,20 +117,26 @@ class Swarm:
                     logger.debug(f"Registering {obj.__name__}")
                     self.use(obj)
 
-    async def solve(self, query: str) -> Any:
+    @staticmethod
+    def ability_query(query: str) -> str:
+        """The text that gets embedded to look up an ability for query."""
+        return "A Python function that would be able to solve this question: " + query
+
+    async def solve(
+        self, query: str, context: Optional[EmbeddingContext] = None
+    ) -> Any:
         """This uses ranker to evaluate which function is most suited to the query, calls it, and returns the result"""
         if not len(self.abilities.keys()) > 0:
             logger.debug("No abilities registered!")
             return
-        top_function_docstring = await self.ranker.rank(
-            query="A Python function that would be able to solve this question: "
-            + query,
-            top_k=1,
-            texts=tuple(self.abilities.keys()),
-            model=self.ranker.default_model,
-            return_none_if_below_threshold=True,
-            threshold=0.5,
-        )
+        await self.index_abilities()
+        query_vector = (
+            await embed_in(context, self.ranker, [self.ability_query(query)])
+        )[0]
+        top_function_docstring = [
+            self.descriptions[self.index.keys[i]]
+            for i, _ in self.index.search(query_vector, top_k=1, threshold=0.5)
+        ]
         logger.debug(f"Top function for query {query} is {top_function_docstring}")
         if not top_function_docstring:
             return